@@ -3,10 +3,25 @@ Flask web application to display Entra ID profile pictures.
 """
 import os
 import csv
+import time
+import threading
+from collections import deque
+from urllib.parse import unquote
 import requests
-from flask import Flask, render_template, redirect, url_for, session, request
-from msal import ConfidentialClientApplication
+from flask import Flask, render_template, redirect, url_for, session, request, send_from_directory
+from msal import ConfidentialClientApplication, SerializableTokenCache
 from dotenv import load_dotenv
+from session_store import create_session_interface
+from classification_jobs import ClassificationJob
+from http_clients import get_client, upstream_stats
+from classifier_pool import ClassifierPool
+from response_cache import RenderCache
+from request_log import install_request_logging
+from profiler import install_profiler
+from photo_ingest import (BlobPhotoStore, LocalPhotoStore, MappingAppender, PhotoIngestor,
+                          UploadRejected)
+from directory_sync import DirectorySync
+from sprite_sheets import SpriteSheets, http_fetch
 
 # Load environment variables
 load_dotenv()
@@ -14,6 +29,27 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
 
+# Server-side sessions: the cookie only carries a signed session id.
+# SESSION_BACKEND is 'sqlite' (default), 'memory' or 'cookie' (Flask default).
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+SESSION_DB_PATH = os.getenv(
+    'SESSION_DB_PATH',
+    os.path.join(os.path.dirname(__file__), 'sessions.db')
+)
+_session_interface = create_session_interface(
+    SESSION_BACKEND,
+    db_path=SESSION_DB_PATH,
+    max_entries=int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+)
+if _session_interface is not None:
+    app.session_interface = _session_interface
+
+# One JSON line per request when REQUEST_LOG_PATH is set (see request_log.py)
+install_request_logging(app, 'app')
+
+# Admin-only sampling profiler when PROFILER_ADMIN_TOKEN is set (see profiler.py)
+install_profiler(app, 'app')
+
 # Azure AD / Entra ID Configuration
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
@@ -23,24 +59,174 @@ REDIRECT_URI = os.getenv('REDIRECT_URI', 'http://localhost:5000/auth/callback')
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPE = ["User.Read", "User.ReadBasic.All"]
 
-# Microsoft Graph API endpoint
-GRAPH_API_ENDPOINT = "https://graph.microsoft.com/v1.0"
+# Microsoft Graph API endpoint (overridable to point at a local stand-in)
+GRAPH_API_ENDPOINT = os.getenv('GRAPH_API_ENDPOINT', 'https://graph.microsoft.com/v1.0')
+
+# Classifier API used for photo classification. CLASSIFIER_API_URLS
+# (comma-separated) spreads requests over several replicas.
+CLASSIFIER_API_URL = os.getenv('CLASSIFIER_API_URL', 'https://profilepicapp-classifier-c2p7wl.azurewebsites.net')
+CLASSIFIER_API_URLS = [url.strip() for url in
+                       os.getenv('CLASSIFIER_API_URLS', CLASSIFIER_API_URL).split(',')]
+_hedge_after_ms = os.getenv('CLASSIFIER_HEDGE_AFTER_MS', '')
+classifier_pool = ClassifierPool(
+    CLASSIFIER_API_URLS,
+    strategy=os.getenv('CLASSIFIER_LB_STRATEGY', 'p2c'),
+    hash_affinity=os.getenv('CLASSIFIER_HASH_AFFINITY', '1') != '0',
+    hedge_after_ms=float(_hedge_after_ms) if _hedge_after_ms else None,
+    health_interval=float(os.getenv('CLASSIFIER_HEALTH_INTERVAL', '10'))
+)
+
+# Background classification of every user's photo
+classification_job = ClassificationJob(
+    classifier_pool,
+    max_workers=int(os.getenv('CLASSIFICATION_WORKERS', '4')),
+    max_retries=int(os.getenv('CLASSIFICATION_MAX_RETRIES', '3')),
+    store_result=lambda user, result: store_prediction(user, result),
+    # Cached pages are invalidated once per batch of results, not per result
+    on_result=lambda users: bump_mapping_version()
+)
+
+# MSAL token cache, shared by all users and persisted across restarts.
+# Entries are keyed by each user's home account id inside the cache file.
+TOKEN_CACHE_PATH = os.getenv(
+    'TOKEN_CACHE_PATH',
+    os.path.join(os.path.dirname(__file__), 'token_cache.json')
+)
 
 # Load photo URL mappings from CSV
 PHOTO_MAPPING = {}
 USER_LIST = []  # List of all users with photos
+USER_POSITIONS = {}  # lowercase UPN -> index in USER_LIST
+DIRECTORY_IDS = {}  # Graph object id -> lowercase UPN (users seen by the directory sync)
+_user_list_lock = threading.Lock()
+
+# Incremented whenever USER_LIST/PHOTO_MAPPING change; part of page cache keys
+MAPPING_VERSION = 0
+_mapping_version_lock = threading.Lock()
+
+# Number of users per gallery page
+GALLERY_PAGE_SIZE = int(os.getenv('GALLERY_PAGE_SIZE', '200'))
 
-# Try multiple possible CSV paths
+# Compressed cache of rendered gallery/browse pages
+render_cache = RenderCache(max_entries=int(os.getenv('RENDER_CACHE_ENTRIES', '512')))
+
+# Try multiple possible CSV paths (PHOTO_MAPPING_CSV, if set, comes first)
 CSV_PATHS = [
     os.path.join(os.path.dirname(__file__), 'scripts', 'test_images', 'profile_upload_map.csv'),
     os.path.join(os.path.dirname(__file__), 'profile_upload_map.csv'),
     'scripts/test_images/profile_upload_map.csv',
     'profile_upload_map.csv'
 ]
+if os.getenv('PHOTO_MAPPING_CSV'):
+    CSV_PATHS.insert(0, os.getenv('PHOTO_MAPPING_CSV'))
+# CSV that uploads are appended to (the one loaded at startup, if any)
+MAPPING_CSV_PATH = CSV_PATHS[0] if os.getenv('PHOTO_MAPPING_CSV') else CSV_PATHS[1]
+
+def bump_mapping_version():
+    """Mark the user mapping as changed so cached pages are re-rendered."""
+    global MAPPING_VERSION
+    with _mapping_version_lock:
+        MAPPING_VERSION += 1
+
+
+def apply_mapping_row(row, positions):
+    """
+    Add one upload map row to PHOTO_MAPPING/USER_LIST.
+    
+    Uploads append rows instead of rewriting the CSV, so a later row for the
+    same user replaces the earlier entry (`positions`: upn -> USER_LIST index).
+    
+    Returns:
+        the user entry
+    """
+    # Map userPrincipalName to blob URL (lowercase for case-insensitive lookup)
+    upn = row['UserPrincipalName'].lower()
+    PHOTO_MAPPING[upn] = row['BlobUrl']
+    # Store user info for browsing
+    user = {
+        'userPrincipalName': row['UserPrincipalName'],
+        'displayName': row['DisplayName'],
+        'blobUrl': row['BlobUrl'],
+        'category': row.get('Category', 'unknown')
+    }
+    if upn in positions:
+        USER_LIST[positions[upn]] = user
+    else:
+        positions[upn] = len(USER_LIST)
+        USER_LIST.append(user)
+    return user
+
+
+def store_prediction(user, result):
+    """
+    Store a classification result on the user's current entry.
+    
+    Entries are replaced when the mapping changes, so the entry is looked
+    up by UPN; results for a photo that has since been replaced are dropped.
+    
+    Returns:
+        the updated entry, or None if the result was dropped
+    """
+    upn = user['userPrincipalName'].lower()
+    with _user_list_lock:
+        position = USER_POSITIONS.get(upn)
+        if position is None or USER_LIST[position].get('blobUrl') != user.get('blobUrl'):
+            return None
+        current = USER_LIST[position]
+        current['predictedClass'] = result['predicted_class']
+        current['predictionConfidence'] = result['confidence']
+        return current
+
+
+def apply_directory_changes(upserts, removals):
+    """
+    Apply users changed in the directory (see directory_sync.py).
+    
+    Changed users keep their photo, category and prediction; users new to
+    the mapping are added without a photo, renamed users move to their new
+    UPN and removed users leave the mapping.
+    """
+    with _user_list_lock:
+        for change in upserts:
+            upn = change['userPrincipalName'].lower()
+            previous = (change.get('previousUserPrincipalName') or '').lower()
+            if previous and previous in USER_POSITIONS and upn not in USER_POSITIONS:
+                USER_POSITIONS[upn] = USER_POSITIONS.pop(previous)
+                if previous in PHOTO_MAPPING:
+                    PHOTO_MAPPING[upn] = PHOTO_MAPPING.pop(previous)
+            DIRECTORY_IDS[change['id']] = upn
+            if upn in USER_POSITIONS:
+                user = dict(USER_LIST[USER_POSITIONS[upn]])
+                user['userPrincipalName'] = change['userPrincipalName']
+                user['displayName'] = change.get('displayName') or user['displayName']
+                USER_LIST[USER_POSITIONS[upn]] = user
+            else:
+                USER_POSITIONS[upn] = len(USER_LIST)
+                USER_LIST.append({
+                    'userPrincipalName': change['userPrincipalName'],
+                    'displayName': change.get('displayName') or change['userPrincipalName'],
+                    'blobUrl': '',
+                    'category': 'no-picture'
+                })
+        
+        removed = {user['userPrincipalName'].lower() for user in removals}
+        for user in removals:
+            DIRECTORY_IDS.pop(user['id'], None)
+        removed &= USER_POSITIONS.keys()
+        if removed:
+            USER_LIST[:] = [user for user in USER_LIST
+                            if user['userPrincipalName'].lower() not in removed]
+            USER_POSITIONS.clear()
+            USER_POSITIONS.update({user['userPrincipalName'].lower(): i
+                                   for i, user in enumerate(USER_LIST)})
+            for upn in removed:
+                PHOTO_MAPPING.pop(upn, None)
+    bump_mapping_version()
+
 
 def load_photo_mappings():
     """Load photo URL mappings from CSV file."""
-    global PHOTO_MAPPING, USER_LIST
+    global PHOTO_MAPPING, USER_LIST, MAPPING_CSV_PATH
     
     csv_path = None
     for path in CSV_PATHS:
@@ -50,20 +236,13 @@ def load_photo_mappings():
     
     if csv_path:
         print(f"Found CSV at: {csv_path}")
+        MAPPING_CSV_PATH = csv_path
         try:
             with open(csv_path, 'r', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
                 for row in reader:
-                    # Map userPrincipalName to blob URL (lowercase for case-insensitive lookup)
-                    upn = row['UserPrincipalName'].lower()
-                    PHOTO_MAPPING[upn] = row['BlobUrl']
-                    # Store user info for browsing
-                    USER_LIST.append({
-                        'userPrincipalName': row['UserPrincipalName'],
-                        'displayName': row['DisplayName'],
-                        'blobUrl': row['BlobUrl'],
-                        'category': row.get('Category', 'unknown')
-                    })
+                    apply_mapping_row(row, USER_POSITIONS)
+            bump_mapping_version()
             print(f"✓ Loaded {len(PHOTO_MAPPING)} photo mappings from CSV")
             print(f"✓ User list contains {len(USER_LIST)} users")
         except Exception as e:
@@ -78,14 +257,186 @@ def load_photo_mappings():
 # Load mappings on startup
 load_photo_mappings()
 
+# Photo uploads: streamed to PHOTO_SPOOL_DIR, stored as a canonical JPEG in the
+# blob container (PHOTO_STORE_SAS_URL) or, without one, in a local directory
+# served under /uploads/, and appended to the upload map (see photo_ingest.py).
+# The spool holds unchecked request bodies, so it must not be under /uploads/.
+PHOTO_STORE_DIR = os.getenv('PHOTO_STORE_DIR', os.path.join(os.path.dirname(__file__), 'uploads'))
+if os.getenv('PHOTO_STORE_SAS_URL'):
+    photo_store = BlobPhotoStore(os.getenv('PHOTO_STORE_SAS_URL'))
+else:
+    photo_store = LocalPhotoStore(PHOTO_STORE_DIR,
+                                  os.getenv('PHOTO_STORE_BASE_URL', 'http://localhost:5000/uploads'))
+photo_ingestor = PhotoIngestor(
+    photo_store,
+    MappingAppender(MAPPING_CSV_PATH),
+    spool_dir=os.getenv('PHOTO_SPOOL_DIR', os.path.join(os.path.dirname(__file__), 'upload_spool')),
+    max_bytes=int(os.getenv('PHOTO_MAX_BYTES', str(10 * 1024 * 1024))),
+    max_side=int(os.getenv('PHOTO_MAX_SIDE', '512'))
+)
+
+
+def fetch_photo(url):
+    """Photo bytes by URL; photos in the local photo store are read from disk."""
+    if isinstance(photo_store, LocalPhotoStore) and url.startswith(f"{photo_store.base_url}/"):
+        name = unquote(url[len(photo_store.base_url) + 1:])
+        with open(os.path.join(PHOTO_STORE_DIR, os.path.basename(name)), 'rb') as f:
+            return f.read()
+    return http_fetch(url)
+
+
+# Gallery sprite sheets: thumbnails of each chunk of SPRITE_SHEET_USERS users
+# packed into one image, so a gallery page loads in a few image requests
+# (see sprite_sheets.py). SPRITE_SHEETS=off renders one <img> per user.
+SPRITE_SHEETS_ENABLED = os.getenv('SPRITE_SHEETS', 'on').lower() != 'off'
+sprite_sheets = SpriteSheets(
+    cache_dir=os.getenv('SPRITE_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'sprites')),
+    fetch=fetch_photo,
+    thumb_size=int(os.getenv('SPRITE_THUMB_SIZE', '160')),
+    sheet_users=min(int(os.getenv('SPRITE_SHEET_USERS', '100')), GALLERY_PAGE_SIZE)
+) if SPRITE_SHEETS_ENABLED else None
+
+
+# Live directory data: with DIRECTORY_SYNC=on a background thread applies users
+# added, changed or removed in Entra ID through Graph delta queries (the delta
+# link and a replica of the synced users are kept in DIRECTORY_SYNC_STATE_PATH)
+DIRECTORY_SYNC_ENABLED = os.getenv('DIRECTORY_SYNC', 'off').lower() == 'on'
+directory_sync = DirectorySync(
+    GRAPH_API_ENDPOINT,
+    token_provider=lambda: get_app_token(),
+    apply_changes=apply_directory_changes,
+    state_path=os.getenv('DIRECTORY_SYNC_STATE_PATH',
+                         os.path.join(os.path.dirname(__file__), 'directory_sync_state.json')),
+    interval=float(os.getenv('DIRECTORY_SYNC_INTERVAL', '300')),
+    page_size=int(os.getenv('DIRECTORY_SYNC_PAGE_SIZE', '500'))
+) if DIRECTORY_SYNC_ENABLED else None
+
+
+# Process-wide MSAL application and token cache
+_msal_app = None
+_msal_app_lock = threading.Lock()
+_token_cache = SerializableTokenCache()
+_token_cache_lock = threading.Lock()
+
+# Recent login timings in milliseconds (reported by /debug/status)
+LOGIN_TIMINGS = {
+    'authorize_url': deque(maxlen=100),
+    'token_exchange': deque(maxlen=100),
+    'silent_token': deque(maxlen=100),
+}
+
+
+def _load_token_cache():
+    """Load the persisted token cache from disk, if present."""
+    if not os.path.exists(TOKEN_CACHE_PATH):
+        return
+    try:
+        with open(TOKEN_CACHE_PATH, 'r', encoding='utf-8') as f:
+            _token_cache.deserialize(f.read())
+        print(f"✓ Loaded token cache from: {TOKEN_CACHE_PATH}")
+    except Exception as e:
+        print(f"Error loading token cache: {e}")
+
+
+def _save_token_cache():
+    """Persist the token cache to disk if it changed since the last save."""
+    if not _token_cache.has_state_changed:
+        return
+    with _token_cache_lock:
+        if not _token_cache.has_state_changed:
+            return
+        try:
+            tmp_path = f"{TOKEN_CACHE_PATH}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(_token_cache.serialize())
+            os.replace(tmp_path, TOKEN_CACHE_PATH)
+        except Exception as e:
+            print(f"Error saving token cache: {e}")
+
+
+def _record_timing(name, started):
+    """Record the elapsed time since `started` under the given login stage."""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    LOGIN_TIMINGS[name].append(elapsed_ms)
+    return elapsed_ms
+
 
 def get_msal_app():
-    """Create and return MSAL application instance."""
-    return ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET
-    )
+    """
+    Return the process-wide MSAL application instance.
+    
+    The instance is created once so authority/OIDC discovery runs a single
+    time, and it shares one serializable token cache across all requests.
+    """
+    global _msal_app
+    
+    if _msal_app is None:
+        with _msal_app_lock:
+            if _msal_app is None:
+                _load_token_cache()
+                _msal_app = ConfidentialClientApplication(
+                    CLIENT_ID,
+                    authority=AUTHORITY,
+                    client_credential=CLIENT_SECRET,
+                    token_cache=_token_cache
+                )
+    return _msal_app
+
+
+def _get_session_account(msal_app):
+    """Find the cached MSAL account belonging to the current session."""
+    account_id = session.get('home_account_id')
+    if not account_id:
+        return None
+    for account in msal_app.get_accounts():
+        if account.get('home_account_id') == account_id:
+            return account
+    return None
+
+
+def get_access_token():
+    """
+    Return an access token for the signed-in user.
+    
+    Tokens come from the shared MSAL cache; MSAL refreshes them silently
+    with the cached refresh token when they expire. Falls back to the token
+    stored at login if the account is no longer in the cache.
+    """
+    # Sessions without a cached account skip MSAL entirely
+    account = None
+    if 'home_account_id' in session:
+        msal_app = get_msal_app()
+        account = _get_session_account(msal_app)
+    if account:
+        started = time.perf_counter()
+        result = msal_app.acquire_token_silent(SCOPE, account=account)
+        _record_timing('silent_token', started)
+        _save_token_cache()
+        if result and 'access_token' in result:
+            if session.get('access_token') != result['access_token']:
+                session['access_token'] = result['access_token']
+            return result['access_token']
+    return session.get('access_token')
+
+
+def get_app_token():
+    """
+    Return an app-only Graph token (client credentials) for background work.
+    
+    Needs the User.Read.All application permission. Returns None when the
+    app is not configured or the token request fails.
+    """
+    if not all([CLIENT_ID, CLIENT_SECRET, TENANT_ID]):
+        return None
+    result = get_msal_app().acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+    if result and 'access_token' in result:
+        return result['access_token']
+    print(f"App token request failed: {result.get('error_description') if result else None}")
+    return None
+
+
+if directory_sync is not None:
+    directory_sync.start()
 
 
 @app.route('/')
@@ -99,11 +450,13 @@ def index():
 @app.route('/login')
 def login():
     """Initiate OAuth2 login flow."""
+    started = time.perf_counter()
     msal_app = get_msal_app()
     auth_url = msal_app.get_authorization_request_url(
         SCOPE,
         redirect_uri=REDIRECT_URI
     )
+    _record_timing('authorize_url', started)
     return redirect(auth_url)
 
 
@@ -114,19 +467,34 @@ def auth_callback():
     if not code:
         return "Error: No authorization code received", 400
     
+    started = time.perf_counter()
     msal_app = get_msal_app()
     result = msal_app.acquire_token_by_authorization_code(
         code,
         scopes=SCOPE,
         redirect_uri=REDIRECT_URI
     )
+    elapsed_ms = _record_timing('token_exchange', started)
+    print(f"Token exchange completed in {elapsed_ms:.1f} ms")
+    _save_token_cache()
     
     if "error" in result:
         return f"Error: {result.get('error_description')}", 400
     
+    # New session id for the signed-in session (server-side sessions only;
+    # Flask's cookie sessions carry no id that could have been planted)
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+    
     # Store access token in session
     session['access_token'] = result['access_token']
     
+    # Remember which cached MSAL account belongs to this session
+    claims = result.get('id_token_claims', {})
+    accounts = msal_app.get_accounts(username=claims.get('preferred_username'))
+    if accounts:
+        session['home_account_id'] = accounts[0]['home_account_id']
+    
     # Get user profile
     user_info = get_user_profile(result['access_token'])
     if user_info:
@@ -138,6 +506,12 @@ def auth_callback():
 @app.route('/logout')
 def logout():
     """Clear session and logout."""
+    if 'home_account_id' in session:
+        msal_app = get_msal_app()
+        account = _get_session_account(msal_app)
+        if account:
+            msal_app.remove_account(account)
+            _save_token_cache()
     session.clear()
     return redirect(url_for('index'))
 
@@ -149,27 +523,48 @@ def debug_status():
         'csv_loaded': len(PHOTO_MAPPING) > 0,
         'total_mappings': len(PHOTO_MAPPING),
         'total_users': len(USER_LIST),
-        'sample_upns': list(PHOTO_MAPPING.keys())[:5] if PHOTO_MAPPING else []
+        'sample_upns': list(PHOTO_MAPPING.keys())[:5] if PHOTO_MAPPING else [],
+        'login_latency_ms': {
+            name: {
+                'count': len(timings),
+                'avg': round(sum(timings) / len(timings), 1) if timings else None,
+                'last': round(timings[-1], 1) if timings else None
+            }
+            for name, timings in LOGIN_TIMINGS.items()
+        }
     }
 
 
+@app.route('/debug/render-cache')
+def debug_render_cache():
+    """Render time and cache hit rate for cached pages."""
+    stats = render_cache.stats()
+    stats['mapping_version'] = MAPPING_VERSION
+    return stats
+
+
+@app.route('/debug/upstreams')
+def debug_upstreams():
+    """Latency histograms and circuit breaker state per upstream dependency."""
+    stats = upstream_stats()
+    stats['classifier_pool'] = classifier_pool.stats()
+    return stats
+
+
 @app.route('/debug/test-classifier')
 def test_classifier():
     """Test endpoint to verify connectivity to the classifier API."""
     if 'access_token' not in session:
         return redirect(url_for('login'))
     
-    classifier_url = os.getenv('CLASSIFIER_API_URL', 'https://profilepicapp-classifier-c2p7wl.azurewebsites.net')
-    
     results = {
-        'classifier_url': classifier_url,
+        'classifier_urls': CLASSIFIER_API_URLS,
         'tests': {}
     }
     
     # Test 1: Health check
     try:
-        health_url = f"{classifier_url}/api/health"
-        response = requests.get(health_url, timeout=90)
+        response = classifier_pool.get('/api/health')
         results['tests']['health_check'] = {
             'status': 'success' if response.status_code == 200 else 'failed',
             'status_code': response.status_code,
@@ -183,8 +578,7 @@ def test_classifier():
     
     # Test 2: Root endpoint
     try:
-        root_url = f"{classifier_url}/"
-        response = requests.get(root_url, timeout=90)
+        response = classifier_pool.get('/')
         results['tests']['root_endpoint'] = {
             'status': 'success' if response.status_code == 200 else 'failed',
             'status_code': response.status_code,
@@ -200,14 +594,14 @@ def test_classifier():
     if USER_LIST:
         try:
             test_user = USER_LIST[0]
-            if test_user.get('BlobUrl'):
-                classify_url = f"{classifier_url}/api/classify/url"
-                payload = {'image_url': test_user['BlobUrl']}
-                response = requests.post(classify_url, json=payload, timeout=30)
+            if test_user.get('blobUrl'):
+                payload = {'image_url': test_user['blobUrl']}
+                response = classifier_pool.post('/api/classify/url', key=test_user['blobUrl'],
+                                                json=payload)
                 results['tests']['classify_image'] = {
                     'status': 'success' if response.status_code == 200 else 'failed',
                     'status_code': response.status_code,
-                    'test_image': test_user['BlobUrl'],
+                    'test_image': test_user['blobUrl'],
                     'response': response.json() if response.status_code == 200 else response.text[:200]
                 }
         except Exception as e:
@@ -219,6 +613,29 @@ def test_classifier():
     return results
 
 
+@app.route('/classification/run', methods=['POST'])
+def run_classification():
+    """Start classifying every user's photo in the background."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    
+    started = classification_job.start(USER_LIST)
+    status = classification_job.status()
+    status['started'] = started
+    return status, 202 if started else 409
+
+
+@app.route('/classification/status')
+def classification_status():
+    """Report progress and throughput of the background classification job."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    
+    status = classification_job.status()
+    status['classified_users'] = sum(1 for user in USER_LIST if user.get('predictedClass'))
+    return status
+
+
 @app.route('/browse')
 @app.route('/browse/<int:index>')
 def browse_profiles(index=0):
@@ -235,14 +652,16 @@ def browse_profiles(index=0):
     if not USER_LIST:
         return "No users found", 404
     
-    current_user = USER_LIST[index]
+    def render():
+        current_user = USER_LIST[index]
+        return render_template('browse.html', 
+                              user=current_user,
+                              current_index=index,
+                              total_users=len(USER_LIST),
+                              has_prev=index > 0,
+                              has_next=index < len(USER_LIST) - 1)
     
-    return render_template('browse.html', 
-                          user=current_user,
-                          current_index=index,
-                          total_users=len(USER_LIST),
-                          has_prev=index > 0,
-                          has_next=index < len(USER_LIST) - 1)
+    return render_cache.respond('browse', ('browse', MAPPING_VERSION, index), render)
 
 
 @app.route('/gallery')
@@ -254,9 +673,74 @@ def gallery():
     if not USER_LIST:
         return "No users found", 404
     
-    return render_template('gallery.html', 
-                          users=USER_LIST,
-                          total_users=len(USER_LIST))
+    # ?categories=predicted filters by classifier output instead of the CSV column
+    use_predicted = request.args.get('categories') == 'predicted'
+    
+    total_pages = max(1, -(-len(USER_LIST) // GALLERY_PAGE_SIZE))
+    page = min(max(request.args.get('page', 1, type=int), 1), total_pages)
+    start_index = (page - 1) * GALLERY_PAGE_SIZE
+    
+    def render():
+        sprites = {}
+        if sprite_sheets is not None:
+            sprites = sprite_sheets.page_tiles(USER_LIST, start_index, GALLERY_PAGE_SIZE,
+                                               lambda name: url_for('gallery_sprite', name=name))
+        return render_template('gallery.html', 
+                              users=USER_LIST[start_index:start_index + GALLERY_PAGE_SIZE],
+                              sprites=sprites,
+                              total_users=len(USER_LIST),
+                              start_index=start_index,
+                              page=page,
+                              total_pages=total_pages,
+                              use_predicted=use_predicted)
+    
+    # Pages are re-rendered once new sprite sheets are ready
+    sprite_version = sprite_sheets.version if sprite_sheets is not None else 0
+    cache_key = ('gallery', MAPPING_VERSION, sprite_version, use_predicted, page)
+    return render_cache.respond('gallery', cache_key, render)
+
+
+@app.route('/gallery/sprites/<name>')
+def gallery_sprite(name):
+    """Serve a sprite sheet image or manifest (names are content-addressed)."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    if sprite_sheets is None:
+        return "Sprite sheets are disabled", 404
+    if name.endswith('.json'):
+        return send_from_directory(sprite_sheets.sheet_dir, name, mimetype='application/json',
+                                   max_age=0)
+    response = send_from_directory(sprite_sheets.sheet_dir, name, mimetype='image/jpeg',
+                                   max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/gallery/sprites/build', methods=['POST'])
+def build_gallery_sprites():
+    """Build every missing sprite sheet for the current user list in the background."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    if sprite_sheets is None:
+        return {'error': 'Sprite sheets are disabled'}, 404
+    with _user_list_lock:
+        users = list(USER_LIST)
+    sprite_sheets.start_build_all(users)
+    status = sprite_sheets.stats()
+    status['users'] = len(users)
+    return status, 202
+
+
+@app.route('/debug/sprites')
+def debug_sprites():
+    """Sprite sheet build counters and cache size."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    if sprite_sheets is None:
+        return {'enabled': False}
+    status = sprite_sheets.stats()
+    status['enabled'] = True
+    return status
 
 
 @app.route('/profile/photo')
@@ -285,10 +769,17 @@ def user_photo(user_id):
     # If user_id looks like a UPN, use it directly
     if '@' in user_id:
         user_upn = user_id.lower()
+    elif user_id in DIRECTORY_IDS:
+        # Object ids of synced directory users resolve without a Graph call
+        user_upn = DIRECTORY_IDS[user_id]
     else:
         # Need to fetch user info from Graph to get UPN
-        headers = {'Authorization': f"Bearer {session['access_token']}"}
-        response = requests.get(f"{GRAPH_API_ENDPOINT}/users/{user_id}", headers=headers)
+        headers = {'Authorization': f"Bearer {get_access_token()}"}
+        try:
+            response = get_client('graph').get(f"{GRAPH_API_ENDPOINT}/users/{user_id}", headers=headers)
+        except requests.RequestException as e:
+            print(f"Graph user lookup failed: {e}")
+            return redirect(url_for('static', filename='placeholder.png'))
         
         if response.status_code == 200:
             user_data = response.json()
@@ -303,10 +794,83 @@ def user_photo(user_id):
         return redirect(url_for('static', filename='placeholder.png'))
 
 
+@app.route('/user/<user_id>/photo', methods=['PUT'])
+def upload_user_photo(user_id):
+    """
+    Upload a user's profile photo as the raw request body (streamed).
+    
+    Query parameters: displayName, category (animal/avatar/human); both
+    optional, defaulting to the user's current entry. The X-Filename header keeps the original file name. The photo is
+    classified in the background. Signed-in users can only upload their
+    own photo.
+    """
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    if '@' not in user_id:
+        return {'error': 'Photos are uploaded by user principal name'}, 400
+    own_upn = session.get('user', {}).get('userPrincipalName', '')
+    if user_id.lower() != own_upn.lower():
+        return {'error': 'You can only upload your own photo'}, 403
+    
+    with _user_list_lock:
+        position = USER_POSITIONS.get(user_id.lower())
+        current = dict(USER_LIST[position]) if position is not None else None
+    
+    try:
+        row = photo_ingestor.ingest(
+            user_id,
+            request.stream,
+            content_length=request.content_length,
+            display_name=request.args.get('displayName'),
+            file_name=request.headers.get('X-Filename'),
+            category=request.args.get('category'),
+            current=current
+        )
+    except UploadRejected as e:
+        return {'error': str(e)}, e.status_code
+    
+    with _user_list_lock:
+        user = apply_mapping_row(row, USER_POSITIONS)
+    bump_mapping_version()
+    classification_job.submit(user)
+    return {'user': user, 'blobName': row['BlobName'], 'classification': 'queued'}, 201
+
+
+@app.route('/uploads/<path:name>')
+def uploaded_photo(name):
+    """Serve photos from the local photo store (stand-in for blob storage)."""
+    return send_from_directory(PHOTO_STORE_DIR, name, mimetype='image/jpeg', max_age=86400)
+
+
+@app.route('/debug/directory-sync')
+def debug_directory_sync():
+    """Progress and lag of the Graph delta directory sync."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    if directory_sync is None:
+        return {'enabled': False}
+    status = directory_sync.status()
+    status['enabled'] = True
+    status['mapping_version'] = MAPPING_VERSION
+    return status
+
+
+@app.route('/debug/uploads')
+def debug_uploads():
+    """Upload counters of the photo ingestion pipeline."""
+    if 'access_token' not in session:
+        return "Unauthorized", 401
+    return photo_ingestor.stats()
+
+
 def get_user_profile(access_token):
     """Get user profile information from Microsoft Graph."""
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(f"{GRAPH_API_ENDPOINT}/me", headers=headers)
+    try:
+        response = get_client('graph').get(f"{GRAPH_API_ENDPOINT}/me", headers=headers)
+    except requests.RequestException as e:
+        print(f"Graph profile request failed: {e}")
+        return None
     
     if response.status_code == 200:
         return response.json()
@@ -0,0 +1,265 @@
+"""
+Offline benchmark of the web app's routes
+
+Drives /gallery, /browse/<n>, /user/<id>/photo and /profile/photo of
+app.py in-process (Flask test clients, one per worker thread) with a
+signed-in session, against synthetic upload maps of any size. Graph
+(/me, /users/{id}) and blob storage are served by local_standins.py, and
+MSAL is never contacted (the session carries its access token), so no
+network access or credentials are needed. Sprite sheets are off (their
+background builds would fetch photos and invalidate cached pages mid-run),
+and the worker refuses every connection to a host other than this one: a
+run that attempted any fails and lists them under outbound_requests.
+
+Every map size runs in a fresh process, because app.py loads its mapping
+at import. Per route it reports latency percentiles, throughput, status
+codes and mean response size:
+
+    users   route                 n   req/s    p50 ms    p95 ms    p99 ms   mean bytes
+
+Usage:
+    python benchmark_app.py                                   # 100, 1k, 10k and 100k users
+    python benchmark_app.py --users 1000 --concurrency 16 --requests 500
+    python benchmark_app.py --routes gallery browse --gzip --graph-latency-ms 40
+    python benchmark_app.py --users 10000 --render-cache-entries 0   # no page cache
+
+Reports are written to logs/benchmarks/.
+"""
+import argparse
+import csv
+import json
+import os
+import ipaddress
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from local_standins import StandinServer, load_users
+from replay_requests import percentiles
+
+BASE_DIR = Path(__file__).parent
+REPORTS_DIR = BASE_DIR / "logs" / "benchmarks"
+
+USER_COUNTS = (100, 1000, 10000, 100000)
+ROUTES = ('gallery', 'browse', 'user_photo_upn', 'user_photo_id', 'profile_photo')
+CATEGORIES = ('human', 'avatar', 'animal', 'no-picture')
+
+
+def write_synthetic_mapping(path, users, seed=0):
+    """An upload map with `users` rows in the format of profile_upload_map.csv"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(['UserPrincipalName', 'DisplayName', 'ImageFileName', 'BlobName',
+                         'BlobUrl', 'Category', 'UploadDate'])
+        for i in range(users):
+            category = CATEGORIES[rng.randrange(len(CATEGORIES))]
+            file_name = blob = url = ''
+            if category != 'no-picture':
+                file_name = f"{category}_{i:06d}.jpg"
+                blob = f"profile_{file_name}"
+                url = f"https://benchstore.blob.core.windows.net/profile-photos/{blob}"
+            writer.writerow([f"benchuser{i:06d}@bench.example", f"Bench User {i}", file_name,
+                             blob, url, category, '2025-10-24 12:00:00'])
+
+
+def _is_local(host):
+    if isinstance(host, bytes):
+        host = host.decode('ascii', 'replace')
+    if host in (None, '', 'localhost'):
+        return True
+    try:
+        return ipaddress.ip_address(host.split('%')[0]).is_loopback
+    except ValueError:
+        return False
+
+
+def block_outbound():
+    """
+    Refuse connections and name lookups for hosts other than this one for
+    the rest of the process; returns the list the refused hosts are added to
+    """
+    refused = []
+
+    def audit(event, args):
+        if event == 'socket.getaddrinfo':
+            host = args[0]
+        elif event == 'socket.connect' and isinstance(args[1], tuple):
+            host = args[1][0]
+        else:
+            return
+        if not _is_local(host):
+            refused.append(host if isinstance(host, str) else repr(host))
+            raise ConnectionRefusedError(f"benchmark: outbound connection to {host} refused")
+
+    sys.addaudithook(audit)
+    return refused
+
+
+class RouteDriver:
+    """Builds request paths per route and sends them from per-thread clients"""
+
+    def __init__(self, app_module, users, gzip=False, seed=0):
+        self.app_module = app_module
+        self.users = users
+        self.headers = {'Accept-Encoding': 'gzip'} if gzip else {}
+        self.rng = random.Random(seed)
+        self._local = threading.local()
+
+    def paths(self, route, count):
+        app = self.app_module
+        total = len(app.USER_LIST)
+        pages = max(1, -(-total // app.GALLERY_PAGE_SIZE))
+        make = {
+            'gallery': lambda: f"/gallery?page={self.rng.randint(1, pages)}",
+            'browse': lambda: f"/browse/{self.rng.randrange(max(total, 1))}",
+            'user_photo_upn': lambda: f"/user/{self.rng.choice(self.users)['userPrincipalName']}/photo",
+            'user_photo_id': lambda: f"/user/{self.rng.choice(self.users)['id']}/photo",
+            'profile_photo': lambda: "/profile/photo",
+        }[route]
+        return [make() for _ in range(count)]
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self.app_module.app.test_client()
+            me = self.users[0] if self.users else {}
+            with client.session_transaction() as session:
+                session['access_token'] = 'benchmark-token'
+                session['user'] = {'userPrincipalName': me.get('userPrincipalName', ''),
+                                   'displayName': me.get('displayName', '')}
+            self._local.client = client
+        return client
+
+    def get(self, path):
+        started = time.perf_counter()
+        response = self._client().get(path, headers=self.headers)
+        body = response.get_data()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        response.close()
+        return elapsed_ms, response.status_code, len(body)
+
+
+def run_route(driver, route, requests, concurrency, warmup=5):
+    for path in driver.paths(route, warmup):
+        driver.get(path)
+    paths = driver.paths(route, requests)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(driver.get, paths))
+    elapsed = time.perf_counter() - started
+    latencies = [ms for ms, _, _ in results]
+    return {
+        'route': route,
+        'requests': len(results),
+        'concurrency': concurrency,
+        'requests_per_second': round(len(results) / elapsed, 1),
+        'latency_ms': percentiles(latencies),
+        'statuses': dict(Counter(str(status) for _, status, _ in results)),
+        'mean_bytes': round(sum(size for _, _, size in results) / len(results)),
+    }
+
+
+def run_size(users, routes, requests, concurrency, gzip=False, graph_latency_ms=0.0):
+    """Benchmark one map size in this process (imports app.py)"""
+    refused = block_outbound()
+    workdir = tempfile.mkdtemp(prefix='benchmark_app_')
+    map_path = os.path.join(workdir, 'profile_upload_map.csv')
+    write_synthetic_mapping(map_path, users)
+    standins = StandinServer(map_path=map_path, graph_latency_ms=graph_latency_ms).start()
+
+    os.environ.update({
+        'PHOTO_MAPPING_CSV': map_path,
+        'GRAPH_API_ENDPOINT': standins.graph_url,
+        'SESSION_BACKEND': 'memory',
+        'TOKEN_CACHE_PATH': os.path.join(workdir, 'token_cache.json'),
+        'PHOTO_STORE_DIR': os.path.join(workdir, 'uploads'),
+        'SPRITE_SHEETS': 'off',
+        'SPRITE_CACHE_DIR': os.path.join(workdir, 'sprites'),
+    })
+    started = time.perf_counter()
+    import app as app_module
+    load_seconds = time.perf_counter() - started
+
+    driver = RouteDriver(app_module, load_users(map_path), gzip)
+    results = [run_route(driver, route, requests, concurrency) for route in routes]
+    standins.stop()
+    return {'users': users, 'load_seconds': round(load_seconds, 2),
+            'graph_requests': standins.requests_served, 'routes': results,
+            'outbound_requests': dict(Counter(refused))}
+
+
+def print_report(reports):
+    print(f"\n{'users':>7s}  {'route':16s} {'n':>6s} {'req/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} "
+          f"{'p99 ms':>8s} {'mean bytes':>11s}  status")
+    print("-" * 100)
+    for report in reports:
+        for r in report['routes']:
+            lat = r['latency_ms']
+            print(f"{report['users']:7d}  {r['route']:16s} {r['requests']:6d} "
+                  f"{r['requests_per_second']:8.1f} {lat['p50']:8.2f} {lat['p95']:8.2f} "
+                  f"{lat['p99']:8.2f} {r['mean_bytes']:11d}  {r['statuses']}")
+        print(f"{'':9s}(mapping loaded in {report['load_seconds']} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app.py routes offline")
+    parser.add_argument('--users', type=int, nargs='+', default=list(USER_COUNTS),
+                        help="Synthetic map sizes to benchmark")
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES))
+    parser.add_argument('--requests', type=int, default=300, help="Requests per route")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--gzip', action='store_true', help="Send Accept-Encoding: gzip")
+    parser.add_argument('--graph-latency-ms', type=float, default=0.0,
+                        help="Latency added by the Graph stand-in")
+    parser.add_argument('--render-cache-entries', type=int, default=None,
+                        help="RENDER_CACHE_ENTRIES for the app (0 disables the page cache)")
+    parser.add_argument('--report', default=None, help="Write the JSON report here")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_size(args.users[0], args.routes, args.requests, args.concurrency,
+                                  args.gzip, args.graph_latency_ms)))
+        return
+
+    env = dict(os.environ)
+    if args.render_cache_entries is not None:
+        env['RENDER_CACHE_ENTRIES'] = str(args.render_cache_entries)
+    reports = []
+    for users in args.users:
+        print(f"Benchmarking {users} users ...")
+        cmd = [sys.executable, str(Path(__file__).resolve()), '--worker', '--users', str(users),
+               '--routes', *args.routes, '--requests', str(args.requests),
+               '--concurrency', str(args.concurrency),
+               '--graph-latency-ms', str(args.graph_latency_ms)]
+        if args.gzip:
+            cmd.append('--gzip')
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True, env=env,
+                                cwd=BASE_DIR).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+    print_report(reports)
+
+    REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    report_path = Path(args.report) if args.report else (
+        REPORTS_DIR / f"app_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'concurrency': args.concurrency, 'requests_per_route': args.requests,
+                   'gzip': args.gzip, 'graph_latency_ms': args.graph_latency_ms,
+                   'render_cache_entries': args.render_cache_entries, 'sizes': reports}, f, indent=2)
+    print(f"\nReport written to {report_path}")
+
+    outbound = {host: n for report in reports
+                for host, n in report['outbound_requests'].items()}
+    if outbound:
+        sys.exit(f"Benchmark attempted outbound connections (refused): {outbound}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Background classification of user profile photos.
+
+Runs every user's photo through the classifier API (/api/classify/url) on a
+bounded worker pool and stores the predicted class and confidence on the
+user entries themselves, so the gallery can filter by predicted category.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+# HTTP status codes worth retrying (throttling / transient server errors)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ClassificationJob:
+    """
+    Classifies user photos in the background.
+
+    Only one run is active at a time. Progress is available through
+    status() while the run is in flight and after it finishes.
+    """
+
+    def __init__(self, classifier, max_workers=4, max_retries=3,
+                 backoff_seconds=1.0, store_result=None, on_result=None,
+                 notify_interval=1.0):
+        """
+        Args:
+            classifier: classifier_pool.ClassifierPool shared by all workers,
+                routing each image to a replica (with timeouts, circuit
+                breakers and hedging)
+            store_result: optional function(user, result) that stores a
+                prediction and returns the updated entry (or None if the
+                user is gone); by default the result is written into the
+                user dict that was queued
+            on_result: optional callback invoked with the list of updated
+                user entries, at most once per notify_interval seconds
+        """
+        self.classifier = classifier
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.store_result = store_result
+        self.on_result = on_result
+        self.notify_interval = notify_interval
+        self._unreported = []
+        self._notify_timer = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reset_progress(0)
+        self.state = 'idle'
+
+        # Single photos queued with submit(), e.g. right after an upload
+        self._executor = None
+        self.submitted = {'queued': 0, 'completed': 0, 'failed': 0}
+
+    def _reset_progress(self, total):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self.last_error = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, users):
+        """
+        Start classifying `users` in a background thread.
+
+        Args:
+            users: list of user dicts with a 'blobUrl' key; results are
+                written to 'predictedClass' and 'predictionConfidence'
+
+        Returns:
+            True if a run was started, False if one is already in progress
+        """
+        with self._lock:
+            if self.is_running():
+                return False
+            targets = [user for user in users if user.get('blobUrl')]
+            self._reset_progress(len(targets))
+            self.state = 'running'
+            self.started_at = time.time()
+            self._thread = threading.Thread(
+                target=self._run, args=(targets,), name='classification-job', daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, users):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._classify_with_retry, user['blobUrl']): user
+                       for user in users}
+            for future in as_completed(futures):
+                user = futures[future]
+                try:
+                    self._store_result(user, future.result())
+                    with self._lock:
+                        self.completed += 1
+                except Exception as e:
+                    with self._lock:
+                        self.failed += 1
+                        self.last_error = f"{user.get('userPrincipalName')}: {e}"
+        with self._lock:
+            self.finished_at = time.time()
+            self.state = 'finished'
+        print(f"✓ Classification job finished: {self.completed} classified, {self.failed} failed")
+
+    def _store_result(self, user, result):
+        if self.store_result is not None:
+            user = self.store_result(user, result)
+        else:
+            user['predictedClass'] = result['predicted_class']
+            user['predictionConfidence'] = result['confidence']
+        if user is not None and self.on_result is not None:
+            self._notify(user)
+
+    def _notify(self, user):
+        """Report updated entries in batches (one on_result call per interval)"""
+        with self._lock:
+            self._unreported.append(user)
+            if self._notify_timer is not None:
+                return
+            self._notify_timer = threading.Timer(self.notify_interval, self._flush_results)
+            self._notify_timer.daemon = True
+            self._notify_timer.start()
+
+    def _flush_results(self):
+        with self._lock:
+            users, self._unreported = self._unreported, []
+            self._notify_timer = None
+        if users:
+            self.on_result(users)
+
+    def submit(self, user):
+        """
+        Classify a single user's photo in the background.
+
+        Runs on its own small pool, independently of (and concurrently
+        with) full runs started with start().
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='classification-submit')
+            self.submitted['queued'] += 1
+        future = self._executor.submit(self._classify_with_retry, user['blobUrl'])
+        future.add_done_callback(lambda f: self._finish_submitted(user, f))
+        return future
+
+    def _finish_submitted(self, user, future):
+        try:
+            self._store_result(user, future.result())
+            outcome = 'completed'
+        except Exception as e:
+            outcome = 'failed'
+            with self._lock:
+                self.last_error = f"{user.get('userPrincipalName')}: {e}"
+        with self._lock:
+            self.submitted['queued'] -= 1
+            self.submitted[outcome] += 1
+
+    def _classify_with_retry(self, image_url):
+        """Classify one image, retrying transient failures with exponential backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.classifier.post('/api/classify/url', key=image_url,
+                                                json={'image_url': image_url})
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    result = response.json()
+                    if not result.get('success'):
+                        raise ValueError(result.get('error', 'classification failed'))
+                    return result
+                error = requests.HTTPError(f"HTTP {response.status_code}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.backoff_seconds * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay / 2))
+        raise error
+
+    def status(self):
+        """Return progress and throughput of the current or last run."""
+        with self._lock:
+            done = self.completed + self.failed
+            end = self.finished_at or time.time()
+            elapsed = (end - self.started_at) if self.started_at else 0.0
+            return {
+                'state': self.state,
+                'total': self.total,
+                'completed': self.completed,
+                'failed': self.failed,
+                'remaining': self.total - done,
+                'elapsed_seconds': round(elapsed, 2),
+                'images_per_second': round(done / elapsed, 2) if elapsed > 0 else 0.0,
+                'workers': self.max_workers,
+                'submitted': dict(self.submitted),
+                'last_error': self.last_error
+            }
@@ -4,26 +4,102 @@ Provides image classification endpoint for profile pictures.
 """
 import os
 import io
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from PIL import Image
 import tensorflow as tf
 from tensorflow import keras
+from model_registry import current_model_path
+from request_log import install_request_logging, stage, set_cache_outcome, record_stage
+from model_cascade import Cascade, load_cascade_config
+from runtime_tuning import MicroBatcher, tune_at_startup
+from image_decode import DecodeBusy, decode_budget, decode_resized, decode_stats
+from profiler import install_profiler
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for cross-origin requests
 
+# One JSON line per request when REQUEST_LOG_PATH is set (see request_log.py)
+install_request_logging(app, 'classifier')
+
+# Admin-only sampling profiler when PROFILER_ADMIN_TOKEN is set (see profiler.py)
+install_profiler(app, 'classifier')
+
+# Largest batch accepted by /api/classify/tensor
+MAX_TENSOR_BATCH = int(os.getenv('MAX_TENSOR_BATCH', '64'))
+
 # Global variable to hold the model
 model = None
+# Fast first stage in front of `model` when CASCADE_MODE=on (see model_cascade.py)
+cascade = None
 CLASS_LABELS = ['animal', 'avatar', 'human']
+# Tuned thread pools / batch size when RUNTIME_AUTOTUNE=on (see runtime_tuning.py)
+runtime_config = None
+micro_batcher = None
+
+
+class PredictionCache:
+    """
+    LRU cache of /api/classify/url results keyed by image URL.
+
+    The web app routes each image URL to the same replica (consistent
+    hashing in classifier_pool.py), so repeats are answered here without
+    downloading the image or running the model again.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+prediction_cache = PredictionCache(
+    max_entries=int(os.getenv('PREDICTION_CACHE_SIZE', '1024')),
+    ttl_seconds=float(os.getenv('PREDICTION_CACHE_TTL', '3600'))
+)
 
 def load_model():
     """Load the pre-trained CNN model."""
     global model
     
     # Try to load the model from different possible paths
-    model_paths = [
+    # (MODEL_PATH, if set, takes precedence - e.g. a distilled student model -
+    # followed by the current version in models/registry.json)
+    model_paths = [os.getenv('MODEL_PATH')] if os.getenv('MODEL_PATH') else []
+    if current_model_path():
+        model_paths.append(current_model_path())
+    model_paths += [
         'models/resnet50_profilepic_classifier.keras',  # ResNet50 model
         'models/profile_classifier.keras',
         'models/profile_classifier.h5',
@@ -38,11 +114,14 @@ def load_model():
     for model_path in model_paths:
         if os.path.exists(model_path):
             try:
+                configure_runtime(model_path)
                 print(f"Loading model from: {model_path}")
                 model = keras.models.load_model(model_path)
                 print(f"✓ Model loaded successfully!")
                 print(f"  Input shape: {model.input_shape}")
                 print(f"  Output shape: {model.output_shape}")
+                load_cascade()
+                start_micro_batching()
                 return True
             except Exception as e:
                 print(f"Error loading model from {model_path}: {e}")
@@ -52,6 +131,197 @@ def load_model():
     return False
 
 
+def configure_runtime(model_path):
+    """
+    Size TensorFlow's thread pools from the stored (or a fresh) calibration.
+    
+    Enabled with RUNTIME_AUTOTUNE=on; must run before the model is loaded.
+    The first boot on a host benchmarks candidate settings against
+    RUNTIME_LATENCY_TARGET_MS and stores the result in
+    models/runtime_tuning.json for later boots.
+    """
+    global runtime_config
+    if os.getenv('RUNTIME_AUTOTUNE', 'off') != 'on' or runtime_config is not None:
+        return
+    try:
+        config, source = tune_at_startup(
+            model_path, float(os.getenv('RUNTIME_LATENCY_TARGET_MS', '200')))
+    except RuntimeError as e:
+        print(f"WARNING: Runtime tuning skipped: {e}")
+        return
+    runtime_config = {key: config[key] for key in (
+        'intra_op_threads', 'inter_op_threads', 'batch_size', 'p95_ms',
+        'images_per_second', 'latency_target_ms', 'tuned_at')}
+    runtime_config['source'] = source
+    print(f"✓ Runtime tuning ({source}): intra={config['intra_op_threads']} "
+          f"inter={config['inter_op_threads']} batch={config['batch_size']}")
+
+
+def start_micro_batching():
+    """
+    Group concurrent requests into batches of the tuned size.
+    
+    A worker only sees as many concurrent requests as it has threads
+    (RUNTIME_SERVER_THREADS, i.e. gunicorn --threads), so batches are capped
+    at that; a sync worker (1 thread) never batches, because every request
+    would wait RUNTIME_BATCH_WAIT_MS for company that cannot arrive.
+    """
+    global micro_batcher
+    if runtime_config is None:
+        return
+    server_threads = int(os.getenv('RUNTIME_SERVER_THREADS', '1'))
+    max_batch = min(runtime_config['batch_size'], server_threads)
+    if max_batch <= 1:
+        if runtime_config['batch_size'] > 1:
+            print(f"Micro-batching off: tuned batch size {runtime_config['batch_size']} needs "
+                  f"a threaded server (RUNTIME_SERVER_THREADS={server_threads})")
+        return
+    micro_batcher = MicroBatcher(lambda batch: list(zip(*predict_batch(batch))),
+                                 max_batch,
+                                 float(os.getenv('RUNTIME_BATCH_WAIT_MS', '5')))
+
+
+def runtime_info():
+    """Thread pool and batching configuration, for /api/health."""
+    if runtime_config is None:
+        return {
+            'source': 'tensorflow defaults',
+            'intra_op_threads': tf.config.threading.get_intra_op_parallelism_threads(),
+            'inter_op_threads': tf.config.threading.get_inter_op_parallelism_threads(),
+            'batch_size': 1
+        }
+    return {**runtime_config,
+            'micro_batching': micro_batcher.stats() if micro_batcher is not None else None}
+
+
+def load_cascade():
+    """
+    Put the calibrated fast model in front of the full model.
+    
+    Enabled with CASCADE_MODE=on. The fast model and threshold come from
+    models/cascade.json (python model_cascade.py calibrate), overridable with
+    CASCADE_FAST_MODEL and CASCADE_THRESHOLD.
+    """
+    global cascade
+    if os.getenv('CASCADE_MODE', 'off') != 'on':
+        return False
+    config = load_cascade_config() or {}
+    fast_path = os.getenv('CASCADE_FAST_MODEL') or config.get('fast_model')
+    threshold = os.getenv('CASCADE_THRESHOLD') or config.get('threshold')
+    if not fast_path or threshold is None or not os.path.exists(fast_path):
+        print("WARNING: CASCADE_MODE=on but no calibrated fast model found; serving the full model only.")
+        return False
+    print(f"Loading cascade fast model from: {fast_path} (threshold {float(threshold):.2f})")
+    cascade = Cascade(keras.models.load_model(fast_path), model, float(threshold),
+                      expected_full_ms=config.get('full_ms'))
+    return True
+
+
+def predict(img_array):
+    """
+    Run the model (or the cascade) on a preprocessed image.
+    
+    Returns:
+        (class probabilities, stage that answered: 'fast' or 'full')
+    """
+    if micro_batcher is not None:
+        with stage('predict'):
+            return micro_batcher.submit(img_array[0])
+    if cascade is not None:
+        return cascade.predict(img_array, record_stage)
+    with stage('predict'):
+        predictions = model.predict(img_array, verbose=0)
+    return predictions[0], 'full'
+
+
+def predict_batch(batch):
+    """
+    Run the model (or the cascade) on a batch of preprocessed images.
+    
+    Returns:
+        (class probabilities [N, classes], stage that answered each image)
+    """
+    if cascade is not None:
+        return cascade.predict_batch(batch, record_stage)
+    with stage('predict'):
+        predictions = model.predict_on_batch(batch)
+    return np.asarray(predictions), ['full'] * len(batch)
+
+
+def format_prediction(probabilities, answered_by):
+    """Response body for one image's class probabilities."""
+    predicted_class_idx = np.argmax(probabilities)
+    return {
+        'success': True,
+        'predicted_class': CLASS_LABELS[predicted_class_idx],
+        'confidence': float(probabilities[predicted_class_idx]),
+        'probabilities': {
+            'animal': float(probabilities[0]),
+            'avatar': float(probabilities[1]),
+            'human': float(probabilities[2])
+        },
+        'stage': answered_by,
+        'mock': False
+    }
+
+
+def model_input_shape():
+    """(height, width, channels) the served model expects."""
+    if model is not None:
+        return tuple(model.input_shape[1:])
+    return (128, 128, 3)
+
+
+def parse_tensor(body, shape_header=None):
+    """
+    Wrap an uploaded uint8 tensor without copying it.
+    
+    Accepts a .npy file (recognized by the NumPy magic bytes) or a raw
+    buffer whose shape is given by the X-Tensor-Shape header, e.g.
+    "128,128,3" for one image or "8,128,128,3" for a batch.
+    
+    Returns:
+        (uint8 array of shape (N, H, W, C), whether a batch was sent)
+    
+    Raises:
+        ValueError: malformed tensor or shape not matching the model input
+    """
+    offset = 0
+    if body[:6] == b'\x93NUMPY':
+        stream = io.BytesIO(body)
+        version = np.lib.format.read_magic(stream)
+        read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                       else np.lib.format.read_array_header_2_0)
+        shape, fortran_order, dtype = read_header(stream)
+        if dtype != np.uint8 or fortran_order:
+            raise ValueError(f"Expected a C-ordered uint8 array, got {dtype}"
+                             f"{' (Fortran order)' if fortran_order else ''}")
+        offset = stream.tell()
+    elif shape_header:
+        try:
+            shape = tuple(int(dim) for dim in shape_header.split(','))
+        except ValueError:
+            raise ValueError(f"Invalid X-Tensor-Shape header: {shape_header!r}")
+    else:
+        raise ValueError('Send a .npy file, or raw uint8 pixels with an X-Tensor-Shape header.')
+    
+    expected_shape = model_input_shape()
+    if len(shape) not in (3, 4) or tuple(shape[-3:]) != expected_shape or min(shape) < 1:
+        raise ValueError(f"Tensor shape {shape} does not match the model input "
+                         f"{expected_shape} (or a batch of them)")
+    count = int(np.prod(shape))
+    if len(body) - offset != count:
+        raise ValueError(f"Tensor of shape {shape} needs {count} bytes, got {len(body) - offset}")
+    
+    tensor = np.frombuffer(body, dtype=np.uint8, count=count, offset=offset).reshape(shape)
+    batched = tensor.ndim == 4
+    if not batched:
+        tensor = tensor[np.newaxis]
+    if len(tensor) > MAX_TENSOR_BATCH:
+        raise ValueError(f"Batch of {len(tensor)} images exceeds the limit of {MAX_TENSOR_BATCH}")
+    return tensor, batched
+
+
 def preprocess_image(image_file):
     """
     Preprocess the image for the CNN model.
@@ -63,30 +333,26 @@ def preprocess_image(image_file):
         numpy array ready for model prediction
     """
     try:
-        # Open image
-        if isinstance(image_file, bytes):
-            img = Image.open(io.BytesIO(image_file))
-        else:
-            img = Image.open(image_file)
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+        source = io.BytesIO(image_file) if isinstance(image_file, bytes) else image_file
         
         # Resize to model input size (adjust based on your model)
         # Common sizes: 224x224, 128x128, 64x64
         target_size = (128, 128)  # Adjust to match your model's input
-        img = img.resize(target_size, Image.LANCZOS)
         
-        # Convert to numpy array and normalize
-        img_array = np.array(img, dtype=np.float32)
-        img_array = img_array / 255.0  # Normalize to [0, 1]
+        # Decode to RGB within the pixel and decode-memory budgets
+        # (see image_decode.py)
+        img_array = decode_resized(source, target_size)
+        
+        # Convert to float and normalize
+        img_array = img_array.astype(np.float32) / 255.0  # Normalize to [0, 1]
         
         # Add batch dimension
         img_array = np.expand_dims(img_array, axis=0)
         
         return img_array
     
+    except DecodeBusy:
+        raise
     except Exception as e:
         raise ValueError(f"Error preprocessing image: {str(e)}")
 
@@ -122,6 +388,7 @@ def index():
         'model_loaded': model is not None,
         'endpoints': {
             'classify': '/api/classify - POST multipart/form-data with "image" field',
+            'classify_tensor': '/api/classify/tensor - POST uint8 pixels (.npy or raw + X-Tensor-Shape)',
             'health': '/api/health - GET health check'
         }
     })
@@ -133,7 +400,12 @@ def health():
     return jsonify({
         'status': 'healthy',
         'model_loaded': model is not None,
-        'classes': CLASS_LABELS
+        'classes': CLASS_LABELS,
+        'prediction_cache': prediction_cache.stats(),
+        'runtime': runtime_info(),
+        'decode': decode_stats.snapshot(decode_budget),
+        'cascade': ({'threshold': cascade.threshold, **cascade.stats.snapshot()}
+                    if cascade is not None else None)
     })
 
 
@@ -175,26 +447,13 @@ def classify_image():
             }), 400
         
         # Preprocess the image
-        img_array = preprocess_image(image_file)
+        with stage('preprocess'):
+            img_array = preprocess_image(image_file)
         
         # Make prediction
         if model is not None:
-            # Use actual model
-            predictions = model.predict(img_array, verbose=0)
-            predicted_class_idx = np.argmax(predictions[0])
-            confidence = float(predictions[0][predicted_class_idx])
-            
-            result = {
-                'success': True,
-                'predicted_class': CLASS_LABELS[predicted_class_idx],
-                'confidence': confidence,
-                'probabilities': {
-                    'animal': float(predictions[0][0]),
-                    'avatar': float(predictions[0][1]),
-                    'human': float(predictions[0][2])
-                },
-                'mock': False
-            }
+            # Use actual model (or the fast/full cascade)
+            result = format_prediction(*predict(img_array))
         else:
             # Use mock prediction for testing
             result = mock_prediction(img_array)
@@ -203,6 +462,12 @@ def classify_image():
         
         return jsonify(result), 200
     
+    except DecodeBusy as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503, {'Retry-After': '5'}
+    
     except ValueError as e:
         return jsonify({
             'success': False,
@@ -237,30 +502,24 @@ def classify_image_url():
         
         image_url = data['image_url']
         
+        cached = prediction_cache.get(image_url)
+        set_cache_outcome('hit' if cached is not None else 'miss')
+        if cached is not None:
+            return jsonify({**cached, 'cached': True}), 200
+        
         # Download the image
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()
+        with stage('download'):
+            response = requests.get(image_url, timeout=10)
+            response.raise_for_status()
         
         # Preprocess the image
-        img_array = preprocess_image(response.content)
+        with stage('preprocess'):
+            img_array = preprocess_image(response.content)
         
         # Make prediction
         if model is not None:
-            predictions = model.predict(img_array, verbose=0)
-            predicted_class_idx = np.argmax(predictions[0])
-            confidence = float(predictions[0][predicted_class_idx])
-            
-            result = {
-                'success': True,
-                'predicted_class': CLASS_LABELS[predicted_class_idx],
-                'confidence': confidence,
-                'probabilities': {
-                    'animal': float(predictions[0][0]),
-                    'avatar': float(predictions[0][1]),
-                    'human': float(predictions[0][2])
-                },
-                'mock': False
-            }
+            result = format_prediction(*predict(img_array))
+            prediction_cache.put(image_url, result)
         else:
             result = mock_prediction(img_array)
             result['success'] = True
@@ -268,6 +527,12 @@ def classify_image_url():
         
         return jsonify(result), 200
     
+    except DecodeBusy as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503, {'Retry-After': '5'}
+    
     except requests.RequestException as e:
         return jsonify({
             'success': False,
@@ -281,6 +546,54 @@ def classify_image_url():
         }), 500
 
 
+@app.route('/api/classify/tensor', methods=['POST'])
+def classify_tensor():
+    """
+    Classify pre-resized pixels, skipping image decode and resize.
+    
+    Expected: a .npy file or a raw buffer (with an X-Tensor-Shape header)
+    holding uint8 RGB pixels at the model's input size, either one image
+    (H, W, 3) or a batch (N, H, W, 3).
+    
+    Returns: the /api/classify format for one image; for a batch,
+    {'success': true, 'count': N, 'predictions': [...]}
+    """
+    try:
+        with stage('decode'):
+            tensor, batched = parse_tensor(request.get_data(cache=False),
+                                           request.headers.get('X-Tensor-Shape'))
+            # The only copy: uint8 -> float32 in [0, 1] as the model expects
+            batch = np.multiply(tensor, 1 / 255.0, dtype=np.float32)
+        
+        if model is not None:
+            probabilities, stages = predict_batch(batch)
+            results = [format_prediction(p, answered_by)
+                       for p, answered_by in zip(probabilities, stages)]
+        else:
+            results = []
+            for img_array in batch:
+                result = mock_prediction(img_array)
+                result['success'] = True
+                result['warning'] = 'Using mock predictions - no model loaded'
+                results.append(result)
+        
+        if batched:
+            return jsonify({'success': True, 'count': len(results), 'predictions': results}), 200
+        return jsonify(results[0]), 200
+    
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Internal server error: {str(e)}'
+        }), 500
+
+
 if __name__ == '__main__':
     print("=" * 60)
     print("Profile Picture Classifier API")
@@ -298,6 +611,7 @@ if __name__ == '__main__':
     print("  - GET  /api/health    - Health check")
     print("  - POST /api/classify  - Classify uploaded image")
     print("  - POST /api/classify/url - Classify image from URL")
+    print("  - POST /api/classify/tensor - Classify pre-resized uint8 pixels")
     print("=" * 60)
     
     # Run the server
@@ -0,0 +1,286 @@
+"""
+Client-side load balancing across classifier API replicas.
+
+ClassifierPool spreads classifier requests over several replicas
+(CLASSIFIER_API_URLS) without an external load balancer:
+
+- Consistent hashing on the image URL: the same image goes to the same
+  replica, so that replica's prediction cache answers repeats. A hash ring
+  with virtual nodes keeps most assignments stable when replicas come and
+  go, and an owner that is already much busier than average
+  (bounded load) is skipped.
+- Otherwise (or with no key) requests go to the replica with the fewest
+  outstanding requests ('least'), or the better of two random replicas
+  ('p2c', power of two choices).
+- A background thread checks every replica's /api/health; unhealthy
+  replicas and replicas whose circuit breaker is open are skipped.
+- A request still running after the replica's latency budget (its recent
+  p95, or CLASSIFIER_HEDGE_AFTER_MS) is hedged: a second copy goes to
+  another replica and the first successful response wins. Connection
+  errors and 5xx responses fail over to the next replica.
+
+Each replica gets its own pooled client from http_clients (timeouts,
+bulkhead, circuit breaker, latency histogram).
+"""
+import bisect
+import hashlib
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from http_clients import get_client
+
+STRATEGIES = ('p2c', 'least')
+
+# Auto hedging: use a replica's p95 once it has this many samples, never
+# hedging sooner than the floor
+HEDGE_MIN_SAMPLES = 20
+HEDGE_FLOOR_MS = 50.0
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class Replica:
+    """One classifier instance and its load/health bookkeeping."""
+
+    def __init__(self, url, client):
+        self.url = url.rstrip('/')
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self.healthy = True  # until the first health check says otherwise
+        self.last_health_error = None
+        self.ewma_ms = 0.0
+        self.recent_ms = deque(maxlen=200)
+
+    def available(self):
+        return self.healthy and self.client.breaker.state != 'open'
+
+    def p95_ms(self):
+        if len(self.recent_ms) < HEDGE_MIN_SAMPLES:
+            return None
+        durations = sorted(self.recent_ms)
+        return durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+
+
+class ClassifierPool:
+    """
+    Routes classifier requests across replicas.
+
+    Args:
+        urls: replica base URLs
+        strategy: 'p2c' (power of two choices) or 'least' (least outstanding)
+        hash_affinity: route requests with a key (image URL) by consistent hashing
+        hedge_after_ms: fixed hedging budget; None = each replica's recent p95,
+            0 = never hedge
+        health_interval: seconds between /api/health checks
+        load_factor: hashed owner is skipped once it has more than this
+            multiple of the average outstanding requests
+    """
+
+    def __init__(self, urls, strategy='p2c', hash_affinity=True, hedge_after_ms=None,
+                 health_interval=10.0, virtual_nodes=64, load_factor=1.25):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy!r}; use one of {STRATEGIES}")
+        urls = [url for url in urls if url]
+        if not urls:
+            raise ValueError("At least one classifier URL is required")
+        self.replicas = [
+            Replica(url, get_client('classifier' if len(urls) == 1 else f"classifier[{i}]",
+                                    kind='classifier'))
+            for i, url in enumerate(urls)
+        ]
+        self.strategy = strategy
+        self.hash_affinity = hash_affinity
+        self.hedge_after_ms = hedge_after_ms
+        self.health_interval = health_interval
+        self.load_factor = load_factor
+        self._ring = sorted((_hash(f"{replica.url}#{v}"), i)
+                            for i, replica in enumerate(self.replicas)
+                            for v in range(virtual_nodes))
+        self._ring_keys = [h for h, _ in self._ring]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(8, 4 * len(self.replicas)),
+                                            thread_name_prefix='classifier-pool')
+        self._health_thread = None
+        self._health_session = requests.Session()
+        self.counters = {'requests': 0, 'hedges': 0, 'hedge_wins': 0, 'failovers': 0,
+                         'affinity_hits': 0}
+
+    # -- routing -----------------------------------------------------------
+
+    def _owner(self, key, candidates):
+        """First replica clockwise from the key's position on the ring"""
+        allowed = {id(replica) for replica in candidates}
+        start = bisect.bisect(self._ring_keys, _hash(key))
+        for offset in range(len(self._ring)):
+            replica = self.replicas[self._ring[(start + offset) % len(self._ring)][1]]
+            if id(replica) in allowed:
+                return replica
+        return None
+
+    def pick(self, key=None, exclude=()):
+        """Choose a replica for a request (None if every replica is excluded)"""
+        remaining = [r for r in self.replicas if r not in exclude]
+        candidates = [r for r in remaining if r.available()] or remaining
+        if not candidates:
+            return None
+
+        if key is not None and self.hash_affinity:
+            owner = self._owner(key, candidates)
+            total = sum(r.outstanding for r in candidates)
+            if owner.outstanding < math.ceil(self.load_factor * (total + 1) / len(candidates)):
+                self._count('affinity_hits')
+                return owner
+
+        load = lambda r: (r.outstanding, r.ewma_ms)
+        if self.strategy == 'least' or len(candidates) == 1:
+            return min(candidates, key=load)
+        first, second = random.sample(candidates, 2)
+        return first if load(first) <= load(second) else second
+
+    def hedge_budget_ms(self, replica):
+        if self.hedge_after_ms is not None:
+            return self.hedge_after_ms or None
+        p95 = replica.p95_ms()
+        return max(p95, HEDGE_FLOOR_MS) if p95 is not None else None
+
+    # -- requests ----------------------------------------------------------
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _send(self, replica, method, path, kwargs):
+        with self._lock:
+            replica.outstanding += 1
+            replica.requests += 1
+        started = time.perf_counter()
+        try:
+            return replica.client.request(method, f"{replica.url}{path}", **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                replica.outstanding -= 1
+                replica.recent_ms.append(elapsed_ms)
+                replica.ewma_ms = 0.8 * replica.ewma_ms + 0.2 * elapsed_ms if replica.ewma_ms \
+                    else elapsed_ms
+
+    def request(self, method, path, key=None, **kwargs):
+        """
+        Send a request to the pool; returns the first successful response
+
+        Raises:
+            requests.RequestException: every replica tried failed
+        """
+        self._ensure_health_checks()
+        self._count('requests')
+        tried, pending = [], {}
+        last_error = last_response = None
+        hedged = False
+
+        def launch(replica, reason):
+            tried.append(replica)
+            pending[self._executor.submit(self._send, replica, method, path, kwargs)] = reason
+
+        launch(self.pick(key), 'primary')
+        while pending:
+            timeout = None
+            if not hedged and len(tried) < len(self.replicas):
+                budget = self.hedge_budget_ms(tried[0])
+                timeout = budget / 1000 if budget else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Over the latency budget: race a copy on another replica
+                hedged = True
+                alternative = self.pick(key, exclude=tried)
+                if alternative is not None:
+                    self._count('hedges')
+                    launch(alternative, 'hedge')
+                continue
+
+            for future in done:
+                reason = pending.pop(future)
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    last_error = e
+                    continue
+                if response.status_code < 500:
+                    if reason == 'hedge':
+                        self._count('hedge_wins')
+                    return response
+                last_response = response
+
+            if not pending:
+                alternative = self.pick(key, exclude=tried)
+                if alternative is not None:
+                    self._count('failovers')
+                    launch(alternative, 'failover')
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    def get(self, path, key=None, **kwargs):
+        return self.request('GET', path, key=key, **kwargs)
+
+    def post(self, path, key=None, **kwargs):
+        return self.request('POST', path, key=key, **kwargs)
+
+    # -- health ------------------------------------------------------------
+
+    def check_health(self):
+        """Probe every replica's /api/health once"""
+        for replica in self.replicas:
+            try:
+                response = self._health_session.get(f"{replica.url}/api/health", timeout=2)
+                replica.healthy = (response.status_code == 200
+                                   and response.json().get('status') == 'healthy')
+                replica.last_health_error = (None if replica.healthy
+                                             else f"HTTP {response.status_code}")
+            except (requests.RequestException, ValueError) as e:
+                replica.healthy = False
+                replica.last_health_error = str(e)
+
+    def _health_loop(self):
+        while True:
+            self.check_health()
+            time.sleep(self.health_interval)
+
+    def _ensure_health_checks(self):
+        if self._health_thread is not None or len(self.replicas) == 1:
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(
+                    target=self._health_loop, name='classifier-health', daemon=True)
+                self._health_thread.start()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            'strategy': self.strategy,
+            'hash_affinity': self.hash_affinity,
+            'hedge_after_ms': self.hedge_after_ms,
+            **counters,
+            'replicas': [{
+                'url': r.url,
+                'healthy': r.healthy,
+                'circuit': r.client.breaker.state,
+                'outstanding': r.outstanding,
+                'requests': r.requests,
+                'ewma_ms': round(r.ewma_ms, 1),
+                'p95_ms': round(r.p95_ms(), 1) if r.p95_ms() is not None else None,
+                'hedge_budget_ms': self.hedge_budget_ms(r),
+                'last_health_error': r.last_health_error,
+            } for r in self.replicas],
+        }
@@ -0,0 +1,230 @@
+"""
+Local classifier replicas for exercising client-side load balancing
+
+Runs several classifier_api.py processes on consecutive ports, standing in
+for the replicas behind CLASSIFIER_API_URLS, and benchmarks the routing
+strategies of classifier_pool.py against them. One replica can be made
+slow for part of its requests to model a noisy neighbour.
+
+Usage:
+    python classifier_replicas.py start --replicas 3            # run until Ctrl-C
+    python classifier_replicas.py bench --replicas 3 --requests 600 --concurrency 8
+    python classifier_replicas.py bench --slow-replica-ms 300 --slow-fraction 0.3
+
+The bench downloads images from local_standins.py, so no network access is
+needed. Set MODEL_PATH to pick the model the replicas load (a small student
+model keeps the bench quick).
+"""
+import argparse
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+
+from classifier_pool import ClassifierPool
+from local_standins import StandinServer
+
+BASE_DIR = Path(__file__).parent
+
+# (label, strategy, hash_affinity, hedge_after_ms)
+BENCH_CONFIGS = [
+    ('least', 'least', False, 0),
+    ('p2c', 'p2c', False, 0),
+    ('p2c+hash', 'p2c', True, 0),
+    ('p2c+hash+hedge', 'p2c', True, None),
+]
+
+
+def serve(port, delay_ms=0.0, delay_fraction=0.0):
+    """Run one classifier replica in this process"""
+    import logging
+
+    import classifier_api
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    if delay_ms and delay_fraction:
+        @classifier_api.app.before_request
+        def _injected_delay():
+            if random.random() < delay_fraction:
+                time.sleep(delay_ms / 1000)
+
+    classifier_api.load_model()
+    classifier_api.app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def start_replicas(count, base_port, slow_ms=0.0, slow_fraction=0.0):
+    """Start `count` replica processes; the last one is slow if slow_ms is set"""
+    processes, urls = [], []
+    for i in range(count):
+        port = base_port + i
+        command = [sys.executable, str(Path(__file__).resolve()), 'serve', '--port', str(port)]
+        if slow_ms and i == count - 1:
+            command += ['--delay-ms', str(slow_ms), '--delay-fraction', str(slow_fraction)]
+        processes.append(subprocess.Popen(command, cwd=BASE_DIR, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL))
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+
+def wait_until_healthy(urls, timeout=300):
+    deadline = time.time() + timeout
+    pending = list(urls)
+    while pending and time.time() < deadline:
+        for url in list(pending):
+            try:
+                if requests.get(f"{url}/api/health", timeout=1).status_code == 200:
+                    pending.remove(url)
+            except requests.RequestException:
+                pass
+        time.sleep(0.5)
+    if pending:
+        raise RuntimeError(f"Replicas did not come up: {pending}")
+
+
+def stop_replicas(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def cache_stats(urls):
+    stats = []
+    for url in urls:
+        health = requests.get(f"{url}/api/health", timeout=5).json()
+        stats.append(health.get('prediction_cache', {'hits': 0, 'misses': 0}))
+    return stats
+
+
+def image_workload(standin, requests_count, distinct, seed=0):
+    """Image URLs with repeats (a few popular images, a long tail)"""
+    blobs = [user['_blob'] for user in standin.users if user['_blob']][:distinct]
+    if not blobs:
+        blobs = [f"generated_{i}.jpg" for i in range(distinct)]
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(blobs))]
+    chosen = rng.choices(blobs, weights=weights, k=requests_count)
+    return [f"{standin.base_url}/blob/profile-pictures/{blob}" for blob in chosen]
+
+
+def run_config(urls, workload, label, strategy, hash_affinity, hedge_after_ms, concurrency):
+    pool = ClassifierPool(urls, strategy=strategy, hash_affinity=hash_affinity,
+                          hedge_after_ms=hedge_after_ms, health_interval=2.0)
+    # Distinct URLs per configuration so replica caches start cold each time
+    images = [f"{url}?run={label}" for url in workload]
+    before = cache_stats(urls)
+
+    def classify(image_url):
+        started = time.perf_counter()
+        response = pool.post('/api/classify/url', key=image_url, json={'image_url': image_url})
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(classify, images))
+    elapsed = time.perf_counter() - started
+
+    after = cache_stats(urls)
+    hits = sum(a['hits'] - b['hits'] for a, b in zip(after, before))
+    misses = sum(a['misses'] - b['misses'] for a, b in zip(after, before))
+    latencies = np.array([ms for ms, _ in results])
+    stats = pool.stats()
+    return {
+        'config': label,
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status != 200),
+        'throughput': len(results) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'cache_hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+        'per_replica': [r['requests'] for r in stats['replicas']],
+        'hedges': stats['hedges'],
+        'hedge_wins': stats['hedge_wins'],
+    }
+
+
+def print_report(rows):
+    print(f"\n{'config':18s} {'req/s':>7s} {'p50':>8s} {'p95':>8s} {'p99':>8s} "
+          f"{'cache hit':>9s} {'hedges':>7s} {'errors':>6s}  per replica")
+    for row in rows:
+        print(f"{row['config']:18s} {row['throughput']:7.1f} {row['p50_ms']:7.1f}ms "
+              f"{row['p95_ms']:7.1f}ms {row['p99_ms']:7.1f}ms {row['cache_hit_rate']:9.1%} "
+              f"{row['hedges']:>4d}/{row['hedge_wins']:<2d} {row['errors']:>6d}  "
+              f"{row['per_replica']}")
+
+
+def bench(args):
+    standin = StandinServer().start()
+    processes, urls = start_replicas(args.replicas, args.base_port,
+                                     args.slow_replica_ms, args.slow_fraction)
+    try:
+        print(f"Starting {args.replicas} replicas: {', '.join(urls)}")
+        wait_until_healthy(urls)
+        workload = image_workload(standin, args.requests, args.distinct_images)
+        # Warm every replica's model before timing anything
+        for url in urls:
+            requests.post(f"{url}/api/classify/url", json={'image_url': workload[0] + '?warmup'},
+                          timeout=60)
+        rows = []
+        for label, strategy, hash_affinity, hedge_after_ms in BENCH_CONFIGS:
+            print(f"  running {label} ...")
+            rows.append(run_config(urls, workload, label, strategy, hash_affinity,
+                                   hedge_after_ms, args.concurrency))
+        print_report(rows)
+    finally:
+        stop_replicas(processes)
+        standin.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local classifier replicas and load balancing bench")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = sub.add_parser('serve', help="Run one replica (used by start/bench)")
+    serve_parser.add_argument('--port', type=int, required=True)
+    serve_parser.add_argument('--delay-ms', type=float, default=0.0)
+    serve_parser.add_argument('--delay-fraction', type=float, default=0.0)
+
+    for name in ('start', 'bench'):
+        p = sub.add_parser(name)
+        p.add_argument('--replicas', type=int, default=3)
+        p.add_argument('--base-port', type=int, default=5101)
+        p.add_argument('--slow-replica-ms', type=float, default=0.0,
+                       help="Delay injected into part of the last replica's requests")
+        p.add_argument('--slow-fraction', type=float, default=0.2)
+    bench_parser = sub.choices['bench']
+    bench_parser.add_argument('--requests', type=int, default=600)
+    bench_parser.add_argument('--concurrency', type=int, default=8)
+    bench_parser.add_argument('--distinct-images', type=int, default=100)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.port, args.delay_ms, args.delay_fraction)
+    elif args.command == 'start':
+        processes, urls = start_replicas(args.replicas, args.base_port,
+                                         args.slow_replica_ms, args.slow_fraction)
+        try:
+            wait_until_healthy(urls)
+            print(f"CLASSIFIER_API_URLS={','.join(urls)}")
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_replicas(processes)
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
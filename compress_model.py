@@ -0,0 +1,271 @@
+"""
+Post-training compression for the served Keras models
+
+Applies magnitude pruning at several sparsity levels and weight clustering
+to a trained model, fine-tunes each variant briefly on the training split of
+the packed dataset while keeping the sparsity mask / cluster structure, and
+measures every variant on the held-out split:
+
+    variant | sparsity | accuracy | p50/p99 latency | size | gzipped size
+
+Pruned and clustered weights only shrink the artifact once it is compressed
+(zeros and repeated centroids compress well), so both sizes are reported.
+The smallest variant within --max-accuracy-drop of the baseline is
+registered in models/registry.json.
+
+Usage:
+    python compress_model.py --model models/profile_classifier.keras
+    python compress_model.py --model m.keras --sparsities 0.5 0.8 --clusters 16 --no-register
+"""
+import argparse
+import gzip
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from evaluate_model import evaluate, measure_latency
+from model_registry import register_model
+from packed_dataset import PackedDataset, default_dataset_dir
+
+BASE_DIR = Path(__file__).parent
+OUTPUT_DIR = BASE_DIR / "models" / "compressed"
+
+# Layers with fewer weights than this are left alone (biases, tiny heads)
+MIN_WEIGHTS_TO_COMPRESS = 1024
+
+
+def compressible_layers(model):
+    """Conv/Dense layers (including those inside nested models) worth compressing"""
+    for layer in model.layers:
+        if hasattr(layer, 'layers'):
+            yield from compressible_layers(layer)
+        elif getattr(layer, 'kernel', None) is not None and \
+                int(np.prod(layer.kernel.shape)) >= MIN_WEIGHTS_TO_COMPRESS:
+            yield layer
+
+
+def apply_pruning(model, sparsity):
+    """
+    Zero out the smallest-magnitude `sparsity` fraction of each layer's kernel
+
+    Returns:
+        list of (layer, mask) pairs used to keep pruned weights at zero
+    """
+    masks = []
+    for layer in compressible_layers(model):
+        kernel = layer.kernel.numpy()
+        threshold = np.quantile(np.abs(kernel), sparsity)
+        mask = (np.abs(kernel) > threshold).astype(kernel.dtype)
+        layer.kernel.assign(kernel * mask)
+        masks.append((layer, mask))
+    return masks
+
+
+def apply_clustering(model, n_clusters, iterations=10):
+    """
+    Replace each kernel's weights with `n_clusters` shared values (1-D k-means)
+
+    Centroids start linearly spaced between the kernel's min and max.
+
+    Returns:
+        list of (layer, assignments) pairs used to keep the cluster structure
+    """
+    clusters = []
+    for layer in compressible_layers(model):
+        kernel = layer.kernel.numpy()
+        flat = kernel.ravel()
+        centroids = np.linspace(flat.min(), flat.max(), n_clusters)
+        for _ in range(iterations):
+            boundaries = (centroids[1:] + centroids[:-1]) / 2
+            assignments = np.searchsorted(boundaries, flat)
+            sums = np.bincount(assignments, weights=flat, minlength=n_clusters)
+            counts = np.bincount(assignments, minlength=n_clusters)
+            centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+            centroids.sort()
+        boundaries = (centroids[1:] + centroids[:-1]) / 2
+        assignments = np.searchsorted(boundaries, flat)
+        layer.kernel.assign(centroids[assignments].reshape(kernel.shape).astype(kernel.dtype))
+        clusters.append((layer, assignments))
+    return clusters
+
+
+class KeepPruned(keras.callbacks.Callback):
+    """Re-apply pruning masks after every fine-tuning step"""
+
+    def __init__(self, masks):
+        super().__init__()
+        self.masks = masks
+
+    def on_train_batch_end(self, batch, logs=None):
+        for layer, mask in self.masks:
+            layer.kernel.assign(layer.kernel * mask)
+
+
+class KeepClustered(keras.callbacks.Callback):
+    """After every fine-tuning step, snap weights back to their (updated) cluster means"""
+
+    def __init__(self, clusters):
+        super().__init__()
+        self.clusters = clusters
+
+    def on_train_batch_end(self, batch, logs=None):
+        for layer, assignments in self.clusters:
+            kernel = layer.kernel.numpy()
+            flat = kernel.ravel()
+            sums = np.bincount(assignments, weights=flat)
+            counts = np.maximum(np.bincount(assignments), 1)
+            layer.kernel.assign((sums / counts)[assignments].reshape(kernel.shape)
+                                .astype(kernel.dtype))
+
+
+def kernel_sparsity(model):
+    """Fraction of zero weights across all compressible kernels"""
+    zeros = total = 0
+    for layer in compressible_layers(model):
+        kernel = layer.kernel.numpy()
+        zeros += int(np.sum(kernel == 0))
+        total += kernel.size
+    return zeros / total if total else 0.0
+
+
+def gzipped_size(path):
+    """Size in bytes of the artifact after gzip compression"""
+    with open(path, 'rb') as f:
+        return len(gzip.compress(f.read(), compresslevel=9))
+
+
+def training_batches(dataset, rows, input_size, batch_size):
+    """tf.data pipeline over packed dataset rows, resized to the model input"""
+    num_classes = len(dataset.class_names)
+
+    def batches():
+        for images, labels in dataset.iter_batches(rows, batch_size, shuffle=True):
+            yield images, labels
+
+    ds = tf.data.Dataset.from_generator(batches, output_signature=(
+        tf.TensorSpec(shape=(None, dataset.size, dataset.size, 3), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int64),
+    ))
+
+    def prepare(images, labels):
+        images = tf.cast(images, tf.float32) / 255.0
+        if input_size != (dataset.size, dataset.size):
+            images = tf.image.resize(images, input_size)
+        return images, tf.one_hot(labels, num_classes)
+
+    return ds.map(prepare).prefetch(tf.data.AUTOTUNE)
+
+
+def measure_variant(name, model, path, dataset, val_rows, runs):
+    """Save a variant (without optimizer state) and collect its accuracy, latency and size"""
+    serving_model = keras.models.clone_model(model)
+    serving_model.set_weights(model.get_weights())
+    serving_model.save(path)
+    result = {'variant': name, 'path': str(path), 'sparsity': round(kernel_sparsity(model), 3)}
+    result.update(evaluate(model, dataset, val_rows))
+    result.update(measure_latency(model, runs))
+    result['size_mb'] = round(os.path.getsize(path) / 1e6, 2)
+    result['gzip_mb'] = round(gzipped_size(path) / 1e6, 2)
+    return result
+
+
+def compress(model_path, dataset, sparsities, cluster_counts, fine_tune_epochs=2,
+             learning_rate=1e-4, batch_size=16, runs=50):
+    """
+    Build, fine-tune and measure every compressed variant
+
+    Returns:
+        list of result dicts; the first entry is the uncompressed baseline
+    """
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    stem = Path(model_path).stem
+    train_rows, val_rows = dataset.split()
+
+    baseline = keras.models.load_model(model_path)
+    input_size = tuple(baseline.input_shape[1:3])
+    baseline_path = OUTPUT_DIR / f"{stem}_baseline.keras"
+    results = [measure_variant('baseline', baseline, baseline_path, dataset, val_rows, runs)]
+
+    variants = [(f"prune_{int(s * 100)}", 'prune', s) for s in sparsities]
+    variants += [(f"cluster_{k}", 'cluster', k) for k in cluster_counts]
+
+    for name, method, amount in variants:
+        print(f"\nBuilding variant: {name}")
+        model = keras.models.load_model(model_path)
+        if method == 'prune':
+            keep = KeepPruned(apply_pruning(model, amount))
+        else:
+            keep = KeepClustered(apply_clustering(model, amount))
+
+        if fine_tune_epochs > 0:
+            model.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+                          loss='categorical_crossentropy', metrics=['accuracy'])
+            model.fit(training_batches(dataset, train_rows, input_size, batch_size),
+                      epochs=fine_tune_epochs, callbacks=[keep], verbose=2)
+
+        path = OUTPUT_DIR / f"{stem}_{name}.keras"
+        results.append(measure_variant(name, model, path, dataset, val_rows, runs))
+    return results
+
+
+def select_best(results, max_accuracy_drop):
+    """Smallest compressed variant whose accuracy is within the allowed drop"""
+    baseline_accuracy = results[0]['accuracy'] or 0.0
+    candidates = [r for r in results[1:]
+                  if (r['accuracy'] or 0.0) >= baseline_accuracy - max_accuracy_drop]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda r: (r['gzip_mb'], r['p50_ms']))
+
+
+def print_table(results):
+    print(f"\n{'variant':14s} {'sparsity':>8s} {'acc':>6s} {'p50 ms':>8s} {'p99 ms':>8s} "
+          f"{'size MB':>8s} {'gzip MB':>8s}")
+    print("-" * 68)
+    for r in results:
+        print(f"{r['variant']:14s} {r['sparsity']:8.3f} {r['accuracy'] or 0:6.3f} "
+              f"{r['p50_ms']:8.2f} {r['p99_ms']:8.2f} {r['size_mb']:8.2f} {r['gzip_mb']:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune / cluster a trained classifier")
+    parser.add_argument('--model', required=True, help="Trained Keras model to compress")
+    parser.add_argument('--dataset', default=None, help="Packed dataset directory")
+    parser.add_argument('--size', type=int, default=128,
+                        help="Packed resolution used to locate the default dataset")
+    parser.add_argument('--sparsities', type=float, nargs='*', default=[0.5, 0.75, 0.9])
+    parser.add_argument('--clusters', type=int, nargs='*', default=[16, 32])
+    parser.add_argument('--fine-tune-epochs', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=50, help="Latency measurement runs")
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.01)
+    parser.add_argument('--no-register', action='store_true',
+                        help="Do not register the best variant")
+    args = parser.parse_args()
+
+    dataset = PackedDataset(args.dataset or default_dataset_dir(args.size))
+    results = compress(args.model, dataset, args.sparsities, args.clusters,
+                       args.fine_tune_epochs, runs=args.runs)
+    print_table(results)
+
+    with open(OUTPUT_DIR / f"{Path(args.model).stem}_report.json", 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    best = select_best(results, args.max_accuracy_drop)
+    if best is None:
+        print(f"\nNo variant stayed within {args.max_accuracy_drop:.3f} of baseline accuracy")
+        return
+    print(f"\nBest variant: {best['variant']} ({best['path']})")
+    if not args.no_register:
+        metrics = {key: best[key] for key in
+                   ('accuracy', 'sparsity', 'p50_ms', 'p99_ms', 'size_mb', 'gzip_mb')}
+        version = register_model(best['path'], metrics,
+                                 source=f"compress_model {best['variant']} of {args.model}")
+        print(f"✓ Registered as version {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Incremental directory sync through Microsoft Graph delta queries.
+
+The first round pages through GET /users/delta once and ends with a delta
+link; every later round follows that link and receives only the users
+that were added, changed or removed since. DirectorySync keeps a local
+replica of the synced users (id -> selected properties) and the delta link
+in a state file, so a restart resumes from the stored link instead of
+enumerating the whole directory again. The replica is replayed into the
+app's mapping at start, then only the changes of each round are applied.
+
+Pages of a round are fetched on a dedicated pooled client (its own
+connection pool, concurrency limit and circuit breaker, so a large sync
+cannot starve user-facing Graph calls). A delta chain is sequential (each
+page names the next), so a fetcher thread stays at most PREFETCH_PAGES
+pages ahead of the thread applying them.
+
+Graph answers an expired or unknown delta token with 410 Gone; the round
+then restarts as a full sync and users missing from it are removed.
+
+status() reports progress of the running round (pages, users) and lag:
+how long ago the mapping last caught up with the directory.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+
+import requests
+
+from http_clients import get_client
+
+# Properties requested from Graph (and kept in the replica)
+SELECT_FIELDS = ('id', 'userPrincipalName', 'displayName', 'mail')
+
+# Pages fetched ahead of the one being applied
+PREFETCH_PAGES = 2
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(value, default):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date)"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class ResyncRequired(Exception):
+    """The stored delta token is no longer valid (HTTP 410)."""
+
+
+class DirectorySync:
+    """
+    Background Graph delta sync of directory users
+
+    Args:
+        graph_endpoint: Graph base URL (GRAPH_API_ENDPOINT)
+        token_provider: function() -> app-only access token (or None)
+        apply_changes: function(upserts, removals) applying one page of
+            changes to the app's mapping; upserts are full user dicts
+            (SELECT_FIELDS, plus 'previousUserPrincipalName' on renames),
+            removals are user dicts that left the directory
+        state_path: JSON file holding the delta link and the replica
+        interval: seconds between rounds of the background thread
+        page_size: users per page requested from Graph ($top)
+    """
+
+    def __init__(self, graph_endpoint, token_provider, apply_changes, state_path,
+                 interval=300, page_size=500, max_retries=3, client_name='graph-sync'):
+        self.graph_endpoint = graph_endpoint.rstrip('/')
+        self.token_provider = token_provider
+        self.apply_changes = apply_changes
+        self.state_path = state_path
+        self.interval = interval
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.client = get_client(client_name, kind='graph')
+
+        self.delta_link = None
+        self.users = {}  # id -> user dict (SELECT_FIELDS)
+        self._round_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.state = 'idle'
+        self.rounds = 0
+        self.full_syncs = 0
+        self.failures = 0
+        self.totals = {'pages': 0, 'upserts': 0, 'removals': 0}
+        self.current = None
+        self.last_round = None
+        self.last_success_at = None
+        self.last_error = None
+
+    def load_state(self):
+        """
+        Read the stored delta link and replica and replay the replica into
+        the mapping (no Graph calls). Returns the number of users replayed.
+        """
+        if not os.path.exists(self.state_path):
+            return 0
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading directory sync state: {e}")
+            return 0
+        self.delta_link = state.get('delta_link')
+        self.users = state.get('users', {})
+        self.last_success_at = state.get('saved_at')
+        if self.users:
+            self.apply_changes(list(self.users.values()), [])
+        return len(self.users)
+
+    def save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'delta_link': self.delta_link, 'users': self.users,
+                       'saved_at': self.last_success_at}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def initial_url(self):
+        query = urlencode({'$select': ','.join(SELECT_FIELDS), '$top': self.page_size}, safe='$,')
+        return f"{self.graph_endpoint}/users/delta?{query}"
+
+    def fetch_page(self, url):
+        """
+        GET one delta page, retrying throttling and transient failures
+
+        Raises:
+            ResyncRequired: the delta token expired (410)
+            requests.RequestException: the page could not be fetched
+        """
+        for attempt in range(self.max_retries + 1):
+            token = self.token_provider()
+            headers = {'Authorization': f"Bearer {token}"} if token else {}
+            delay = 2 ** attempt
+            try:
+                response = self.client.get(url, headers=headers)
+                if response.status_code == 410:
+                    raise ResyncRequired(response.text[:200])
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f"HTTP {response.status_code}")
+                delay = retry_after_seconds(response.headers.get('Retry-After'), delay)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        raise error
+
+    def _pages(self, url):
+        """Yield the pages of one delta chain, fetched ahead on another thread"""
+        pages = queue.Queue(maxsize=PREFETCH_PAGES)
+        cancelled = threading.Event()
+
+        def fetch():
+            next_url = url
+            try:
+                while next_url and not cancelled.is_set():
+                    page = self.fetch_page(next_url)
+                    next_url = page.get('@odata.nextLink')
+                    pages.put(page)
+                pages.put(None)
+            except Exception as e:
+                pages.put(e)
+
+        fetcher = threading.Thread(target=fetch, name='directory-sync-fetch', daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            cancelled.set()
+            while fetcher.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _apply_page(self, items, seen):
+        upserts, removals = [], []
+        for item in items:
+            user_id = item.get('id')
+            if not user_id:
+                continue
+            if '@removed' in item:
+                removed = self.users.pop(user_id, None)
+                if removed is not None:
+                    removals.append(removed)
+                continue
+            seen.add(user_id)
+            previous = self.users.get(user_id, {})
+            # Changed users may carry only the properties that changed
+            user = {**previous, **{key: item[key] for key in SELECT_FIELDS if key in item}}
+            if not user.get('userPrincipalName'):
+                continue
+            if user == previous:
+                continue
+            self.users[user_id] = user
+            change = dict(user)
+            old_upn = previous.get('userPrincipalName')
+            if old_upn and old_upn.lower() != user['userPrincipalName'].lower():
+                change['previousUserPrincipalName'] = old_upn
+            upserts.append(change)
+        if upserts or removals:
+            self.apply_changes(upserts, removals)
+        return len(upserts), len(removals)
+
+    def sync_once(self):
+        """
+        Run one sync round (a full sync if there is no valid delta link)
+
+        Returns:
+            summary dict of the round
+        """
+        with self._round_lock:
+            try:
+                return self._round(full=self.delta_link is None)
+            except ResyncRequired:
+                print("Directory sync: delta token expired, running a full sync")
+                self.delta_link = None
+                return self._round(full=True)
+
+    def _round(self, full):
+        started = time.time()
+        with self._lock:
+            self.state = 'syncing'
+            self.current = {'full': full, 'started_at': started, 'pages': 0,
+                            'upserts': 0, 'removals': 0}
+        seen = set()
+        delta_link = None
+        try:
+            for page in self._pages(self.delta_link or self.initial_url()):
+                upserts, removals = self._apply_page(page.get('value', []), seen)
+                delta_link = page.get('@odata.deltaLink', delta_link)
+                with self._lock:
+                    self.current['pages'] += 1
+                    self.current['upserts'] += upserts
+                    self.current['removals'] += removals
+            if delta_link is None:
+                raise ValueError("Delta chain ended without a delta link")
+            if full:
+                # Users absent from a full enumeration have left the directory
+                gone = [self.users.pop(user_id) for user_id in set(self.users) - seen]
+                if gone:
+                    self.apply_changes([], gone)
+                    with self._lock:
+                        self.current['removals'] += len(gone)
+        except ResyncRequired:
+            with self._lock:
+                self.state = 'idle'
+                self.current = None
+            raise
+        except Exception as e:
+            with self._lock:
+                self.state = 'failed'
+                self.failures += 1
+                self.last_error = str(e)
+                self.current = None
+            raise
+
+        finished = time.time()
+        with self._lock:
+            round_info = dict(self.current, finished_at=finished,
+                              duration_seconds=round(finished - started, 2))
+            self.delta_link = delta_link
+            self.last_success_at = started
+            self.rounds += 1
+            self.full_syncs += int(full)
+            for key in self.totals:
+                self.totals[key] += round_info[key]
+            self.last_round = round_info
+            self.current = None
+            self.state = 'idle'
+            self.last_error = None
+        self.save_state()
+        return round_info
+
+    def start(self):
+        """Replay the stored replica, then sync every `interval` seconds"""
+        if self._thread is not None:
+            return
+        replayed = self.load_state()
+        if replayed:
+            print(f"✓ Directory sync: replayed {replayed} users from {self.state_path}")
+        self._thread = threading.Thread(target=self._loop, name='directory-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                summary = self.sync_once()
+                print(f"✓ Directory sync: {summary['upserts']} changed, "
+                      f"{summary['removals']} removed in {summary['pages']} pages")
+            except Exception as e:
+                print(f"Directory sync failed: {e}")
+            self._stop.wait(self.interval)
+
+    def status(self):
+        """Progress of the running round and lag behind the directory"""
+        with self._lock:
+            now = time.time()
+            current = dict(self.current) if self.current else None
+            if current:
+                current['elapsed_seconds'] = round(now - current.pop('started_at'), 2)
+            return {
+                'state': self.state,
+                'users': len(self.users),
+                'has_delta_link': self.delta_link is not None,
+                'rounds': self.rounds,
+                'full_syncs': self.full_syncs,
+                'failures': self.failures,
+                'interval_seconds': self.interval,
+                # Changes made in the directory since then are not applied yet
+                'lag_seconds': round(now - self.last_success_at, 1) if self.last_success_at else None,
+                'current_round': current,
+                'last_round': self.last_round,
+                'totals': dict(self.totals),
+                'last_error': self.last_error,
+                'client': self.client.stats(),
+            }
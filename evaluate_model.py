@@ -0,0 +1,199 @@
+"""
+Offline evaluation of a trained classifier on the packed dataset
+
+Reads batches straight from the memory-mapped dataset built by
+`python packed_dataset.py build` and reports accuracy, per-class accuracy,
+a confusion matrix and inference throughput.
+
+Usage:
+    python evaluate_model.py                                  # default model, validation split
+    python evaluate_model.py --model models/profile_classifier.keras --split all
+    python evaluate_model.py --report --model models/a.keras  # + latency, size, RSS
+    python evaluate_model.py --compare models/a.keras models/b.keras
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from packed_dataset import PackedDataset, default_dataset_dir
+
+BASE_DIR = Path(__file__).parent
+DEFAULT_MODEL = BASE_DIR / "models" / "profile_classifier.keras"
+
+
+def evaluate(model, dataset, rows, batch_size=32):
+    """
+    Evaluate `model` on the given rows of a PackedDataset
+
+    Images are resized on the fly if the model's input resolution differs
+    from the packed resolution.
+
+    Returns:
+        dict with accuracy, per_class accuracy, confusion matrix and timing
+    """
+    input_size = tuple(model.input_shape[1:3])
+    num_classes = len(dataset.class_names)
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    predict_seconds = 0.0
+
+    for images, labels in dataset.iter_batches(rows, batch_size):
+        batch = images.astype(np.float32) / 255.0
+        if input_size != (dataset.size, dataset.size):
+            batch = tf.image.resize(batch, input_size).numpy()
+        started = time.perf_counter()
+        probabilities = model.predict_on_batch(batch)
+        predict_seconds += time.perf_counter() - started
+        predicted = np.argmax(probabilities, axis=1)
+        np.add.at(confusion, (labels, predicted), 1)
+
+    total = int(confusion.sum())
+    per_class = {}
+    for class_idx, class_name in enumerate(dataset.class_names):
+        class_total = confusion[class_idx].sum()
+        per_class[class_name] = (round(float(confusion[class_idx, class_idx] / class_total), 4)
+                                 if class_total else None)
+
+    return {
+        'images': total,
+        'accuracy': round(float(np.trace(confusion) / total), 4) if total else None,
+        'per_class': per_class,
+        'confusion_matrix': confusion.tolist(),
+        'predict_seconds': round(predict_seconds, 3),
+        'images_per_second': round(total / predict_seconds, 1) if predict_seconds else None,
+    }
+
+
+def measure_latency(model, runs=100, warmup=10):
+    """
+    Single-image CPU inference latency, as served by classifier_api.py
+
+    Returns:
+        dict with p50/p99/mean latency in milliseconds
+    """
+    x = np.random.rand(1, *model.input_shape[1:]).astype(np.float32)
+    for _ in range(warmup):
+        model.predict_on_batch(x)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        model.predict_on_batch(x)
+        timings.append((time.perf_counter() - started) * 1000)
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 2),
+        'p99_ms': round(float(np.percentile(timings, 99)), 2),
+        'mean_ms': round(float(np.mean(timings)), 2),
+    }
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB
+
+    Prefers VmHWM from /proc (reset on exec, unlike ru_maxrss, which a
+    subprocess inherits from its parent on Linux); None where neither
+    exists (Windows).
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def model_report(model_path, dataset, rows, batch_size=32, runs=100):
+    """
+    Accuracy, latency, on-disk size and peak RSS for one model
+
+    Peak RSS covers the whole process, so call this in a fresh process
+    (see compare_models) when comparing models.
+    """
+    model = keras.models.load_model(model_path)
+    report = {'model': str(model_path), 'parameters': int(model.count_params())}
+    report.update(evaluate(model, dataset, rows, batch_size))
+    report.update(measure_latency(model, runs))
+    report['size_mb'] = round(os.path.getsize(model_path) / 1e6, 2)
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def compare_models(model_paths, dataset_dir=None, split='val', runs=100):
+    """
+    Report each model in its own subprocess so peak RSS is comparable
+
+    Returns:
+        list of report dicts, printed as a table
+    """
+    reports = []
+    for model_path in model_paths:
+        cmd = [sys.executable, str(Path(__file__).resolve()), '--report', '--json',
+               '--model', str(model_path), '--split', split, '--runs', str(runs)]
+        if dataset_dir:
+            cmd += ['--dataset', str(dataset_dir)]
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"\n{'model':45s} {'acc':>6s} {'p50 ms':>8s} {'p99 ms':>8s} {'size MB':>8s} {'RSS MB':>8s}")
+    print("-" * 88)
+    for r in reports:
+        print(f"{Path(r['model']).name:45s} {r['accuracy'] or 0:6.3f} {r['p50_ms']:8.2f} "
+              f"{r['p99_ms']:8.2f} {r['size_mb']:8.2f} {r['peak_rss_mb'] or 0:8.1f}")
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a classifier on the packed dataset")
+    parser.add_argument('--model', default=str(DEFAULT_MODEL), help="Keras model file")
+    parser.add_argument('--dataset', default=None, help="Packed dataset directory")
+    parser.add_argument('--size', type=int, default=128,
+                        help="Packed resolution used to locate the default dataset")
+    parser.add_argument('--split', choices=['val', 'train', 'all'], default='val')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--report', action='store_true',
+                        help="Also measure latency, on-disk size and peak RSS")
+    parser.add_argument('--runs', type=int, default=100, help="Latency measurement runs")
+    parser.add_argument('--compare', nargs='+', metavar='MODEL',
+                        help="Compare several models, each in a fresh process")
+    parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_models(args.compare, args.dataset, args.split, args.runs)
+        return
+
+    dataset = PackedDataset(args.dataset or default_dataset_dir(args.size))
+    train_rows, val_rows = dataset.split()
+    rows = {'val': val_rows, 'train': train_rows, 'all': dataset.rows}[args.split]
+
+    if args.report:
+        report = model_report(args.model, dataset, rows, args.batch_size, args.runs)
+        report['split'] = args.split
+        print(json.dumps(report) if args.json else json.dumps(report, indent=2))
+        return
+
+    print(f"Loading model from: {args.model}")
+    model = keras.models.load_model(args.model)
+
+    print(f"Evaluating on {len(rows)} images ({args.split} split)...")
+    results = evaluate(model, dataset, rows, args.batch_size)
+    results['model'] = args.model
+    results['split'] = args.split
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
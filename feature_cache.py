@@ -0,0 +1,176 @@
+"""
+Cached backbone features for fast classification-head retraining
+
+Runs a frozen ImageNet backbone (ResNet50, matching the production
+transfer-learning model) once over the packed dataset and stores the pooled
+feature vectors on disk as float16, keyed by image content hash and backbone
+version. Retraining the head then only needs the cached vectors; images added
+to the packed dataset later are the only ones pushed through the backbone.
+
+Usage:
+    python feature_cache.py            # update the cache for the packed dataset
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from packed_dataset import DATASETS_DIR, PackedDataset, default_dataset_dir
+
+FEATURES_DIR = DATASETS_DIR / "features"
+
+# Supported backbones: Keras application builder and its ImageNet input
+# preprocessing ('caffe' style: RGB -> BGR, then subtract the channel means)
+BACKBONES = {
+    'resnet50': {
+        'builder': keras.applications.ResNet50,
+        'mean_bgr': [103.939, 116.779, 123.68],
+    },
+}
+
+FEATURES_FILE = 'features.f16'
+INDEX_FILE = 'index.json'
+
+
+def backbone_version(name, input_size):
+    """Identifier that changes whenever cached features would change"""
+    return f"{name}-imagenet-{input_size[0]}x{input_size[1]}-keras{keras.__version__}"
+
+
+def create_input_preprocessing(mean_bgr):
+    """
+    Convert [0, 1] RGB input into the backbone's caffe-style BGR input
+
+    Implemented as a fixed 1x1 convolution (channel swap, x255, minus mean)
+    so the assembled model is a plain Keras model that `load_model` can
+    serve with the API's existing [0, 1] preprocessing.
+    """
+    conv = layers.Conv2D(3, 1, trainable=False, name='imagenet_preprocessing')
+    conv.build((None, None, None, 3))
+    kernel = np.zeros((1, 1, 3, 3), dtype=np.float32)
+    for rgb_channel, bgr_channel in ((0, 2), (1, 1), (2, 0)):
+        kernel[0, 0, rgb_channel, bgr_channel] = 255.0
+    conv.set_weights([kernel, -np.array(mean_bgr, dtype=np.float32)])
+    return conv
+
+
+def create_backbone(name='resnet50', input_size=(128, 128)):
+    """Frozen backbone mapping [0, 1] RGB images to pooled feature vectors"""
+    spec = BACKBONES[name]
+    base = spec['builder'](include_top=False, weights='imagenet', pooling='avg',
+                           input_shape=(*input_size, 3))
+    base.trainable = False
+
+    inputs = layers.Input(shape=(*input_size, 3))
+    x = create_input_preprocessing(spec['mean_bgr'])(inputs)
+    outputs = base(x, training=False)
+    return keras.Model(inputs, outputs, name=f"{name}_backbone")
+
+
+class FeatureCache:
+    """
+    Append-only on-disk cache of feature vectors for one backbone version
+
+    Layout: <cache_dir>/features.f16 (rows x dim float16) and index.json
+    mapping image sha1 -> row.
+    """
+
+    def __init__(self, cache_dir, version, dim):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.version = version
+        self.dim = dim
+        index_path = self.cache_dir / INDEX_FILE
+        if index_path.exists():
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index['version'] != version or index['dim'] != dim:
+                raise ValueError(f"{self.cache_dir} holds features for {index['version']}")
+            self.rows = index['rows']
+        else:
+            self.rows = {}
+
+    def missing(self, hashes):
+        return [h for h in hashes if h not in self.rows]
+
+    def append(self, hashes, features):
+        """Append feature vectors for the given image hashes"""
+        features = np.asarray(features, dtype=np.float16)
+        features_path = self.cache_dir / FEATURES_FILE
+        features_path.touch()
+        with open(features_path, 'r+b') as f:
+            # Drop vectors written by an append that never reached the index
+            f.truncate(len(self.rows) * self.dim * features.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(features.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        for image_hash in hashes:
+            self.rows[image_hash] = len(self.rows)
+        self._save_index()
+
+    def _save_index(self):
+        index_path = self.cache_dir / INDEX_FILE
+        tmp_path = index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.version, 'dim': self.dim, 'rows': self.rows}, f)
+        tmp_path.replace(index_path)
+
+    def lookup(self, hashes):
+        """Return float32 features (len(hashes) x dim) for cached image hashes"""
+        features = np.memmap(self.cache_dir / FEATURES_FILE, dtype=np.float16, mode='r',
+                             shape=(len(self.rows), self.dim))
+        return features[[self.rows[h] for h in hashes]].astype(np.float32)
+
+
+def update_feature_cache(dataset, backbone_name='resnet50', batch_size=32, backbone=None):
+    """
+    Make sure every image in `dataset` has cached backbone features
+
+    Args:
+        dataset: PackedDataset to featurize
+        backbone: optional prebuilt backbone (from create_backbone)
+
+    Returns:
+        (cache, backbone, number of images pushed through the backbone)
+    """
+    input_size = (dataset.size, dataset.size)
+    version = backbone_version(backbone_name, input_size)
+    if backbone is None:
+        backbone = create_backbone(backbone_name, input_size)
+    cache = FeatureCache(FEATURES_DIR / version, version, backbone.output_shape[-1])
+
+    hashes = [dataset.records[row]['sha1'] for row in dataset.rows]
+    missing = set(cache.missing(hashes))
+    rows = [row for row in dataset.rows if dataset.records[row]['sha1'] in missing]
+    # Identical images (same hash) only need one forward pass
+    rows = list({dataset.records[row]['sha1']: row for row in rows}.values())
+
+    rows = np.sort(np.array(rows, dtype=np.int64))
+    for start in range(0, len(rows), batch_size):
+        batch_rows = rows[start:start + batch_size]
+        images = dataset.images[batch_rows].astype(np.float32) / 255.0
+        features = backbone.predict_on_batch(images)
+        cache.append([dataset.records[row]['sha1'] for row in batch_rows], np.asarray(features))
+    return cache, backbone, len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update cached backbone features")
+    parser.add_argument('--dataset', default=None, help="Packed dataset directory")
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--backbone', choices=sorted(BACKBONES), default='resnet50')
+    args = parser.parse_args()
+
+    dataset = PackedDataset(args.dataset or default_dataset_dir(args.size))
+    cache, _, computed = update_feature_cache(dataset, args.backbone)
+    print(f"✓ Computed features for {computed} new image(s); "
+          f"{len(cache.rows)} cached in {cache.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Shared outbound HTTP clients for the web application.
+
+Each upstream dependency (Microsoft Graph, blob storage, the classifier API)
+gets its own connection pool, timeouts, concurrency limit and circuit
+breaker, plus a latency histogram so /debug/upstreams shows which upstream
+dominates page latency.
+
+Settings can be overridden per upstream with environment variables, e.g.
+UPSTREAM_GRAPH_READ_TIMEOUT=5 or UPSTREAM_CLASSIFIER_MAX_CONCURRENCY=8.
+"""
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from request_log import record_stage
+
+# Default settings per upstream (timeouts in seconds)
+UPSTREAM_DEFAULTS = {
+    'graph': {
+        'connect_timeout': 3.05,
+        'read_timeout': 10.0,
+        'pool_maxsize': 10,
+        'max_concurrency': 10,
+        'failure_threshold': 5,
+        'reset_timeout': 30.0,
+    },
+    'blob': {
+        'connect_timeout': 3.05,
+        'read_timeout': 15.0,
+        'pool_maxsize': 10,
+        'max_concurrency': 10,
+        'failure_threshold': 5,
+        'reset_timeout': 30.0,
+    },
+    'classifier': {
+        'connect_timeout': 3.05,
+        'read_timeout': 30.0,
+        'pool_maxsize': 8,
+        'max_concurrency': 8,
+        'failure_threshold': 5,
+        'reset_timeout': 30.0,
+    },
+}
+
+# Histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised when an upstream's circuit breaker is open."""
+
+
+class BulkheadFullError(requests.ConnectionError):
+    """Raised when an upstream already has its maximum requests in flight."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls fail fast for `reset_timeout` seconds. Then a single trial call
+    is let through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow_request(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with approximate percentiles."""
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = list(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, elapsed_ms, error=False):
+        index = len(self.buckets_ms)
+        for i, bound in enumerate(self.buckets_ms):
+            if elapsed_ms <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            if error:
+                self.errors += 1
+
+    def percentile(self, pct):
+        """Return the bucket upper bound containing the given percentile."""
+        if self.count == 0:
+            return None
+        target = self.count * pct / 100.0
+        running = 0
+        for i, bucket_count in enumerate(self.counts):
+            running += bucket_count
+            if running >= target:
+                return self.buckets_ms[i] if i < len(self.buckets_ms) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'avg_ms': round(self.total_ms / self.count, 1) if self.count else None,
+                'max_ms': round(self.max_ms, 1),
+                'total_ms': round(self.total_ms, 1),
+                'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95),
+                'p99_ms': self.percentile(99),
+                'buckets': {
+                    (f"le_{bound}" if i < len(self.buckets_ms) else 'inf'): count
+                    for i, (bound, count) in enumerate(
+                        zip(self.buckets_ms + [None], self.counts))
+                },
+            }
+
+
+class UpstreamClient:
+    """Pooled, timeout-aware HTTP client for a single upstream dependency."""
+
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10, pool_maxsize=10,
+                 max_concurrency=10, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.histogram = LatencyHistogram()
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._counter_lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def _reject(self, error):
+        with self._counter_lock:
+            self.rejected += 1
+        raise error
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request through this upstream's pool.
+
+        Raises:
+            CircuitOpenError: the circuit breaker is open
+            BulkheadFullError: max_concurrency requests are already in flight
+            requests.RequestException: the request itself failed
+        """
+        if not self._slots.acquire(blocking=False):
+            self._reject(BulkheadFullError(
+                f"{self.name}: {self.max_concurrency} requests in flight"))
+        if not self.breaker.allow_request():
+            self._slots.release()
+            self._reject(CircuitOpenError(f"{self.name}: circuit open"))
+
+        kwargs.setdefault('timeout', self.timeout)
+        with self._counter_lock:
+            self.in_flight += 1
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            with self._counter_lock:
+                self.in_flight -= 1
+            self._slots.release()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.histogram.observe(elapsed_ms, error=failed)
+            record_stage(f"upstream_{self.name}", elapsed_ms)
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        return {
+            'circuit': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'in_flight': self.in_flight,
+            'rejected': self.rejected,
+            'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+            'latency': self.histogram.snapshot(),
+        }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _setting(name, key, default):
+    value = os.getenv(f"UPSTREAM_{name.upper()}_{key.upper()}")
+    if value is None:
+        return default
+    return type(default)(value)
+
+
+def get_client(name, kind=None):
+    """
+    Return the shared client for an upstream ('graph', 'blob' or 'classifier').
+
+    `kind` selects the defaults and environment overrides when several
+    clients share them, e.g. one client per classifier replica.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                kind = kind or name
+                defaults = UPSTREAM_DEFAULTS.get(kind, UPSTREAM_DEFAULTS['graph'])
+                settings = {key: _setting(kind, key, value) for key, value in defaults.items()}
+                client = UpstreamClient(name, **settings)
+                _clients[name] = client
+    return client
+
+
+def upstream_stats():
+    """Return stats for every upstream client created so far."""
+    return {name: client.stats() for name, client in sorted(_clients.items())}
@@ -0,0 +1,282 @@
+"""
+Parallel hyperparameter sweep for train_model_example.py
+
+Trains many configurations (image size, batch size, learning rate,
+architecture) side by side on a process pool and stops unpromising ones
+early with successive halving:
+
+    rung 0: every trial trains --min-epochs epochs
+    rung k: the best 1/--eta trials continue up to min_epochs * eta^k epochs
+            (resuming from their checkpoint) until --max-epochs
+
+Each worker process is pinned to its own slice of CPU cores
+(os.sched_setaffinity, where the platform has it; elsewhere workers are
+not pinned) and TensorFlow's thread pools are sized to that slice, so
+parallel trials do not oversubscribe the machine. All trials read
+the same packed, memory-mapped dataset per image size (built once up front),
+so images are decoded once and shared through the OS page cache.
+
+Results are written after every rung to models/sweeps/<timestamp>/
+leaderboard.json and leaderboard.csv.
+
+Usage:
+    python hyperparameter_sweep.py
+    python hyperparameter_sweep.py --img-sizes 96 128 --batch-sizes 16 32 \\
+        --learning-rates 1e-3 3e-4 --parallel 4 --max-epochs 27
+    python hyperparameter_sweep.py --samples 12      # random subset of the grid
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from packed_dataset import DATA_DIR, build_packed_dataset, default_dataset_dir
+
+BASE_DIR = Path(__file__).parent
+SWEEPS_DIR = BASE_DIR / "models" / "sweeps"
+
+LEADERBOARD_FIELDS = ['rank', 'trial', 'architecture', 'img_size', 'batch_size',
+                      'learning_rate', 'epochs', 'rung', 'status', 'val_accuracy',
+                      'best_val_accuracy', 'val_loss', 'train_seconds', 'images_per_second',
+                      'cores', 'checkpoint']
+
+
+# How long a (replacement) worker waits for a free core set before running
+# unpinned
+CORE_SET_WAIT_SECONDS = 5
+
+
+def available_cores():
+    """CPUs this process may use (affinity aware where the platform supports it)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(parallel, threads_per_trial=None):
+    """
+    Partition the CPUs this process may use into one core set per worker
+
+    Returns:
+        list of `parallel` core lists (sets overlap only when there are
+        fewer cores than workers)
+    """
+    cores = available_cores()
+    threads_per_trial = threads_per_trial or max(1, len(cores) // parallel)
+    return [[cores[(worker * threads_per_trial + i) % len(cores)]
+             for i in range(threads_per_trial)]
+            for worker in range(parallel)]
+
+
+def _init_worker(core_queue, threads_per_worker):
+    """
+    Pool initializer: pin this worker to a core set before TensorFlow starts
+
+    TensorFlow's intra/inter-op thread pools cannot be resized once created,
+    so they are configured here, before any trial builds a model. A worker
+    that replaces a dead one finds no core set left in the queue; it runs
+    unpinned with the same thread count instead of blocking.
+    """
+    threads = threads_per_worker
+    try:
+        cores = core_queue.get(timeout=CORE_SET_WAIT_SECONDS)
+    except queue.Empty:
+        print("Worker started without a free core set; running unpinned")
+    else:
+        threads = len(cores)
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def run_trial(trial, start_epoch, end_epoch, sweep_dir):
+    """
+    Train one configuration from `start_epoch` up to `end_epoch` (worker side)
+
+    The first call builds a fresh model; later rungs resume from the trial's
+    checkpoint, which includes the optimizer state.
+
+    Returns:
+        dict of metrics for the leaderboard
+    """
+    from tensorflow import keras
+    import train_model_example as trainer
+
+    trainer.configure(img_size=trial['img_size'], batch_size=trial['batch_size'],
+                      learning_rate=trial['learning_rate'])
+    train_ds, val_ds, train_count, _ = trainer.create_packed_datasets(
+        default_dataset_dir(trial['img_size']))
+
+    checkpoint = Path(sweep_dir) / f"trial_{trial['trial']:03d}.keras"
+    if start_epoch > 0:
+        model = keras.models.load_model(checkpoint)
+    else:
+        builder = {'cnn': trainer.create_model,
+                   'student': trainer.create_student_model}[trial['architecture']]
+        model = builder((*trainer.IMG_SIZE, 3), len(trainer.CLASS_NAMES))
+        model.compile(optimizer=keras.optimizers.Adam(learning_rate=trainer.LEARNING_RATE),
+                      loss='categorical_crossentropy', metrics=['accuracy'])
+
+    started = time.perf_counter()
+    history = model.fit(train_ds, validation_data=val_ds, initial_epoch=start_epoch,
+                        epochs=end_epoch, verbose=0)
+    train_seconds = time.perf_counter() - started
+    model.save(checkpoint)
+
+    return {
+        'epochs': end_epoch,
+        'val_accuracy': round(float(history.history['val_accuracy'][-1]), 4),
+        'best_val_accuracy': round(float(max(history.history['val_accuracy'])), 4),
+        'val_loss': round(float(history.history['val_loss'][-1]), 4),
+        'train_seconds': round(train_seconds, 1),
+        'images_per_second': round(train_count * (end_epoch - start_epoch) / train_seconds, 1),
+        'cores': ' '.join(str(core) for core in available_cores()),
+        'checkpoint': str(checkpoint),
+    }
+
+
+def build_trials(architectures, img_sizes, batch_sizes, learning_rates, samples=None, seed=42):
+    """Full grid of configurations, or a seeded random sample of `samples` of them"""
+    grid = list(itertools.product(architectures, img_sizes, batch_sizes, learning_rates))
+    if samples and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return [{'trial': i, 'architecture': arch, 'img_size': size, 'batch_size': batch,
+             'learning_rate': lr, 'epochs': 0, 'rung': 0, 'status': 'pending'}
+            for i, (arch, size, batch, lr) in enumerate(grid)]
+
+
+def rung_budgets(min_epochs, max_epochs, eta):
+    """Cumulative epochs per rung: min_epochs, min_epochs*eta, ... capped at max_epochs"""
+    budgets = [min(min_epochs, max_epochs)]
+    while budgets[-1] < max_epochs:
+        budgets.append(min(budgets[-1] * eta, max_epochs))
+    return budgets
+
+
+def write_leaderboard(trials, sweep_dir):
+    """
+    Rank trials (furthest rung first, then validation accuracy) and write JSON + CSV
+
+    Trials stopped at an earlier rung trained for fewer epochs, so they rank
+    below every trial that got further.
+    """
+    ranked = sorted(trials, key=lambda t: (-t['epochs'], -(t.get('val_accuracy') or 0.0),
+                                           t.get('val_loss') or float('inf')))
+    for rank, trial in enumerate(ranked, start=1):
+        trial['rank'] = rank
+
+    with open(Path(sweep_dir) / 'leaderboard.json', 'w', encoding='utf-8') as f:
+        json.dump(ranked, f, indent=2)
+    with open(Path(sweep_dir) / 'leaderboard.csv', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=LEADERBOARD_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(ranked)
+    return ranked
+
+
+def successive_halving(trials, sweep_dir, parallel, min_epochs, max_epochs, eta=3,
+                       threads_per_trial=None):
+    """
+    Run the sweep on a process pool, halving the field after every rung
+
+    Returns:
+        the ranked leaderboard
+    """
+    ctx = multiprocessing.get_context('spawn')  # TensorFlow is not fork-safe
+    core_queue = ctx.Queue()
+    core_sets = split_cores(parallel, threads_per_trial)
+    for cores in core_sets:
+        core_queue.put(cores)
+
+    survivors = list(trials)
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=ctx,
+                             initializer=_init_worker,
+                             initargs=(core_queue, len(core_sets[0]))) as pool:
+        for rung, budget in enumerate(rung_budgets(min_epochs, max_epochs, eta)):
+            print(f"\nRung {rung}: {len(survivors)} trial(s) -> {budget} epochs")
+            futures = {pool.submit(run_trial, t, t['epochs'], budget, str(sweep_dir)): t
+                       for t in survivors}
+            for future in as_completed(futures):
+                trial = futures[future]
+                trial['rung'] = rung
+                try:
+                    trial.update(future.result())
+                    trial['status'] = 'running'
+                    print(f"  trial {trial['trial']:3d} {trial['architecture']:7s} "
+                          f"{trial['img_size']:4d}px bs={trial['batch_size']:<3d} "
+                          f"lr={trial['learning_rate']:<8g} val_acc={trial['val_accuracy']:.4f} "
+                          f"{trial['images_per_second']:8.1f} img/s")
+                except Exception as e:
+                    trial['status'] = f"failed: {e}"
+                    print(f"  trial {trial['trial']:3d} failed: {e}")
+
+            survivors = [t for t in survivors if t['status'] == 'running']
+            survivors.sort(key=lambda t: (-t['val_accuracy'], t['val_loss']))
+            keep = max(1, len(survivors) // eta) if budget < max_epochs else 0
+            for trial in survivors[keep:]:
+                trial['status'] = 'completed' if budget >= max_epochs else f"stopped at rung {rung}"
+            survivors = survivors[:keep]
+            write_leaderboard(trials, sweep_dir)
+            if not survivors:
+                break
+
+    return write_leaderboard(trials, sweep_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep with successive halving")
+    parser.add_argument('--architectures', nargs='+', choices=['cnn', 'student'], default=['cnn'])
+    parser.add_argument('--img-sizes', type=int, nargs='+', default=[128])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32])
+    parser.add_argument('--learning-rates', type=float, nargs='+', default=[1e-3, 3e-4, 1e-4])
+    parser.add_argument('--samples', type=int, default=None,
+                        help="Random sample of this many grid configurations")
+    parser.add_argument('--min-epochs', type=int, default=1, help="Epochs in the first rung")
+    parser.add_argument('--max-epochs', type=int, default=9, help="Epochs for the final rung")
+    parser.add_argument('--eta', type=int, default=3, help="Keep 1/eta of the trials per rung")
+    parser.add_argument('--parallel', type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="Trials trained at the same time")
+    parser.add_argument('--threads-per-trial', type=int, default=None,
+                        help="CPU cores pinned to each trial (default: cores / parallel)")
+    parser.add_argument('--output', default=None, help="Sweep directory")
+    args = parser.parse_args()
+
+    trials = build_trials(args.architectures, args.img_sizes, args.batch_sizes,
+                          args.learning_rates, args.samples)
+    sweep_dir = Path(args.output) if args.output else SWEEPS_DIR / time.strftime('%Y%m%d-%H%M%S')
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+
+    # Decode the images once per resolution; every trial memory-maps the result
+    for size in sorted(set(args.img_sizes)):
+        appended = build_packed_dataset(DATA_DIR, default_dataset_dir(size), size)
+        print(f"Packed dataset {size}px ready ({appended} image(s) added)")
+
+    print(f"Sweeping {len(trials)} configuration(s), {args.parallel} in parallel")
+    started = time.perf_counter()
+    leaderboard = successive_halving(trials, sweep_dir, args.parallel, args.min_epochs,
+                                     args.max_epochs, args.eta, args.threads_per_trial)
+
+    print(f"\nSweep finished in {time.perf_counter() - started:.0f}s")
+    print(f"\n{'rank':>4s} {'trial':>5s} {'arch':7s} {'size':>5s} {'batch':>5s} {'lr':>8s} "
+          f"{'epochs':>6s} {'val_acc':>8s} {'img/s':>8s}  status")
+    print("-" * 80)
+    for t in leaderboard:
+        print(f"{t['rank']:4d} {t['trial']:5d} {t['architecture']:7s} {t['img_size']:5d} "
+              f"{t['batch_size']:5d} {t['learning_rate']:8g} {t['epochs']:6d} "
+              f"{t.get('val_accuracy') or 0:8.4f} {t.get('images_per_second') or 0:8.1f}  "
+              f"{t['status']}")
+    print(f"\nLeaderboard: {sweep_dir / 'leaderboard.csv'}")
+
+
+if __name__ == "__main__":
+    main()
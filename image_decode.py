@@ -0,0 +1,203 @@
+"""
+Memory-bounded image decoding.
+
+Decoding is where an image's real size shows up: a 200 KB PNG can expand
+to gigabytes of pixels. decode_resized() keeps that in check:
+
+- The pixel count is read from the image header (Image.open does not
+  decode) and images over MAX_IMAGE_PIXELS are refused before any pixel
+  data is touched.
+- Large JPEGs are decoded at reduced resolution (libjpeg DCT scaling via
+  Image.draft, 1/2 to 1/8), never below twice the target size, so the
+  final LANCZOS resize keeps its quality.
+- Every decode reserves its estimated memory from a process-wide
+  DecodeBudget (DECODE_MEMORY_MB). Decodes that do not fit wait for
+  others to finish, so concurrent large images cannot add up past the
+  budget. Waiting longer than DECODE_WAIT_SECONDS raises DecodeBusy.
+
+DecodeStats records decodes, rejections, drafts, waits and peak memory
+(reserved decode bytes and process RSS) for sizing instances.
+"""
+import os
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image, ImageMode
+
+# Refuse images with more pixels than this (checked from the header)
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', str(40_000_000)))
+# Memory all concurrent decodes may reserve together
+DECODE_MEMORY_MB = float(os.getenv('DECODE_MEMORY_MB', '512'))
+DECODE_WAIT_SECONDS = float(os.getenv('DECODE_WAIT_SECONDS', '30'))
+# JPEGs larger than this are decoded at reduced resolution
+DRAFT_MIN_PIXELS = int(os.getenv('DECODE_DRAFT_MIN_PIXELS', str(4_000_000)))
+
+
+class DecodeBusy(Exception):
+    """The decode budget stayed exhausted for too long; retry later."""
+
+
+def rss_mb():
+    """Current and peak resident memory of this process, in MB"""
+    current = peak = None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith('VmHWM:'):
+                    peak = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        try:
+            import resource  # Unix only
+        except ImportError:
+            return current, peak
+        peak = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return current, peak
+
+
+class DecodeBudget:
+    """Counting semaphore over bytes of decoded pixels"""
+
+    def __init__(self, capacity_bytes):
+        self.capacity = int(capacity_bytes)
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes, timeout=DECODE_WAIT_SECONDS):
+        """
+        Hold `nbytes` of the budget for the duration of the block
+
+        A single request larger than the whole budget is clamped to it, so
+        it still runs, just never alongside another decode.
+
+        Returns (via `as`): seconds spent waiting
+        """
+        nbytes = min(int(nbytes), self.capacity)
+        started = time.perf_counter()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_use + nbytes <= self.capacity, timeout):
+                raise DecodeBusy(f"Decode memory budget busy for over {timeout:.0f}s")
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield time.perf_counter() - started
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+
+class DecodeStats:
+    """Counters for /api/health"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'decodes': 0, 'rejected': 0, 'drafted': 0, 'waited': 0,
+                         'wait_ms': 0.0, 'largest_pixels': 0, 'largest_decode_bytes': 0}
+
+    def record(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                if name.startswith('largest_'):
+                    self.counters[name] = max(self.counters[name], value)
+                else:
+                    self.counters[name] += value
+
+    def snapshot(self, budget):
+        with self._lock:
+            counters = dict(self.counters)
+        counters['wait_ms'] = round(counters['wait_ms'], 1)
+        current, peak = rss_mb()
+        return {
+            **counters,
+            'max_image_pixels': MAX_IMAGE_PIXELS,
+            'budget_mb': round(budget.capacity / 2**20, 1),
+            'in_use_mb': round(budget.in_use / 2**20, 1),
+            'peak_reserved_mb': round(budget.peak / 2**20, 1),
+            'rss_mb': current,
+            'peak_rss_mb': peak,
+        }
+
+
+decode_budget = DecodeBudget(DECODE_MEMORY_MB * 2**20)
+decode_stats = DecodeStats()
+
+
+def open_checked(source, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Open an image lazily and enforce the pixel budget from its header
+
+    The header check replaces PIL's decompression bomb warning for this
+    open only; PIL's own settings are left alone, so its hard error (at
+    twice Image.MAX_IMAGE_PIXELS) still applies and is reported the same way.
+
+    Raises:
+        ValueError: more than max_pixels pixels
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            img = Image.open(source)
+    except Image.DecompressionBombError as e:
+        decode_stats.record(rejected=1)
+        raise ValueError(str(e)) from e
+    width, height = img.size
+    if width * height > max_pixels:
+        img.close()
+        decode_stats.record(rejected=1)
+        raise ValueError(f"Image is {width}x{height} ({width * height} pixels); "
+                         f"the limit is {max_pixels} pixels")
+    return img
+
+
+def draft_for(img, target_size, min_pixels=DRAFT_MIN_PIXELS):
+    """Switch a large JPEG to reduced-resolution decoding; returns True if it did"""
+    width, height = img.size
+    if img.format != 'JPEG' or width * height < min_pixels:
+        return False
+    requested = (target_size[0] * 2, target_size[1] * 2)
+    img.draft('RGB', requested)
+    return img.size != (width, height)
+
+
+def decoded_bytes(img):
+    """Estimated memory to decode `img` (at its current draft size) and convert it to RGB"""
+    width, height = img.size
+    mode = ImageMode.getmode(img.mode)
+    pixel_bytes = len(mode.bands) * np.dtype(mode.typestr).itemsize
+    return width * height * (pixel_bytes + (3 if img.mode != 'RGB' else 0))
+
+
+def decode_resized(source, target_size, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Decode an image into an RGB uint8 array of `target_size` within the limits
+
+    Args:
+        source: file path, file object or BytesIO
+        target_size: (width, height)
+
+    Raises:
+        ValueError: over the pixel budget (PIL's own errors for
+            undecodable data pass through)
+        DecodeBusy: the decode memory budget stayed exhausted
+    """
+    img = open_checked(source, max_pixels)
+    pixels = img.size[0] * img.size[1]
+    drafted = draft_for(img, target_size)
+    nbytes = decoded_bytes(img)
+    with decode_budget.reserve(nbytes) as waited:
+        img.load()
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img = img.resize(target_size, Image.LANCZOS)
+        array = np.asarray(img, dtype=np.uint8)
+    decode_stats.record(decodes=1, drafted=int(drafted), waited=int(waited > 0.001),
+                        wait_ms=waited * 1000, largest_pixels=pixels,
+                        largest_decode_bytes=nbytes)
+    return array
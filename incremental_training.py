@@ -0,0 +1,255 @@
+"""
+Incremental retraining on newly added photos
+
+Instead of retraining from scratch, fine-tune the current registered model
+on only the images that are new (or whose content changed) since that
+model was trained, mixed with a replay buffer sampled from the images it
+has already seen so it does not forget them:
+
+1. Download photos listed in profile_upload_map.csv that are not yet in
+   scripts/test_images/<category>/ (blob client from http_clients.py)
+2. Append new/changed images to the packed dataset (content-hash based)
+3. Delta = packed rows added after the model's registered dataset watermark
+4. Fine-tune on delta + replay, early-stopping once validation loss stops
+   improving by --min-delta
+5. Register the result as a new model version (current only if it did not
+   lose more than --max-accuracy-drop on the validation set)
+
+Cost scales with the number of new images (plus the replay buffer), not
+with the size of the whole dataset.
+
+Usage:
+    python incremental_training.py
+    python incremental_training.py --replay-ratio 2 --epochs 5
+    python train_model_example.py --mode incremental
+"""
+import argparse
+import csv
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+from tensorflow import keras
+
+from compress_model import training_batches
+from evaluate_model import evaluate
+from model_registry import current_model_path, get_model, register_model
+from packed_dataset import (CLASS_NAMES, DATA_DIR, PackedDataset, build_packed_dataset,
+                            default_dataset_dir)
+
+BASE_DIR = Path(__file__).parent
+UPLOAD_MAP = BASE_DIR / "profile_upload_map.csv"
+OUTPUT_DIR = BASE_DIR / "models" / "incremental"
+SEED = 42
+
+
+def sync_upload_map(map_path=UPLOAD_MAP, data_dir=DATA_DIR, client=None):
+    """
+    Download uploaded profile photos that are missing from the class directories
+
+    Rows without a blob URL or with a category that is not a class
+    (e.g. 'no-picture') are skipped. Photos are saved under their blob
+    name: ImageFileName comes from the uploading client and is not unique,
+    while uploaded blob names are content-addressed.
+
+    Returns:
+        Number of images downloaded
+    """
+    map_path = Path(map_path)
+    if not map_path.exists():
+        return 0
+    if client is None:
+        from http_clients import get_client
+        client = get_client('blob')
+
+    downloaded = 0
+    with open(map_path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            category, url = row.get('Category'), row.get('BlobUrl')
+            file_name, blob_name = row.get('ImageFileName'), row.get('BlobName')
+            if category not in CLASS_NAMES or not url or not (blob_name or file_name):
+                continue
+            class_dir = Path(data_dir) / category
+            # Photos uploaded by the PowerShell scripts from a local training
+            # image are named profile_<ImageFileName>; that image is already here
+            if file_name and blob_name == f"profile_{file_name}" and (class_dir / file_name).exists():
+                continue
+            target = class_dir / Path(blob_name or file_name).name
+            if target.exists():
+                continue
+            try:
+                response = client.get(url)
+                response.raise_for_status()
+            except Exception as e:
+                print(f"  Could not download {target.name}: {e}")
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(response.content)
+            downloaded += 1
+    return downloaded
+
+
+def hash_split(dataset, rows, validation_split=0.2):
+    """
+    Train/validation split by image content hash
+
+    Unlike PackedDataset.split, an image's side of the split never changes
+    as the dataset grows, so old validation images stay unseen by training.
+
+    Returns:
+        (train_rows, val_rows)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    buckets = np.array([zlib.crc32(dataset.records[row]['sha1'].encode()) % 1000
+                        for row in rows])
+    is_val = buckets < int(validation_split * 1000)
+    return rows[~is_val], rows[is_val]
+
+
+def sample_replay(train_rows, count, seed=SEED):
+    """Random replay buffer of old training rows"""
+    count = min(len(train_rows), count)
+    return np.sort(np.random.default_rng(seed).choice(train_rows, count, replace=False))
+
+
+def find_delta(dataset, watermark):
+    """
+    Split current rows into (old, new) by the packed-row watermark
+
+    Packed rows are append-only and changed images get a new row, so every
+    row at or past the watermark is an image the model has not trained on.
+    """
+    rows = dataset.rows
+    return rows[rows < watermark], rows[rows >= watermark]
+
+
+def retrain_incrementally(model_path=None, data_dir=DATA_DIR, replay_ratio=1.0, epochs=10,
+                          learning_rate=1e-4, batch_size=16, min_delta=0.001, patience=2,
+                          max_accuracy_drop=0.01, sync_uploads=True):
+    """
+    Fine-tune the current model on new images plus a replay buffer
+
+    Returns:
+        dict describing the run (None if there was nothing new to train on)
+    """
+    started = time.perf_counter()
+    entry = get_model()
+    current_path = current_model_path()
+    from_registry = current_path is not None and (
+        model_path is None or Path(model_path).resolve() == Path(current_path).resolve())
+    model_path = model_path or current_path
+    if model_path is None:
+        raise FileNotFoundError("No model registered; pass --model or register one first")
+
+    model = keras.models.load_model(model_path)
+    input_size = tuple(model.input_shape[1:3])
+    dataset_dir = default_dataset_dir(input_size[0])
+
+    if sync_uploads:
+        downloaded = sync_upload_map(data_dir=data_dir)
+        print(f"Downloaded {downloaded} new upload(s) from {UPLOAD_MAP.name}")
+    appended = build_packed_dataset(data_dir, dataset_dir, input_size[0])
+    dataset = PackedDataset(dataset_dir)
+    print(f"Packed dataset: {appended} new/changed image(s), {len(dataset)} total")
+
+    seen = (entry or {}).get('dataset') or {}
+    if from_registry and seen.get('path') == str(dataset_dir):
+        watermark = seen['records']
+    else:
+        print("No dataset watermark for this model; treating every image as new")
+        watermark = 0
+    old_rows, new_rows = find_delta(dataset, watermark)
+    if len(new_rows) == 0:
+        print("No new images since the model was trained; nothing to do")
+        return None
+
+    old_train, old_val = hash_split(dataset, old_rows)
+    new_train, new_val = hash_split(dataset, new_rows)
+    replay = sample_replay(old_train, int(round(len(new_train) * replay_ratio)))
+    train_rows = np.sort(np.concatenate([new_train, replay]))
+    val_rows = np.sort(np.concatenate([old_val, new_val]))
+    print(f"Delta: {len(new_train)} train / {len(new_val)} val new image(s), "
+          f"replay buffer: {len(replay)}, validation: {len(val_rows)}")
+
+    def accuracy(rows):
+        return evaluate(model, dataset, rows)['accuracy'] if len(rows) else None
+
+    before = {'val': accuracy(val_rows), 'old_val': accuracy(old_val), 'new_val': accuracy(new_val)}
+
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+                  loss='categorical_crossentropy', metrics=['accuracy'])
+    history = model.fit(
+        training_batches(dataset, train_rows, input_size, batch_size),
+        validation_data=training_batches(dataset, val_rows, input_size, batch_size),
+        epochs=epochs,
+        callbacks=[keras.callbacks.EarlyStopping(
+            monitor='val_loss', min_delta=min_delta, patience=patience,
+            restore_best_weights=True, verbose=1)],
+        verbose=2,
+    )
+
+    after = {'val': accuracy(val_rows), 'old_val': accuracy(old_val), 'new_val': accuracy(new_val)}
+    accepted = (after['val'] or 0.0) >= (before['val'] or 0.0) - max_accuracy_drop
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    output_path = OUTPUT_DIR / f"incremental_{time.strftime('%Y%m%d-%H%M%S')}.keras"
+    serving_model = keras.models.clone_model(model)
+    serving_model.set_weights(model.get_weights())
+    serving_model.save(output_path)
+
+    run = {
+        'new_train_images': int(len(new_train)),
+        'new_val_images': int(len(new_val)),
+        'replay_images': int(len(replay)),
+        'epochs_run': len(history.history['loss']),
+        'seconds': round(time.perf_counter() - started, 1),
+        'accuracy_before': before,
+        'accuracy_after': after,
+    }
+    base = f"v{entry['version']}" if from_registry else model_path
+    version = register_model(
+        output_path,
+        metrics={'accuracy': after['val'], 'incremental': run},
+        source=f"incremental fine-tune of {base}",
+        make_current=accepted,
+        dataset={'path': str(dataset_dir), 'records': len(dataset.records)},
+    )
+    run.update({'version': version, 'current': accepted, 'path': str(output_path)})
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fine-tune the current model on new images")
+    parser.add_argument('--model', default=None,
+                        help="Model to start from (default: current registry version)")
+    parser.add_argument('--replay-ratio', type=float, default=1.0,
+                        help="Old images replayed per new training image")
+    parser.add_argument('--epochs', type=int, default=10, help="Maximum fine-tuning epochs")
+    parser.add_argument('--learning-rate', type=float, default=1e-4)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--min-delta', type=float, default=0.001,
+                        help="Smallest validation loss improvement that counts")
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.01,
+                        help="Do not make the new version current if validation "
+                             "accuracy drops by more than this")
+    parser.add_argument('--no-sync', action='store_true',
+                        help=f"Do not download new photos listed in {UPLOAD_MAP.name}")
+    args = parser.parse_args()
+
+    run = retrain_incrementally(args.model, replay_ratio=args.replay_ratio, epochs=args.epochs,
+                                learning_rate=args.learning_rate, batch_size=args.batch_size,
+                                min_delta=args.min_delta, max_accuracy_drop=args.max_accuracy_drop,
+                                sync_uploads=not args.no_sync)
+    if run is None:
+        return
+    print(f"\nValidation accuracy: {run['accuracy_before']['val']} -> {run['accuracy_after']['val']} "
+          f"(new images: {run['accuracy_before']['new_val']} -> {run['accuracy_after']['new_val']})")
+    print(f"Trained on {run['new_train_images']} new + {run['replay_images']} replayed image(s) "
+          f"for {run['epochs_run']} epoch(s) in {run['seconds']}s")
+    status = "now current" if run['current'] else "registered, NOT made current (accuracy dropped)"
+    print(f"✓ Version {run['version']} ({run['path']}): {status}")
+
+
+if __name__ == "__main__":
+    main()
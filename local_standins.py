@@ -0,0 +1,297 @@
+"""
+Local stand-ins for the services the web app depends on.
+
+StandinServer is a small threaded HTTP server that answers like Microsoft
+Graph and Azure blob storage, so the apps can be exercised (replayed,
+benchmarked) without network access or real credentials:
+
+    GET /graph/v1.0/me                     first user in the mapping
+    GET /graph/v1.0/users/<id or UPN>      user lookup
+    GET /graph/v1.0/users/delta            delta query (paged, with delta links)
+    GET /blob/<container>/<blob name>      photo bytes
+
+Users come from profile_upload_map.csv. Blob names are resolved to the
+local copies in scripts/test_images/<category>/ when present; any other
+blob gets a generated JPEG so every URL in the mapping is servable.
+Fixed per-call latency can be injected to model a slow upstream.
+
+The delta API follows Graph's protocol: without a token it pages through
+every user ($top per page, @odata.nextLink) and the last page carries an
+@odata.deltaLink; following that link returns only users added, changed
+(add_user/update_user) or removed (remove_user, as "@removed" items)
+since. Tokens issued before expire_delta_tokens() answer 410 Gone.
+
+Usage:
+    python local_standins.py --port 8700      # run until interrupted
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from PIL import Image
+
+BASE_DIR = Path(__file__).parent
+UPLOAD_MAP = BASE_DIR / "profile_upload_map.csv"
+IMAGE_DIR = BASE_DIR / "scripts" / "test_images"
+
+# https://<account>.blob.core.windows.net/<container>/<blob>
+BLOB_URL_PATTERN = re.compile(r'^https?://[^/]+\.blob\.core\.windows\.net/(.+)$')
+
+
+def load_users(map_path=UPLOAD_MAP):
+    """Graph-style user objects (with stable ids) built from the upload map"""
+    users = []
+    if not Path(map_path).exists():
+        return users
+    with open(map_path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            user = user_from(row['UserPrincipalName'], row.get('DisplayName', ''))
+            user.update({
+                '_blob': row.get('BlobName', ''),
+                '_file': row.get('ImageFileName', ''),
+                '_category': row.get('Category', ''),
+            })
+            users.append(user)
+    return users
+
+
+def user_from(upn, display_name=''):
+    return {'id': str(uuid.uuid5(uuid.NAMESPACE_URL, upn.lower())), 'userPrincipalName': upn,
+            'displayName': display_name, 'mail': upn if '#ext#' not in upn else None,
+            '_blob': '', '_file': '', '_category': ''}
+
+
+def public_user(user):
+    return {key: value for key, value in user.items() if not key.startswith('_')}
+
+
+def generated_jpeg(name, size=256):
+    """Deterministic placeholder photo for blobs with no local copy"""
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    image = Image.new('RGB', (size, size), tuple(digest[:3]))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class StandinServer:
+    """
+    Threaded HTTP stand-in for Graph and blob storage
+
+    Args:
+        port: port to bind on 127.0.0.1 (0 picks a free one)
+        graph_latency_ms / blob_latency_ms: delay added to every response
+        delta_page_size: users per delta page when the request has no $top
+    """
+
+    def __init__(self, port=0, map_path=UPLOAD_MAP, image_dir=IMAGE_DIR,
+                 graph_latency_ms=0.0, blob_latency_ms=0.0, delta_page_size=100):
+        self.users = load_users(map_path)
+        self.by_key = {}
+        for user in self.users:
+            self.by_key[user['id']] = user
+            self.by_key[user['userPrincipalName'].lower()] = user
+        self.blob_files = {user['_blob']: Path(image_dir) / user['_category'] / user['_file']
+                           for user in self.users if user['_blob']}
+        self.graph_latency_ms = graph_latency_ms
+        self.blob_latency_ms = blob_latency_ms
+        self.requests_served = 0
+        self.delta_page_size = delta_page_size
+        # Delta bookkeeping: sequence number of the last change per user id
+        self.sequence = 0
+        self.changed_at = {}
+        self.removed = {}  # id -> sequence number of the removal
+        self.expired_before = 0
+        self._blob_cache = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def graph_url(self):
+        """Value for GRAPH_API_ENDPOINT"""
+        return f"{self.base_url}/graph/v1.0"
+
+    def blob_url(self, url):
+        """Rewrite an Azure blob URL to this stand-in (other URLs are returned unchanged)"""
+        match = BLOB_URL_PATTERN.match(url or '')
+        return f"{self.base_url}/blob/{match.group(1)}" if match else url
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _changed(self, user_id):
+        self.sequence += 1
+        self.changed_at[user_id] = self.sequence
+
+    def add_user(self, upn, display_name=''):
+        """Create a directory user (visible to the next delta round)"""
+        user = user_from(upn, display_name)
+        with self._lock:
+            self.users.append(user)
+            self.by_key[user['id']] = user
+            self.by_key[upn.lower()] = user
+            self.removed.pop(user['id'], None)
+            self._changed(user['id'])
+        return public_user(user)
+
+    def update_user(self, key, **fields):
+        """Change properties of a user given by id or UPN (e.g. displayName)"""
+        with self._lock:
+            user = self.by_key[key.lower()]
+            if 'userPrincipalName' in fields:
+                self.by_key.pop(user['userPrincipalName'].lower(), None)
+                self.by_key[fields['userPrincipalName'].lower()] = user
+            user.update(fields)
+            self._changed(user['id'])
+        return public_user(user)
+
+    def remove_user(self, key):
+        """Delete a user given by id or UPN"""
+        with self._lock:
+            user = self.by_key.pop(key.lower())
+            self.by_key.pop(user['id'], None)
+            self.by_key.pop(user['userPrincipalName'].lower(), None)
+            self.users.remove(user)
+            self.changed_at.pop(user['id'], None)
+            self.sequence += 1
+            self.removed[user['id']] = self.sequence
+
+    def expire_delta_tokens(self):
+        """Make every delta token issued so far invalid (410 Gone)"""
+        with self._lock:
+            self.expired_before = self.sequence + 1
+
+    def delta_page(self, query):
+        """
+        Return (status, body dict) for GET /users/delta
+
+        Paging state is carried in $skiptoken as "<since>.<upto>.<offset>.<top>"
+        (since -1 = full enumeration); $deltatoken is the sequence number
+        the previous round ended at.
+        """
+        with self._lock:
+            if '$skiptoken' in query:
+                since, upto, offset, top = (int(v) for v in query['$skiptoken'][0].split('.'))
+            else:
+                since = int(query['$deltatoken'][0]) if '$deltatoken' in query else -1
+                upto, offset = self.sequence, 0
+                top = int(query.get('$top', [self.delta_page_size])[0])
+            if since >= 0 and since < self.expired_before:
+                return 410, {'error': {'code': 'resyncRequired',
+                                       'message': 'The delta token has expired'}}
+            if since < 0:
+                items = [public_user(user) for user in self.users]
+            else:
+                items = [public_user(self.by_key[user_id])
+                         for user_id, seq in sorted(self.changed_at.items(), key=lambda kv: kv[1])
+                         if since < seq <= upto]
+                items += [{'id': user_id, '@removed': {'reason': 'deleted'}}
+                          for user_id, seq in self.removed.items() if since < seq <= upto]
+        page = {'@odata.context': f"{self.graph_url}/$metadata#users(id,userPrincipalName,displayName,mail)",
+                'value': items[offset:offset + top]}
+        if offset + top < len(items):
+            page['@odata.nextLink'] = (f"{self.graph_url}/users/delta"
+                                       f"?$skiptoken={since}.{upto}.{offset + top}.{top}")
+        else:
+            page['@odata.deltaLink'] = f"{self.graph_url}/users/delta?$deltatoken={upto}"
+        return 200, page
+
+    def blob_bytes(self, blob_name):
+        with self._lock:
+            body = self._blob_cache.get(blob_name)
+        if body is None:
+            path = self.blob_files.get(blob_name)
+            body = path.read_bytes() if path and path.exists() else generated_jpeg(blob_name)
+            with self._lock:
+                self._blob_cache[blob_name] = body
+        return body
+
+    def handle(self, path):
+        """Return (status, content type, body) for a GET path"""
+        with self._lock:
+            self.requests_served += 1
+        url = urlsplit(path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/')]
+
+        if parts[:2] == ['graph', 'v1.0']:
+            time.sleep(self.graph_latency_ms / 1000)
+            if parts[2:] == ['users', 'delta']:
+                status, body = self.delta_page(parse_qs(url.query))
+                return status, 'application/json', json.dumps(body).encode()
+            if parts[2:] == ['me'] and self.users:
+                return 200, 'application/json', json.dumps(public_user(self.users[0])).encode()
+            if len(parts) == 4 and parts[2] == 'users':
+                user = self.by_key.get(parts[3].lower())
+                if user is not None:
+                    return 200, 'application/json', json.dumps(public_user(user)).encode()
+            error = {'error': {'code': 'Request_ResourceNotFound', 'message': 'Not found'}}
+            return 404, 'application/json', json.dumps(error).encode()
+
+        if parts[:1] == ['blob'] and len(parts) >= 3:
+            time.sleep(self.blob_latency_ms / 1000)
+            return 200, 'image/jpeg', self.blob_bytes(parts[-1])
+
+        return 404, 'text/plain', b'Not found'
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, content_type, body = standin.handle(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Graph/blob stand-in server")
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--graph-latency-ms', type=float, default=0.0)
+    parser.add_argument('--blob-latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StandinServer(args.port, graph_latency_ms=args.graph_latency_ms,
+                           blob_latency_ms=args.blob_latency_ms).start()
+    print(f"Stand-ins for {len(server.users)} users at {server.base_url}")
+    print(f"  GRAPH_API_ENDPOINT={server.graph_url}")
+    print(f"  blobs:  {server.base_url}/blob/<container>/<blob name>")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
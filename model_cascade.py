@@ -0,0 +1,271 @@
+"""
+Confidence-gated model cascade for the classifier API
+
+A small fast model (the 4-block CNN from create_model, or the distilled
+student) answers first. Only when its top-class confidence is below a
+calibrated threshold does the request escalate to the full ResNet50.
+
+Calibration runs both models on the held-out split of the packed dataset
+and picks the lowest threshold whose cascade accuracy stays within
+--max-accuracy-drop of the full model alone. The result is written to
+models/cascade.json, which classifier_api.py reads when CASCADE_MODE=on:
+
+    python model_cascade.py calibrate --fast models/profile_classifier.keras \\
+        --full models/resnet50_profilepic_classifier.keras
+    python model_cascade.py show
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+BASE_DIR = Path(__file__).parent
+CASCADE_CONFIG = BASE_DIR / "models" / "cascade.json"
+DEFAULT_FAST_MODEL = BASE_DIR / "models" / "profile_classifier.keras"
+DEFAULT_FULL_MODEL = BASE_DIR / "models" / "resnet50_profilepic_classifier.keras"
+
+THRESHOLDS = np.round(np.arange(0.34, 1.0, 0.01), 2)
+
+
+def _fit_input(model, batch):
+    """Resize a float batch to the model's input resolution if needed"""
+    input_size = tuple(model.input_shape[1:3])
+    if tuple(batch.shape[1:3]) != input_size:
+        batch = tf.image.resize(batch, input_size).numpy()
+    return batch
+
+
+def load_cascade_config(path=CASCADE_CONFIG):
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class CascadeStats:
+    """Escalation rate and latency saving of a serving cascade"""
+
+    def __init__(self, expected_full_ms=None):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.answered = {'fast': 0, 'full': 0}
+        self.fast_ms = 0.0
+        self.full_ms = 0.0
+        self.expected_full_ms = expected_full_ms
+
+    def observe(self, stage, fast_ms, full_ms=0.0):
+        with self._lock:
+            self.requests += 1
+            self.answered[stage] += 1
+            self.fast_ms += fast_ms
+            self.full_ms += full_ms
+
+    def snapshot(self):
+        with self._lock:
+            requests, answered = self.requests, dict(self.answered)
+            fast_ms, full_ms = self.fast_ms, self.full_ms
+        # Baseline: the full model on every request. Measured on escalations,
+        # else the latency recorded at calibration time.
+        full_mean = full_ms / answered['full'] if answered['full'] else self.expected_full_ms
+        mean_ms = (fast_ms + full_ms) / requests if requests else None
+        saving = (full_mean - mean_ms) if full_mean is not None and mean_ms is not None else None
+        return {
+            'requests': requests,
+            'answered_by': answered,
+            'escalation_rate': round(answered['full'] / requests, 4) if requests else None,
+            'mean_fast_ms': round(fast_ms / requests, 2) if requests else None,
+            'mean_full_ms': round(full_mean, 2) if full_mean is not None else None,
+            'mean_latency_ms': round(mean_ms, 2) if mean_ms is not None else None,
+            'mean_saving_ms': round(saving, 2) if saving is not None else None,
+        }
+
+
+class Cascade:
+    """
+    Two-stage predictor
+
+    Args:
+        fast_model / full_model: loaded Keras models with the same classes
+        threshold: minimum top-class confidence for the fast answer
+    """
+
+    def __init__(self, fast_model, full_model, threshold, expected_full_ms=None):
+        self.fast_model = fast_model
+        self.full_model = full_model
+        self.threshold = threshold
+        self.stats = CascadeStats(expected_full_ms)
+
+    def predict(self, img_array, record_stage=None):
+        """
+        Returns:
+            (probabilities for the first image, stage that answered: 'fast' or 'full')
+        """
+        probabilities, stages = self.predict_batch(img_array[:1], record_stage)
+        return probabilities[0], stages[0]
+
+    def predict_batch(self, batch, record_stage=None):
+        """
+        Fast model on the whole batch; only the unsure images go to the full model
+
+        Returns:
+            (probabilities [N, classes], list of stages that answered)
+        """
+        started = time.perf_counter()
+        probabilities = np.array(self.fast_model.predict_on_batch(_fit_input(self.fast_model, batch)))
+        fast_ms = (time.perf_counter() - started) * 1000
+        if record_stage:
+            record_stage('predict_fast', fast_ms)
+        escalate = np.max(probabilities, axis=1) < self.threshold
+
+        full_ms = 0.0
+        if escalate.any():
+            started = time.perf_counter()
+            probabilities[escalate] = self.full_model.predict_on_batch(
+                _fit_input(self.full_model, batch[escalate]))
+            full_ms = (time.perf_counter() - started) * 1000
+            if record_stage:
+                record_stage('predict_full', full_ms)
+
+        # Per-image share of the batch latency
+        count, escalated = len(batch), int(escalate.sum())
+        for needs_full in escalate:
+            if needs_full:
+                self.stats.observe('full', fast_ms / count, full_ms / escalated)
+            else:
+                self.stats.observe('fast', fast_ms / count)
+        return probabilities, ['full' if needs_full else 'fast' for needs_full in escalate]
+
+
+def _predict_split(model, dataset, rows, batch_size=32):
+    probabilities, labels = [], []
+    for images, batch_labels in dataset.iter_batches(rows, batch_size):
+        batch = _fit_input(model, images.astype(np.float32) / 255.0)
+        probabilities.append(model.predict_on_batch(batch))
+        labels.append(batch_labels)
+    return np.concatenate(probabilities), np.concatenate(labels)
+
+
+def sweep_thresholds(fast_probs, full_probs, labels, thresholds=THRESHOLDS):
+    """Cascade accuracy and escalation rate at every candidate threshold"""
+    fast_pred = np.argmax(fast_probs, axis=1)
+    full_pred = np.argmax(full_probs, axis=1)
+    confidence = np.max(fast_probs, axis=1)
+    rows = []
+    for threshold in thresholds:
+        escalate = confidence < threshold
+        predicted = np.where(escalate, full_pred, fast_pred)
+        rows.append({
+            'threshold': float(threshold),
+            'accuracy': round(float(np.mean(predicted == labels)), 4),
+            'escalation_rate': round(float(np.mean(escalate)), 4),
+        })
+    return rows
+
+
+def calibrate(fast_path, full_path, dataset, rows, max_accuracy_drop=0.01, runs=50,
+              output_path=CASCADE_CONFIG):
+    """
+    Pick the threshold and write the cascade config
+
+    Returns:
+        the config dict (also written to output_path)
+    """
+    from evaluate_model import measure_latency
+
+    fast_model = keras.models.load_model(fast_path)
+    full_model = keras.models.load_model(full_path)
+    fast_probs, labels = _predict_split(fast_model, dataset, rows)
+    full_probs, _ = _predict_split(full_model, dataset, rows)
+
+    fast_accuracy = float(np.mean(np.argmax(fast_probs, axis=1) == labels))
+    full_accuracy = float(np.mean(np.argmax(full_probs, axis=1) == labels))
+    sweep = sweep_thresholds(fast_probs, full_probs, labels)
+    # Lowest threshold (fewest escalations) that keeps accuracy; if none
+    # does, escalate everything the fast model is not certain about
+    acceptable = [r for r in sweep if r['accuracy'] >= full_accuracy - max_accuracy_drop]
+    chosen = acceptable[0] if acceptable else sweep[-1]
+
+    fast_ms = measure_latency(fast_model, runs)['mean_ms']
+    full_ms = measure_latency(full_model, runs)['mean_ms']
+    expected_ms = fast_ms + chosen['escalation_rate'] * full_ms
+
+    config = {
+        'fast_model': str(fast_path),
+        'full_model': str(full_path),
+        'threshold': chosen['threshold'],
+        'validation_images': int(len(labels)),
+        'fast_accuracy': round(fast_accuracy, 4),
+        'full_accuracy': round(full_accuracy, 4),
+        'cascade_accuracy': chosen['accuracy'],
+        'escalation_rate': chosen['escalation_rate'],
+        'fast_ms': fast_ms,
+        'full_ms': full_ms,
+        'expected_ms': round(expected_ms, 2),
+        'expected_saving_ms': round(full_ms - expected_ms, 2),
+        'max_accuracy_drop': max_accuracy_drop,
+        'calibrated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'sweep': sweep,
+    }
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+    return config
+
+
+def print_config(config):
+    print(f"Fast model:  {config['fast_model']} (acc {config['fast_accuracy']:.3f}, "
+          f"{config['fast_ms']:.1f} ms)")
+    print(f"Full model:  {config['full_model']} (acc {config['full_accuracy']:.3f}, "
+          f"{config['full_ms']:.1f} ms)")
+    print(f"Threshold:   {config['threshold']:.2f} on {config['validation_images']} images")
+    print(f"Cascade:     acc {config['cascade_accuracy']:.3f}, "
+          f"escalation rate {config['escalation_rate']:.1%}, "
+          f"expected {config['expected_ms']:.1f} ms "
+          f"(saving {config['expected_saving_ms']:.1f} ms per request)")
+    if config['expected_saving_ms'] <= 0:
+        print("WARNING: the cascade is not faster than the full model alone; leave CASCADE_MODE off")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the fast/full model cascade")
+    sub = parser.add_subparsers(dest='command', required=True)
+    cal = sub.add_parser('calibrate', help="Pick the confidence threshold on the validation split")
+    cal.add_argument('--fast', default=str(DEFAULT_FAST_MODEL), help="Fast first-stage model")
+    cal.add_argument('--full', default=str(DEFAULT_FULL_MODEL), help="Full (ResNet50) model")
+    cal.add_argument('--dataset', default=None, help="Packed dataset directory")
+    cal.add_argument('--size', type=int, default=128)
+    cal.add_argument('--max-accuracy-drop', type=float, default=0.01,
+                     help="Allowed accuracy loss vs. the full model alone")
+    cal.add_argument('--runs', type=int, default=50, help="Latency measurement runs")
+    cal.add_argument('--output', default=str(CASCADE_CONFIG))
+    sub.add_parser('show', help="Print the current calibration")
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        config = load_cascade_config()
+        if config is None:
+            print(f"No cascade calibration at {CASCADE_CONFIG}")
+        else:
+            print_config(config)
+        return
+
+    from packed_dataset import PackedDataset, default_dataset_dir
+
+    dataset = PackedDataset(args.dataset or default_dataset_dir(args.size))
+    _, val_rows = dataset.split()
+    config = calibrate(args.fast, args.full, dataset, val_rows, args.max_accuracy_drop,
+                       args.runs, args.output)
+    print_config(config)
+    print(f"\nWrote {args.output}; serve with CASCADE_MODE=on")
+
+
+if __name__ == "__main__":
+    main()
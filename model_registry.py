@@ -0,0 +1,124 @@
+"""
+Minimal model registry
+
+Keeps models/registry.json with every registered model artifact, its
+metrics and which version is current. classifier_api.load_model serves the
+current version when MODEL_PATH is not set.
+
+Usage:
+    python model_registry.py list
+    python model_registry.py promote <version>
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent
+REGISTRY_PATH = BASE_DIR / "models" / "registry.json"
+
+
+def load_registry(registry_path=REGISTRY_PATH):
+    """Return the registry contents (empty registry if the file is missing)"""
+    registry_path = Path(registry_path)
+    if not registry_path.exists():
+        return {'current': None, 'models': []}
+    with open(registry_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_registry(registry, registry_path=REGISTRY_PATH):
+    registry_path = Path(registry_path)
+    registry_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = registry_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(registry, f, indent=2)
+    tmp_path.replace(registry_path)
+
+
+def register_model(model_path, metrics=None, source=None, make_current=True,
+                   dataset=None, registry_path=REGISTRY_PATH):
+    """
+    Register a model artifact
+
+    Args:
+        model_path: path to the .keras file (stored relative to the repo when possible)
+        metrics: dict of evaluation metrics to keep with the entry
+        source: short description of how the artifact was produced
+        make_current: serve this version from now on
+        dataset: optional description of the training data the model has seen
+            (used by incremental_training.py to find new images)
+
+    Returns:
+        The new version number
+    """
+    registry = load_registry(registry_path)
+    version = max((m['version'] for m in registry['models']), default=0) + 1
+    model_path = Path(model_path).resolve()
+    try:
+        stored_path = model_path.relative_to(BASE_DIR.resolve()).as_posix()
+    except ValueError:
+        stored_path = str(model_path)
+
+    registry['models'].append({
+        'version': version,
+        'path': stored_path,
+        'source': source,
+        'metrics': metrics or {},
+        'dataset': dataset,
+        'registered_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    if make_current:
+        registry['current'] = version
+    _save_registry(registry, registry_path)
+    return version
+
+
+def get_model(version=None, registry_path=REGISTRY_PATH):
+    """Return the registry entry for `version` (default: current), or None"""
+    registry = load_registry(registry_path)
+    version = registry['current'] if version is None else version
+    for entry in registry['models']:
+        if entry['version'] == version:
+            return entry
+    return None
+
+
+def current_model_path(registry_path=REGISTRY_PATH):
+    """Absolute path of the current registered model, or None"""
+    entry = get_model(registry_path=registry_path)
+    if entry is None:
+        return None
+    path = Path(entry['path'])
+    return str(path if path.is_absolute() else BASE_DIR / path)
+
+
+def promote(version, registry_path=REGISTRY_PATH):
+    """Make an already registered version current"""
+    if get_model(version, registry_path) is None:
+        raise ValueError(f"Unknown model version: {version}")
+    registry = load_registry(registry_path)
+    registry['current'] = version
+    _save_registry(registry, registry_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or update the model registry")
+    parser.add_argument('command', choices=['list', 'promote'])
+    parser.add_argument('version', nargs='?', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'promote':
+        promote(args.version)
+        print(f"✓ Version {args.version} is now current")
+
+    registry = load_registry()
+    for entry in registry['models']:
+        marker = '*' if entry['version'] == registry['current'] else ' '
+        accuracy = entry['metrics'].get('accuracy')
+        print(f"{marker} v{entry['version']:<3d} {entry['path']:55s} "
+              f"acc={accuracy if accuracy is not None else '-'}  {entry['source'] or ''}")
+
+
+if __name__ == "__main__":
+    main()
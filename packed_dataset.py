@@ -0,0 +1,259 @@
+"""
+Packed, memory-mapped image dataset for training and evaluation
+
+Decodes the JPEG/PNG files under scripts/test_images/{animal,avatar,human}
+once, resizes them to a fixed resolution and packs them into a single
+uint8 array file (N x H x W x 3) plus a JSON index with labels, source
+paths and content hashes. Readers memory-map the array, so slicing it is
+zero-copy and epoch 1 is as fast as epoch 10.
+
+Usage:
+    python packed_dataset.py build                 # build or append new images
+    python packed_dataset.py build --size 224      # different resolution
+    python packed_dataset.py info                  # show dataset summary
+"""
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+BASE_DIR = Path(__file__).parent
+DATA_DIR = BASE_DIR / "scripts" / "test_images"
+DATASETS_DIR = BASE_DIR / "datasets"
+
+# Class mapping (must match classifier_api.py)
+CLASS_NAMES = ['animal', 'avatar', 'human']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+IMAGES_FILE = 'images.u8'
+INDEX_FILE = 'index.json'
+
+# The index is saved after this many appended images, so an interrupted
+# build keeps its progress
+CHECKPOINT_EVERY = 256
+
+
+def default_dataset_dir(size):
+    """Default location of the packed dataset for a given square resolution"""
+    return DATASETS_DIR / f"profilepics_{size}"
+
+
+def file_sha1(path):
+    """Content hash used to detect new or changed images"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decode_image(path, size):
+    """Decode and resize one image exactly like classifier_api.preprocess_image"""
+    with Image.open(path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img = img.resize((size, size), Image.LANCZOS)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def scan_images(data_dir=DATA_DIR):
+    """Return (path, label) for every image in the class directories, sorted"""
+    found = []
+    for class_idx, class_name in enumerate(CLASS_NAMES):
+        class_dir = Path(data_dir) / class_name
+        if not class_dir.exists():
+            continue
+        for path in sorted(class_dir.iterdir()):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                found.append((path, class_idx))
+    return found
+
+
+def _load_index(dataset_dir):
+    index_path = Path(dataset_dir) / INDEX_FILE
+    if not index_path.exists():
+        return None
+    with open(index_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_index(dataset_dir, index):
+    index_path = Path(dataset_dir) / INDEX_FILE
+    tmp_path = index_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    tmp_path.replace(index_path)
+
+
+def build_packed_dataset(data_dir=DATA_DIR, dataset_dir=None, size=128):
+    """
+    Build the packed dataset, or append images that are new since the last build
+
+    Images are identified by content hash: unchanged files are skipped, new
+    files are decoded and appended to the array file, and files whose content
+    changed get a new row while their old row is marked stale.
+
+    Returns:
+        Number of images appended
+    """
+    dataset_dir = Path(dataset_dir or default_dataset_dir(size))
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    index = _load_index(dataset_dir)
+    if index is None:
+        index = {'class_names': CLASS_NAMES, 'size': size, 'records': []}
+    elif index['size'] != size:
+        raise ValueError(f"{dataset_dir} was packed at {index['size']}px, not {size}px")
+
+    known_hashes = {r['sha1'] for r in index['records'] if not r.get('stale')}
+    by_path = {r['path']: r for r in index['records'] if not r.get('stale')}
+
+    appended = 0
+    images_path = dataset_dir / IMAGES_FILE
+    images_path.touch()
+    with open(images_path, 'r+b') as images_file:
+        # Bytes past the last indexed row come from an interrupted build;
+        # drop them so new rows line up with their index entries
+        images_file.truncate(len(index['records']) * size * size * 3)
+        images_file.seek(0, os.SEEK_END)
+        for path, label in scan_images(data_dir):
+            rel_path = path.relative_to(data_dir).as_posix()
+            sha1 = file_sha1(path)
+            if sha1 in known_hashes:
+                continue
+            try:
+                pixels = decode_image(path, size)
+            except Exception as e:
+                print(f"  Skipping {rel_path}: {e}")
+                continue
+
+            previous = by_path.get(rel_path)
+            if previous is not None:
+                previous['stale'] = True
+
+            images_file.write(pixels.tobytes())
+            record = {
+                'row': len(index['records']),
+                'path': rel_path,
+                'sha1': sha1,
+                'label': label,
+            }
+            index['records'].append(record)
+            by_path[rel_path] = record
+            known_hashes.add(sha1)
+            appended += 1
+            if appended % CHECKPOINT_EVERY == 0:
+                _checkpoint(images_file, dataset_dir, index)
+
+        _checkpoint(images_file, dataset_dir, index)
+    return appended
+
+
+def _checkpoint(images_file, dataset_dir, index):
+    """Save the index once the rows it references are on disk"""
+    images_file.flush()
+    os.fsync(images_file.fileno())
+    index['count'] = len(index['records'])
+    _save_index(dataset_dir, index)
+
+
+class PackedDataset:
+    """
+    Read-only view of a packed dataset
+
+    `images` is a numpy memmap of shape (N, H, W, 3) uint8; slicing it with
+    contiguous ranges does not copy. Stale rows (images whose content
+    changed) are excluded from `rows`.
+    """
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = Path(dataset_dir)
+        index = _load_index(self.dataset_dir)
+        if index is None:
+            raise FileNotFoundError(
+                f"No packed dataset at {self.dataset_dir}. Run: python packed_dataset.py build")
+        self.class_names = index['class_names']
+        self.size = index['size']
+        self.records = index['records']
+        self.images = np.memmap(self.dataset_dir / IMAGES_FILE, dtype=np.uint8, mode='r',
+                                shape=(len(self.records), self.size, self.size, 3))
+        self.labels = np.array([r['label'] for r in self.records], dtype=np.int64)
+        self.rows = np.array([r['row'] for r in self.records if not r.get('stale')],
+                             dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def split(self, validation_split=0.2, seed=42):
+        """
+        Deterministic, stratified train/validation split
+
+        Returns:
+            (train_rows, val_rows) sorted arrays of row numbers
+        """
+        rng = np.random.default_rng(seed)
+        train, val = [], []
+        for class_idx in range(len(self.class_names)):
+            rows = self.rows[self.labels[self.rows] == class_idx]
+            rng.shuffle(rows)
+            n_val = int(round(len(rows) * validation_split))
+            val.extend(rows[len(rows) - n_val:])
+            train.extend(rows[:len(rows) - n_val])
+        return np.sort(np.array(train, dtype=np.int64)), np.sort(np.array(val, dtype=np.int64))
+
+    def iter_batches(self, rows, batch_size, shuffle=False, seed=None):
+        """
+        Yield (images uint8, labels) batches for the given rows
+
+        Rows within each batch are sorted so reads from the memmap stay
+        sequential; consecutive rows are returned as zero-copy slices.
+        """
+        rows = np.asarray(rows)
+        if shuffle:
+            rows = np.random.default_rng(seed).permutation(rows)
+        for start in range(0, len(rows), batch_size):
+            batch_rows = np.sort(rows[start:start + batch_size])
+            first, last = batch_rows[0], batch_rows[-1]
+            if last - first + 1 == len(batch_rows):
+                images = self.images[first:last + 1]
+            else:
+                images = self.images[batch_rows]
+            yield images, self.labels[batch_rows]
+
+    def summary(self):
+        counts = np.bincount(self.labels[self.rows], minlength=len(self.class_names))
+        return {
+            'path': str(self.dataset_dir),
+            'size': self.size,
+            'images': len(self),
+            'stale_rows': len(self.records) - len(self),
+            'bytes': int(self.images.nbytes),
+            'per_class': dict(zip(self.class_names, counts.tolist())),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect the packed image dataset")
+    parser.add_argument('command', choices=['build', 'info'])
+    parser.add_argument('--data-dir', default=str(DATA_DIR), help="Source image directory")
+    parser.add_argument('--output', default=None, help="Packed dataset directory")
+    parser.add_argument('--size', type=int, default=128, help="Square image resolution")
+    args = parser.parse_args()
+
+    dataset_dir = Path(args.output) if args.output else default_dataset_dir(args.size)
+
+    if args.command == 'build':
+        print(f"Packing images from {args.data_dir} into {dataset_dir} at {args.size}px...")
+        appended = build_packed_dataset(Path(args.data_dir), dataset_dir, args.size)
+        print(f"✓ Appended {appended} new image(s)")
+
+    summary = PackedDataset(dataset_dir).summary()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
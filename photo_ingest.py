@@ -0,0 +1,315 @@
+"""
+Streaming ingestion of uploaded profile photos.
+
+PhotoIngestor takes a raw request body and turns it into a stored photo
+plus a new row in the upload map:
+
+1. The body is streamed to a spool file in fixed-size chunks; it is never
+   held in memory as a whole. Uploads with a Content-Length over the limit
+   are refused before reading, and the first bytes must carry a JPEG, PNG,
+   GIF or WebP signature, so oversized or non-image bodies are rejected
+   after at most one chunk.
+2. The photo is decoded once (within the pixel and decode-memory budgets
+   of image_decode.py), rotated per its EXIF orientation, converted
+   to RGB and resized into the canonical rendition (JPEG, longest side
+   PHOTO_MAX_SIDE). Its name is derived from the content hash, so
+   re-uploading the same photo is idempotent.
+3. The rendition goes to the photo store: a local directory (the stand-in
+   for blob storage, served by the web app under /uploads/) or the blob
+   container named by PHOTO_STORE_SAS_URL.
+4. One row is appended to profile_upload_map.csv; the file is never
+   rewritten. Later rows for the same user win when the map is loaded.
+
+Classification is queued by the caller (ClassificationJob.submit).
+"""
+import csv
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import requests
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from http_clients import get_client
+from image_decode import DecodeBusy, decode_budget, decoded_bytes, draft_for, open_checked
+
+CHUNK_SIZE = 64 * 1024
+
+# Columns of profile_upload_map.csv, in file order
+MAPPING_FIELDS = ['UserPrincipalName', 'DisplayName', 'ImageFileName', 'BlobName',
+                  'BlobUrl', 'Category', 'UploadDate']
+
+CATEGORIES = ('animal', 'avatar', 'human')
+
+
+class UploadRejected(Exception):
+    """The upload was refused; status_code is the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_image_type(head):
+    """Image format from the leading bytes, or None if not a supported image"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def spool_upload(stream, spool_dir, max_bytes, content_length=None):
+    """
+    Stream a request body into a temporary file
+
+    Returns:
+        (path, size in bytes, image format)
+
+    Raises:
+        UploadRejected: too large (413), empty or not an image (415)
+    """
+    if content_length is not None and content_length > max_bytes:
+        raise UploadRejected(f"Photo larger than {max_bytes} bytes", 413)
+
+    os.makedirs(spool_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix='upload_', suffix='.part', dir=spool_dir)
+    size, kind = 0, None
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            head = b''
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(f"Photo larger than {max_bytes} bytes", 413)
+                if kind is None:
+                    head += chunk
+                    if len(head) >= 12:
+                        kind = sniff_image_type(head)
+                        if kind is None:
+                            raise UploadRejected("Not a JPEG, PNG, GIF or WebP image", 415)
+                f.write(chunk)
+        if kind is None:
+            kind = sniff_image_type(head) if head else None
+            if kind is None:
+                raise UploadRejected("Not a JPEG, PNG, GIF or WebP image", 415)
+        return path, size, kind
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def normalize_photo(path, max_side=512, quality=85):
+    """Canonical rendition: upright RGB JPEG no larger than max_side, metadata stripped"""
+    try:
+        img = open_checked(path)
+    except ValueError as e:
+        raise UploadRejected(str(e), 413)
+    except (UnidentifiedImageError, OSError):
+        raise UploadRejected("Could not decode photo", 415)
+    try:
+        with img:
+            draft_for(img, (max_side, max_side))
+            with decode_budget.reserve(decoded_bytes(img)):
+                img = ImageOps.exif_transpose(img)
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                img.thumbnail((max_side, max_side), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    except DecodeBusy as e:
+        raise UploadRejected(str(e), 503)
+    except (UnidentifiedImageError, OSError, ValueError):
+        raise UploadRejected("Could not decode photo", 415)
+    return buffer.getvalue()
+
+
+class LocalPhotoStore:
+    """
+    Directory standing in for the blob container
+
+    Args:
+        root: directory the renditions are written to
+        base_url: URL prefix the directory is served under (must be reachable
+            by the classifier API, which downloads photos by URL)
+    """
+
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, name, data):
+        path = os.path.join(self.root, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return f"{self.base_url}/{quote(name)}"
+
+
+class BlobPhotoStore:
+    """
+    Azure blob container addressed by a container SAS URL
+    (https://<account>.blob.core.windows.net/<container>?<sas token>)
+    """
+
+    def __init__(self, container_sas_url):
+        parts = urlsplit(container_sas_url)
+        self._container = parts._replace(query='').geturl().rstrip('/')
+        self._parts = parts
+
+    def put(self, name, data):
+        path = f"{self._parts.path.rstrip('/')}/{quote(name)}"
+        upload_url = urlunsplit(self._parts._replace(path=path))
+        try:
+            response = get_client('blob').request('PUT', upload_url, data=data, headers={
+                'x-ms-blob-type': 'BlockBlob',
+                'Content-Type': 'image/jpeg',
+            })
+        except requests.RequestException as e:
+            # Includes an open circuit and a full bulkhead on the blob client
+            raise UploadRejected(f"Blob storage unavailable: {e}", 503)
+        if response.status_code not in (200, 201):
+            raise UploadRejected(f"Blob storage answered HTTP {response.status_code}", 502)
+        return f"{self._container}/{quote(name)}"
+
+
+class MappingAppender:
+    """Appends rows to the upload map CSV (header written if the file is new)"""
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self._lock = threading.Lock()
+
+    def append(self, row):
+        with self._lock:
+            new_file = not os.path.exists(self.csv_path) or os.path.getsize(self.csv_path) == 0
+            needs_newline = not new_file and not self._ends_with_newline()
+            with open(self.csv_path, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=MAPPING_FIELDS, quoting=csv.QUOTE_ALL,
+                                        lineterminator='\n')
+                if new_file:
+                    writer.writeheader()
+                elif needs_newline:
+                    f.write('\n')
+                writer.writerow(row)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _ends_with_newline(self):
+        with open(self.csv_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+
+class PhotoIngestor:
+    """
+    Streams, validates, normalizes and stores uploaded photos
+
+    Args:
+        store: LocalPhotoStore or BlobPhotoStore
+        mapping: MappingAppender for the upload map
+        spool_dir: where request bodies are streamed to
+        max_bytes: largest accepted upload
+        max_side: longest side of the stored rendition
+    """
+
+    def __init__(self, store, mapping, spool_dir, max_bytes=10 * 1024 * 1024, max_side=512):
+        self.store = store
+        self.mapping = mapping
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self._lock = threading.Lock()
+        self.counters = {'accepted': 0, 'rejected': 0, 'bytes_received': 0, 'bytes_stored': 0}
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.counters[name] += amount
+
+    def ingest(self, upn, stream, content_length=None, display_name=None, file_name=None,
+               category=None, current=None):
+        """
+        Store one uploaded photo and append its upload map row
+
+        Later rows replace earlier ones, so a display name or category that
+        is not given is kept from `current`, the user's current entry
+        (displayName/category keys).
+
+        Returns:
+            the appended row (MAPPING_FIELDS keys)
+
+        Raises:
+            UploadRejected
+        """
+        if category is not None and category not in CATEGORIES:
+            raise UploadRejected(f"Unknown category {category!r}; use one of {CATEGORIES}")
+        try:
+            path, size, _ = spool_upload(stream, self.spool_dir, self.max_bytes, content_length)
+        except UploadRejected:
+            self._count(rejected=1)
+            raise
+        try:
+            rendition = normalize_photo(path, self.max_side)
+        except UploadRejected:
+            self._count(rejected=1)
+            raise
+        finally:
+            os.remove(path)
+
+        blob_name = f"profile_{hashlib.sha1(rendition).hexdigest()[:16]}.jpg"
+        try:
+            blob_url = self.store.put(blob_name, rendition)
+        except UploadRejected:
+            self._count(rejected=1)
+            raise
+        current = current or {}
+        if category is None and current.get('category') in CATEGORIES:
+            category = current['category']
+        row = {
+            'UserPrincipalName': upn,
+            'DisplayName': (_safe_display_name(display_name) or current.get('displayName')
+                            or upn.split('@')[0]),
+            'ImageFileName': _safe_file_name(file_name) or blob_name,
+            'BlobName': blob_name,
+            'BlobUrl': blob_url,
+            'Category': category or 'unknown',
+            'UploadDate': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.mapping.append(row)
+        self._count(accepted=1, bytes_received=size, bytes_stored=len(rendition))
+        return row
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def _safe_display_name(name):
+    # No control characters, and no leading characters a spreadsheet would
+    # read as the start of a formula
+    if not name:
+        return None
+    name = ' '.join(re.sub(r'[\x00-\x1f\x7f]', ' ', name).split())[:256]
+    return name.lstrip('=+-@ ') or None
+
+
+def _safe_file_name(name):
+    if not name:
+        return None
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(name))[:100]
+    return name or None
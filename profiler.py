@@ -0,0 +1,304 @@
+"""
+On-demand sampling profiler for the Flask services.
+
+install_profiler(app, service) adds an admin-only profiling surface:
+
+    GET /admin/profile?seconds=10&interval_ms=5
+        Start sampling every thread's Python stack for N seconds in the
+        background; answers 202 with a session id right away.
+    GET /admin/profile/sessions/<id>
+        202 while that session is still sampling, then its result as
+        collapsed stacks ("frame;frame;frame count" per line), the input
+        format of flamegraph.pl / speedscope.
+    GET /admin/profile/requests/<id>
+        Collapsed stacks of one request that opted in with the
+        `X-Profile: 1` header (its response carries the X-Profile-Id).
+    GET /admin/profile/slow-routes
+        Routes ranked by total time, with p50/p95/max latency.
+
+Sampling uses sys._current_frames() from a background thread, so handlers
+are not instrumented and run at full speed between samples. All endpoints
+(and the X-Profile header) require PROFILER_ADMIN_TOKEN in the X-Admin-Token
+header; without that environment variable the surface is disabled.
+PROFILER_DUMP_INTERVAL (seconds) also prints the slowest routes periodically.
+
+A profiling session never holds a request handler: the classifier runs as a
+single synchronous gunicorn worker, so a handler that waited for the samples
+would block every other request and the profile would show nothing but the
+profiler. Requests served while a session runs are sampled as usual; start
+the session, send the traffic you want to see, then fetch the result.
+"""
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+
+from flask import Response, abort, g, jsonify, request
+
+# Limits that keep profiling cheap under load
+MAX_PROFILE_SECONDS = 60
+MAX_CONCURRENT_REQUEST_PROFILES = 4
+KEPT_REQUEST_PROFILES = 50
+KEPT_SESSION_PROFILES = 10
+ROUTE_SAMPLES = 500
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _collapse(frame):
+    """Root-to-leaf 'file:function' frames joined with ';'"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def collapsed_text(counts):
+    """Collapsed stacks, heaviest first"""
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+class StackSampler:
+    """
+    Background thread sampling Python stacks at a fixed interval
+
+    Args:
+        interval: seconds between samples
+        thread_id: only sample this thread (default: every thread except
+            the sampler itself); stacks are prefixed with the thread name
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frames = {self.thread_id: frames.get(self.thread_id)}
+            for thread_id, frame in frames.items():
+                if thread_id == own_id or frame is None:
+                    continue
+                self.counts[f"{names.get(thread_id, thread_id)};{_collapse(frame)}"] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+
+class RouteTimings:
+    """Recent latency per route, for ranking slow routes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=ROUTE_SAMPLES))
+        self._totals = defaultdict(lambda: [0, 0.0])
+
+    def observe(self, route, elapsed_ms):
+        with self._lock:
+            self._durations[route].append(elapsed_ms)
+            self._totals[route][0] += 1
+            self._totals[route][1] += elapsed_ms
+
+    def top(self, limit=10):
+        with self._lock:
+            snapshot = {route: (sorted(d), list(self._totals[route]))
+                        for route, d in self._durations.items()}
+        rows = []
+        for route, (durations, (count, total_ms)) in snapshot.items():
+            pick = lambda q: round(durations[min(len(durations) - 1, int(q * len(durations)))], 1)
+            rows.append({'route': route, 'count': count, 'total_ms': round(total_ms, 1),
+                         'p50_ms': pick(0.50), 'p95_ms': pick(0.95),
+                         'max_ms': round(durations[-1], 1)})
+        rows.sort(key=lambda r: r['total_ms'], reverse=True)
+        return rows[:limit]
+
+
+def _periodic_dump(service, timings, interval, limit=5):
+    while True:
+        time.sleep(interval)
+        rows = timings.top(limit)
+        if not rows:
+            continue
+        print(f"[profiler] {service}: slowest routes (by total time)")
+        for r in rows:
+            print(f"[profiler]   {r['route']:40s} n={r['count']:<6d} p50={r['p50_ms']:>8.1f}ms "
+                  f"p95={r['p95_ms']:>8.1f}ms max={r['max_ms']:>8.1f}ms")
+
+
+def install_profiler(app, service, admin_token=None):
+    """
+    Register the profiling endpoints and hooks on `app`
+
+    Returns:
+        RouteTimings (also used by the periodic dump), or None if disabled
+    """
+    admin_token = admin_token or os.getenv('PROFILER_ADMIN_TOKEN')
+    if not admin_token:
+        return None
+
+    timings = RouteTimings()
+    request_profiles = OrderedDict()
+    session_profiles = OrderedDict()
+    profile_ids = itertools.count(1)
+    session_ids = itertools.count(1)
+    profile_lock = threading.Lock()
+    session_lock = threading.Lock()
+    active = {'requests': 0}
+
+    def is_admin():
+        supplied = request.headers.get('X-Admin-Token', '')
+        return hmac.compare_digest(supplied.encode(), admin_token.encode())
+
+    def require_admin():
+        if not is_admin():
+            abort(403)
+
+    @app.before_request
+    def _start_request_profile():
+        g._profile_started = time.perf_counter()
+        if request.headers.get('X-Profile') != '1' or not is_admin():
+            return
+        with profile_lock:
+            if active['requests'] >= MAX_CONCURRENT_REQUEST_PROFILES:
+                return
+            active['requests'] += 1
+        g._profile_sampler = StackSampler(interval=0.002,
+                                          thread_id=threading.get_ident()).start()
+
+    @app.after_request
+    def _finish_request_profile(response):
+        started = g.pop('_profile_started', None)
+        if (started is not None and request.url_rule is not None
+                and not request.url_rule.rule.startswith('/admin/profile')):
+            timings.observe(f"{request.method} {request.url_rule.rule}",
+                            (time.perf_counter() - started) * 1000)
+        sampler = g.pop('_profile_sampler', None)
+        if sampler is not None:
+            counts = sampler.stop()
+            with profile_lock:
+                active['requests'] -= 1
+                profile_id = str(next(profile_ids))
+                request_profiles[profile_id] = {
+                    'route': request.url_rule.rule if request.url_rule else request.path,
+                    'counts': counts,
+                }
+                while len(request_profiles) > KEPT_REQUEST_PROFILES:
+                    request_profiles.popitem(last=False)
+            response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @app.teardown_request
+    def _release_request_profile(exc):
+        # A handler that raised skips after_request; stop its sampler here
+        sampler = g.pop('_profile_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+            with profile_lock:
+                active['requests'] -= 1
+
+    def run_session(session_id, seconds, interval):
+        sampler = None
+        try:
+            sampler = StackSampler(interval=interval).start()
+            time.sleep(seconds)
+            counts = sampler.stop()
+        except Exception as e:
+            if sampler is not None:
+                sampler.stop()
+            with profile_lock:
+                if session_id in session_profiles:
+                    session_profiles[session_id].update(state='failed', error=str(e))
+            raise
+        finally:
+            session_lock.release()
+        # This thread is only sleeping; leave it out
+        own = f"{threading.current_thread().name};"
+        counts = Counter({stack: n for stack, n in counts.items() if not stack.startswith(own)})
+        with profile_lock:
+            if session_id in session_profiles:
+                session_profiles[session_id].update(state='done', counts=counts,
+                                                    samples=sampler.samples)
+
+    @app.route('/admin/profile')
+    def admin_profile():
+        """Start sampling all threads for ?seconds=N; returns the session id."""
+        require_admin()
+        seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), MAX_PROFILE_SECONDS)
+        interval_ms = max(request.args.get('interval_ms', 5, type=float), 1.0)
+        if not session_lock.acquire(blocking=False):
+            return jsonify({'error': 'A profiling session is already running'}), 409
+        with profile_lock:
+            session_id = str(next(session_ids))
+            session_profiles[session_id] = {'state': 'running', 'seconds': seconds,
+                                            'started_at': time.time()}
+            while len(session_profiles) > KEPT_SESSION_PROFILES:
+                session_profiles.popitem(last=False)
+        threading.Thread(target=run_session, args=(session_id, seconds, interval_ms / 1000),
+                         name=f'profile-session-{session_id}', daemon=True).start()
+        return jsonify({'id': session_id, 'state': 'running', 'seconds': seconds,
+                        'result': f"/admin/profile/sessions/{session_id}"}), 202
+
+    @app.route('/admin/profile/sessions/<session_id>')
+    def admin_session_profile(session_id):
+        """Collapsed stacks of a finished profiling session."""
+        require_admin()
+        with profile_lock:
+            profile = session_profiles.get(session_id)
+            profile = dict(profile) if profile is not None else None
+        if profile is None:
+            abort(404)
+        if profile['state'] == 'failed':
+            return jsonify({'id': session_id, 'state': 'failed', 'error': profile['error']}), 500
+        if profile['state'] != 'done':
+            remaining = profile['started_at'] + profile['seconds'] - time.time()
+            return jsonify({'id': session_id, 'state': profile['state'],
+                            'remaining_seconds': round(max(remaining, 0.0), 1)}), 202
+        response = Response(collapsed_text(profile['counts']), mimetype='text/plain')
+        response.headers['X-Profile-Samples'] = str(profile['samples'])
+        return response
+
+    @app.route('/admin/profile/requests/<profile_id>')
+    def admin_request_profile(profile_id):
+        """Collapsed stacks of one opted-in request."""
+        require_admin()
+        with profile_lock:
+            profile = request_profiles.get(profile_id)
+        if profile is None:
+            abort(404)
+        response = Response(collapsed_text(profile['counts']), mimetype='text/plain')
+        response.headers['X-Profile-Route'] = profile['route']
+        return response
+
+    @app.route('/admin/profile/slow-routes')
+    def admin_slow_routes():
+        """Routes ranked by total time spent in them."""
+        require_admin()
+        return jsonify({'service': service,
+                        'routes': timings.top(request.args.get('limit', 10, type=int))})
+
+    dump_interval = float(os.getenv('PROFILER_DUMP_INTERVAL', '0'))
+    if dump_interval > 0:
+        threading.Thread(target=_periodic_dump, args=(service, timings, dump_interval),
+                         name='profiler-dump', daemon=True).start()
+    return timings
@@ -0,0 +1,327 @@
+"""
+Replay structured request logs against a local instance
+
+Reads a JSON-lines log written with REQUEST_LOG_PATH (see request_log.py),
+re-issues the requests at their original spacing (or scaled with --speed)
+and compares replayed latency with the logged latency, per route:
+
+    route                      n  orig p50  orig p95  new p50  new p95  delta p50  status diff
+
+By default the service runs in this process (Flask test clients, one per
+worker thread) with Graph and blob storage served by local_standins.py, so
+no network access or login is needed. Blob URLs in logged request bodies
+are rewritten to the stand-in. With --target the requests go over HTTP to
+an already running instance instead.
+
+The in-process instance writes its own request log next to the report, so
+per-stage timings (predict, render, upstream_graph, ...) are compared too.
+
+Usage:
+    python replay_requests.py logs/requests_classifier.jsonl
+    python replay_requests.py logs/requests_app.jsonl --speed 4 --concurrency 16
+    python replay_requests.py logs/requests_app.jsonl --speed 0      # as fast as possible
+    python replay_requests.py logs/requests_classifier.jsonl --target http://localhost:5001
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from local_standins import IMAGE_DIR, StandinServer
+
+BASE_DIR = Path(__file__).parent
+REPORTS_DIR = BASE_DIR / "logs" / "replay"
+
+SERVICE_MODULES = {'app': 'app', 'classifier': 'classifier_api'}
+
+
+def read_log(log_path, service=None, routes=None, limit=None):
+    """Logged requests (optionally filtered by service and route), oldest first"""
+    records = []
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if service and record.get('service') != service:
+                continue
+            if routes and record.get('route') not in routes:
+                continue
+            records.append(record)
+    records.sort(key=lambda r: r['ts'])
+    return records[:limit] if limit else records
+
+
+def rewrite_urls(value, standins):
+    """Point every blob URL inside a logged JSON body at the stand-in"""
+    if isinstance(value, str):
+        return standins.blob_url(value)
+    if isinstance(value, dict):
+        return {k: rewrite_urls(v, standins) for k, v in value.items()}
+    if isinstance(value, list):
+        return [rewrite_urls(v, standins) for v in value]
+    return value
+
+
+class UploadPool:
+    """Local photos used for logged file uploads, picked by closest size"""
+
+    def __init__(self, image_dir=IMAGE_DIR):
+        paths = [p for p in Path(image_dir).rglob('*')
+                 if p.suffix.lower() in ('.jpg', '.jpeg', '.png')]
+        self.files = sorted((p.stat().st_size, p) for p in paths)
+
+    def closest(self, size):
+        if not self.files:
+            return None
+        sizes = [s for s, _ in self.files]
+        index = min(int(np.searchsorted(sizes, size)), len(sizes) - 1)
+        return self.files[index][1]
+
+
+class InProcessTarget:
+    """Send requests to the service imported into this process"""
+
+    def __init__(self, service, standins, server_log):
+        os.environ['GRAPH_API_ENDPOINT'] = standins.graph_url
+        os.environ['REQUEST_LOG_PATH'] = str(server_log)
+        # Sprite builds would fetch every photo and invalidate cached pages mid-replay
+        os.environ['SPRITE_SHEETS'] = 'off'
+        os.environ.setdefault('SESSION_BACKEND', 'memory')
+        self.module = importlib.import_module(SERVICE_MODULES[service])
+        if service == 'classifier':
+            self.module.load_model()
+        self.service = service
+        self._local = threading.local()
+        self._user = standins.users[0] if standins.users else {}
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self.module.app.test_client()
+            if self.service == 'app':
+                # A signed-in session; Graph calls go to the stand-in
+                with client.session_transaction() as session:
+                    session['access_token'] = 'replay-token'
+                    session['user'] = {'userPrincipalName': self._user.get('userPrincipalName', ''),
+                                       'displayName': self._user.get('displayName', '')}
+            self._local.client = client
+        return client
+
+    def send(self, method, path, query, json_body=None, upload=None):
+        kwargs = {'query_string': query} if query else {}
+        if json_body is not None:
+            kwargs['json'] = json_body
+        if upload is not None:
+            kwargs['data'] = {'image': (io.BytesIO(upload.read_bytes()), upload.name)}
+            kwargs['content_type'] = 'multipart/form-data'
+        response = self._client().open(path, method=method, **kwargs)
+        response.close()
+        return response.status_code
+
+
+class HttpTarget:
+    """Send requests over HTTP to a running instance"""
+
+    def __init__(self, base_url, cookie=None):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self._requests = requests
+        self._local = threading.local()
+        self.cookie = cookie
+
+    def send(self, method, path, query, json_body=None, upload=None):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+            if self.cookie:
+                session.headers['Cookie'] = self.cookie
+        url = f"{self.base_url}{path}" + (f"?{query}" if query else '')
+        files = {'image': (upload.name, upload.read_bytes())} if upload is not None else None
+        response = session.request(method, url, json=json_body, files=files,
+                                   allow_redirects=False, timeout=120)
+        return response.status_code
+
+
+def replay(records, target, standins, speed=1.0, concurrency=8):
+    """
+    Re-issue logged requests on a schedule
+
+    Request i is sent (ts_i - ts_0) / speed seconds after the start (speed 0
+    sends as fast as the workers allow). Lateness - how far behind schedule
+    a request was sent - shows when the replay itself could not keep up.
+
+    Returns:
+        list of (record, result) pairs
+    """
+    uploads = UploadPool()
+    results = [None] * len(records)
+
+    def issue(i, record, scheduled):
+        body = rewrite_urls(record.get('body'), standins)
+        upload = None
+        if record['method'] == 'POST' and body is None and record.get('request_bytes'):
+            upload = uploads.closest(record['request_bytes'])
+        sent = time.perf_counter()
+        try:
+            status, error = target.send(record['method'], record['path'], record.get('query'),
+                                        body, upload), None
+        except Exception as e:
+            status, error = None, str(e)
+        results[i] = {
+            'latency_ms': round((time.perf_counter() - sent) * 1000, 3),
+            'lateness_ms': round((sent - scheduled) * 1000, 3),
+            'status': status,
+            'error': error,
+        }
+
+    t0 = records[0]['ts'] if records else 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, record in enumerate(records):
+            scheduled = started + ((record['ts'] - t0) / speed if speed else 0.0)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(issue, i, record, scheduled)
+    return list(zip(records, results))
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    return {f"p{p}": round(float(np.percentile(values, p)), 2) for p in (50, 95, 99)}
+
+
+def mean_stages(records):
+    """Mean milliseconds per stage over the given log records"""
+    totals, counts = defaultdict(float), len(records)
+    for record in records:
+        for name, ms in (record.get('stages') or {}).items():
+            totals[name] += ms
+    return {name: round(total / counts, 2) for name, total in sorted(totals.items())} if counts else {}
+
+
+def build_report(pairs, server_records=None):
+    """Per-route latency and status comparison (original vs replay)"""
+    by_route = defaultdict(list)
+    for record, result in pairs:
+        by_route[record.get('route') or record['path']].append((record, result))
+    server_by_route = defaultdict(list)
+    for record in server_records or []:
+        server_by_route[record.get('route') or record['path']].append(record)
+
+    routes = {}
+    for route, items in sorted(by_route.items()):
+        original = percentiles([r['duration_ms'] for r, _ in items])
+        replayed = percentiles([res['latency_ms'] for _, res in items if res['error'] is None])
+        routes[route] = {
+            'requests': len(items),
+            'original_ms': original,
+            'replay_ms': replayed,
+            'delta_p50_pct': (round((replayed['p50'] - original['p50']) / original['p50'] * 100, 1)
+                              if original['p50'] and replayed['p50'] is not None else None),
+            'status_mismatches': sum(1 for r, res in items if res['status'] != r['status']),
+            'errors': sum(1 for _, res in items if res['error'] is not None),
+            'original_stages_ms': mean_stages([r for r, _ in items]),
+            'replay_stages_ms': mean_stages(server_by_route.get(route, [])),
+        }
+    lateness = [res['lateness_ms'] for _, res in pairs]
+    return {
+        'requests': len(pairs),
+        'routes': routes,
+        'lateness_ms': percentiles(lateness),
+    }
+
+
+def print_report(report):
+    print(f"\n{'route':32s} {'n':>5s} {'orig p50':>9s} {'orig p95':>9s} {'new p50':>9s} "
+          f"{'new p95':>9s} {'d p50':>7s} {'status':>6s}")
+    print("-" * 95)
+    fmt = lambda v, spec: format(v, spec) if v is not None else '-'
+    for route, r in report['routes'].items():
+        print(f"{route[:32]:32s} {r['requests']:5d} {fmt(r['original_ms']['p50'], '9.1f'):>9s} "
+              f"{fmt(r['original_ms']['p95'], '9.1f'):>9s} {fmt(r['replay_ms']['p50'], '9.1f'):>9s} "
+              f"{fmt(r['replay_ms']['p95'], '9.1f'):>9s} "
+              f"{fmt(r['delta_p50_pct'], '+6.1f') + '%' if r['delta_p50_pct'] is not None else '-':>7s} "
+              f"{r['status_mismatches']:6d}")
+        stages = sorted(set(r['original_stages_ms']) | set(r['replay_stages_ms']))
+        for name in stages:
+            print(f"    {name:28s} stage mean: {fmt(r['original_stages_ms'].get(name), '.1f')} -> "
+                  f"{fmt(r['replay_stages_ms'].get(name), '.1f')} ms")
+    late = report['lateness_ms']
+    print(f"\nSend lateness p50/p99: {late['p50']} / {late['p99']} ms "
+          f"(high values mean the replay could not keep the original pace)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a structured request log")
+    parser.add_argument('log', help="JSON-lines request log (REQUEST_LOG_PATH output)")
+    parser.add_argument('--service', choices=sorted(SERVICE_MODULES), default=None,
+                        help="Service to replay (default: the first record's service)")
+    parser.add_argument('--routes', nargs='*', help="Only replay these route rules")
+    parser.add_argument('--limit', type=int, default=None, help="Replay at most N requests")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Timing scale: 1 = original pace, 2 = twice as fast, 0 = no waiting")
+    parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at most")
+    parser.add_argument('--target', default=None,
+                        help="Base URL of a running instance (default: run in-process)")
+    parser.add_argument('--cookie', default=None, help="Cookie header for --target (app session)")
+    parser.add_argument('--graph-latency-ms', type=float, default=0.0,
+                        help="Latency added by the Graph stand-in")
+    parser.add_argument('--blob-latency-ms', type=float, default=0.0,
+                        help="Latency added by the blob stand-in")
+    parser.add_argument('--report', default=None, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    service = args.service
+    if service is None:
+        first = read_log(args.log, limit=1)
+        service = first[0]['service'] if first else 'app'
+    records = read_log(args.log, service, args.routes, args.limit)
+    if not records:
+        print(f"No '{service}' requests in {args.log}")
+        return
+
+    REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    report_path = Path(args.report) if args.report else REPORTS_DIR / f"{service}_{stamp}.json"
+    server_log = report_path.with_name(report_path.stem + '_server.jsonl')
+
+    standins = StandinServer(graph_latency_ms=args.graph_latency_ms,
+                             blob_latency_ms=args.blob_latency_ms).start()
+    target = (HttpTarget(args.target, args.cookie) if args.target
+              else InProcessTarget(service, standins, server_log))
+
+    span = records[-1]['ts'] - records[0]['ts']
+    print(f"Replaying {len(records)} '{service}' requests spanning {span:.1f}s "
+          f"(speed {args.speed or 'max'}, concurrency {args.concurrency})")
+    started = time.perf_counter()
+    pairs = replay(records, target, standins, args.speed, args.concurrency)
+    elapsed = time.perf_counter() - started
+    standins.stop()
+
+    server_records = []
+    if not args.target and server_log.exists():
+        with open(server_log, 'r', encoding='utf-8') as f:
+            server_records = [json.loads(line) for line in f if line.strip()]
+    report = build_report(pairs, server_records)
+    report.update({'log': str(args.log), 'service': service, 'speed': args.speed,
+                   'concurrency': args.concurrency, 'target': args.target or 'in-process',
+                   'seconds': round(elapsed, 2)})
+    print_report(report)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Structured per-request logging for the Flask services.
+
+When REQUEST_LOG_PATH is set, every request handled by the app is written
+as one JSON line:
+
+    {"ts": 1760000000.123, "service": "classifier", "method": "POST",
+     "route": "/api/classify/url", "path": "/api/classify/url", "query": "",
+     "status": 200, "request_bytes": 71, "response_bytes": 212,
+     "duration_ms": 84.2, "stages": {"download": 31.0, "predict": 48.9},
+     "cache": null, "body": {"image_url": "https://..."}}
+
+Handlers add timings with `with stage('predict'):` (or record_stage) and
+the cache outcome with set_cache_outcome(). Outbound calls made through
+http_clients are recorded as `upstream_<name>` stages automatically. Small
+JSON request bodies are kept so replay_requests.py can re-issue the
+traffic; cookies, headers and uploaded files are never logged. Query
+parameters are logged only for the keys in LOGGED_QUERY_KEYS; all other
+values (OAuth `code` and `state`, names, tokens) are masked.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from flask import g, has_request_context, request
+
+# JSON request bodies up to this size are logged for replay
+MAX_LOGGED_BODY = int(os.getenv('REQUEST_LOG_MAX_BODY', '2048'))
+
+# Query parameters whose values are logged; other values are masked
+LOGGED_QUERY_KEYS = {'page', 'categories', 'category', 'limit', 'seconds', 'interval_ms'}
+MASKED_VALUE = 'REDACTED'
+
+
+class RequestLog:
+    """Thread-safe JSON-lines writer."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+
+def record_stage(name, elapsed_ms):
+    """Add `elapsed_ms` to a named stage of the current request (no-op outside requests)."""
+    if not has_request_context() or '_request_log' not in g:
+        return
+    stages = g._request_log['stages']
+    stages[name] = round(stages.get(name, 0.0) + elapsed_ms, 3)
+
+
+@contextmanager
+def stage(name):
+    """Time a block of a request handler as a named stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, (time.perf_counter() - started) * 1000)
+
+
+def set_cache_outcome(outcome):
+    """Record the cache outcome ('hit', 'miss', 'not_modified') of the current request."""
+    if has_request_context() and '_request_log' in g:
+        g._request_log['cache'] = outcome
+
+
+def _logged_query():
+    return urlencode([(key, value if key in LOGGED_QUERY_KEYS else MASKED_VALUE)
+                      for key, value in request.args.items(multi=True)])
+
+
+def _logged_body():
+    if not request.is_json or (request.content_length or 0) > MAX_LOGGED_BODY:
+        return None
+    return request.get_json(silent=True)
+
+
+def install_request_logging(app, service, path=None):
+    """
+    Log every request of `app` to `path` (default: REQUEST_LOG_PATH)
+
+    Returns:
+        The RequestLog, or None if logging is disabled
+    """
+    path = path or os.getenv('REQUEST_LOG_PATH')
+    if not path:
+        return None
+    log = RequestLog(path)
+
+    @app.before_request
+    def _start_request_log():
+        g._request_log = {'started': time.perf_counter(), 'stages': {}, 'cache': None,
+                          'written': False}
+
+    def _write(status, response_bytes):
+        state = g._request_log
+        state['written'] = True
+        rule = request.url_rule
+        log.write({
+            'ts': round(time.time(), 3),
+            'service': service,
+            'method': request.method,
+            'route': rule.rule if rule is not None else None,
+            'path': request.path,
+            'query': _logged_query(),
+            'status': status,
+            'request_bytes': request.content_length or 0,
+            'response_bytes': response_bytes,
+            'duration_ms': round((time.perf_counter() - state['started']) * 1000, 3),
+            'stages': state['stages'],
+            'cache': state['cache'],
+            'body': _logged_body(),
+        })
+
+    @app.after_request
+    def _finish_request_log(response):
+        if '_request_log' in g:
+            length = response.calculate_content_length()
+            _write(response.status_code, length if length is not None else 0)
+        return response
+
+    @app.teardown_request
+    def _log_failed_request(exc):
+        # after_request does not run when a handler raises
+        if exc is not None and '_request_log' in g and not g._request_log['written']:
+            _write(500, 0)
+
+    return log
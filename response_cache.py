@@ -0,0 +1,151 @@
+"""
+Compressed response cache for pages rendered from USER_LIST.
+
+Rendered HTML is stored gzip-compressed (and brotli-compressed when the
+`brotli` package is installed) together with an ETag per encoding (the
+content hash plus "-br"/"-gz" for compressed bodies, as each encoding is a
+different representation under Vary: Accept-Encoding). Unchanged pages are
+answered with 304 Not Modified or the cached compressed body instead of
+re-rendering the template. Cache keys must include the mapping version so
+entries become unreachable as soon as the user list changes.
+"""
+import gzip
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+from request_log import record_stage, set_cache_outcome
+
+try:
+    import brotli
+except ImportError:  # Optional dependency - gzip only
+    brotli = None
+
+
+class CachedPage:
+    """A rendered page stored in compressed form."""
+
+    def __init__(self, html):
+        body = html.encode('utf-8')
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.size = len(body)
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+        self.brotli_body = brotli.compress(body) if brotli is not None else None
+
+    def encoding_for(self, accept_encodings):
+        """Return the content encoding to send for the client's Accept-Encoding."""
+        if self.brotli_body is not None and 'br' in accept_encodings:
+            return 'br'
+        if 'gzip' in accept_encodings:
+            return 'gzip'
+        return None
+
+    def etag_for(self, encoding):
+        """Strong ETag of the page in one content encoding."""
+        suffix = {'br': '-br', 'gzip': '-gz'}.get(encoding, '')
+        return f"{self.etag}{suffix}"
+
+    def body_for(self, encoding):
+        """Return the body in the given content encoding."""
+        if encoding == 'br':
+            return self.brotli_body
+        if encoding == 'gzip':
+            return self.gzip_body
+        return gzip.decompress(self.gzip_body)
+
+
+class RenderCache:
+    """LRU cache of rendered pages with per-route render time and hit rate stats."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _route_stats(self, route):
+        return self._stats.setdefault(route, {
+            'hits': 0, 'misses': 0, 'not_modified': 0, 'renders': 0, 'render_ms_total': 0.0
+        })
+
+    def _get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def _put(self, key, page):
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def respond(self, route, key, render):
+        """
+        Serve a page from the cache, rendering it on a miss.
+
+        Args:
+            route: route name used for statistics
+            key: hashable cache key (include the mapping version)
+            render: zero-argument callable returning the page HTML
+
+        Returns:
+            Flask Response (200 with compressed body, or 304)
+        """
+        page = self._get(key)
+        with self._lock:
+            stats = self._route_stats(route)
+            stats['hits' if page is not None else 'misses'] += 1
+        set_cache_outcome('hit' if page is not None else 'miss')
+
+        if page is None:
+            started = time.perf_counter()
+            page = CachedPage(render())
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            record_stage('render', elapsed_ms)
+            self._put(key, page)
+            with self._lock:
+                stats['renders'] += 1
+                stats['render_ms_total'] += elapsed_ms
+
+        encoding = page.encoding_for(request.accept_encodings)
+        etag = page.etag_for(encoding)
+        if request.if_none_match.contains(etag):
+            with self._lock:
+                stats['not_modified'] += 1
+            set_cache_outcome('not_modified')
+            response = Response(status=304)
+        else:
+            response = Response(page.body_for(encoding), mimetype='text/html')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def stats(self):
+        """Return per-route hit rate and average render time."""
+        with self._lock:
+            routes = {}
+            for route, stats in self._stats.items():
+                lookups = stats['hits'] + stats['misses']
+                routes[route] = {
+                    'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'not_modified': stats['not_modified'],
+                    'hit_rate': round(stats['hits'] / lookups, 3) if lookups else None,
+                    'avg_render_ms': (round(stats['render_ms_total'] / stats['renders'], 2)
+                                      if stats['renders'] else None),
+                }
+            return {
+                'entries': len(self._pages),
+                'max_entries': self.max_entries,
+                'brotli': brotli is not None,
+                'routes': routes,
+            }
@@ -0,0 +1,300 @@
+"""
+Startup auto-tuning of TensorFlow thread pools and inference batch size
+
+TensorFlow's default intra-op/inter-op thread pools size themselves from
+the host's core count, which on a shared App Service plan often
+oversubscribes (or underuses) the cores the container actually gets, and
+the API calls the model one image at a time.
+
+With RUNTIME_AUTOTUNE=on the classifier API calibrates once per host:
+every candidate thread setting is micro-benchmarked in its own subprocess
+(thread pools cannot be resized once TensorFlow has started) on dummy
+inputs at several batch sizes, and the setting with the best throughput
+whose p95 batch latency stays under RUNTIME_LATENCY_TARGET_MS wins. The
+result is stored in models/runtime_tuning.json together with a fingerprint
+of the host and model, so later boots reuse it without re-measuring.
+
+A chosen batch size above 1 is served by MicroBatcher, which groups
+concurrent single-image requests into one model call.
+
+Usage:
+    python runtime_tuning.py tune --model models/resnet50_profilepic_classifier.keras
+    python runtime_tuning.py show
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+BASE_DIR = Path(__file__).parent
+TUNING_PATH = BASE_DIR / "models" / "runtime_tuning.json"
+
+BATCH_SIZES = (1, 2, 4, 8, 16)
+
+# Settings within this fraction of the best throughput count as equal;
+# the one with the lowest latency among them wins
+THROUGHPUT_TOLERANCE = 0.05
+
+
+def available_cpus():
+    """Cores this process may run on (container/affinity aware)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def fingerprint(model_path):
+    """What a stored tuning result is only valid for"""
+    import tensorflow as tf
+
+    stat = os.stat(model_path)
+    return {
+        'cpus': available_cpus(),
+        'cpu_model': _cpu_model(),
+        'tensorflow': tf.__version__,
+        'model': os.path.basename(model_path),
+        'model_bytes': stat.st_size,
+        'model_mtime': int(stat.st_mtime),
+    }
+
+
+def candidate_settings(cpus):
+    """(intra-op, inter-op) thread counts worth trying on `cpus` cores"""
+    intra = sorted({1, max(1, cpus // 2), cpus})
+    return [(a, b) for a in intra for b in (1, 2)]
+
+
+def benchmark(model_path, intra, inter, batch_sizes=BATCH_SIZES, runs=30, warmup=5):
+    """
+    Time the model at each batch size with the given thread pools
+
+    Must run in a fresh process: thread pools are fixed at TF startup.
+    """
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra)
+    tf.config.threading.set_inter_op_parallelism_threads(inter)
+    model = tf.keras.models.load_model(model_path)
+    results = []
+    for batch_size in batch_sizes:
+        x = np.zeros((batch_size, *model.input_shape[1:]), dtype=np.float32)
+        for _ in range(warmup):
+            model.predict_on_batch(x)
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            model.predict_on_batch(x)
+            timings.append((time.perf_counter() - started) * 1000)
+        results.append({
+            'intra_op_threads': intra,
+            'inter_op_threads': inter,
+            'batch_size': batch_size,
+            'p50_ms': round(float(np.percentile(timings, 50)), 2),
+            'p95_ms': round(float(np.percentile(timings, 95)), 2),
+            'images_per_second': round(batch_size * 1000 / float(np.mean(timings)), 1),
+        })
+    return results
+
+
+def choose(results, latency_target_ms):
+    """Best throughput within the latency target (else the lowest latency)"""
+    within = [r for r in results if r['p95_ms'] <= latency_target_ms]
+    if not within:
+        return min(results, key=lambda r: r['p95_ms'])
+    best = max(r['images_per_second'] for r in within)
+    close = [r for r in within if r['images_per_second'] >= best * (1 - THROUGHPUT_TOLERANCE)]
+    return min(close, key=lambda r: r['p95_ms'])
+
+
+def calibrate(model_path, latency_target_ms=200.0, batch_sizes=BATCH_SIZES, runs=30,
+              timeout=600):
+    """
+    Benchmark every candidate thread setting (one subprocess each)
+
+    Returns:
+        tuning config dict (see save_tuning)
+    """
+    results = []
+    for intra, inter in candidate_settings(available_cpus()):
+        cmd = [sys.executable, str(Path(__file__).resolve()), 'bench', '--model', str(model_path),
+               '--intra', str(intra), '--inter', str(inter), '--runs', str(runs),
+               '--batch-sizes', *[str(b) for b in batch_sizes]]
+        print(f"Runtime tuning: benchmarking intra={intra} inter={inter} ...")
+        try:
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True,
+                                    timeout=timeout).stdout
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            print(f"  failed: {e}")
+            continue
+        results.extend(json.loads(output.strip().splitlines()[-1]))
+    if not results:
+        raise RuntimeError("Runtime tuning failed for every candidate setting")
+
+    best = choose(results, latency_target_ms)
+    return {
+        'intra_op_threads': best['intra_op_threads'],
+        'inter_op_threads': best['inter_op_threads'],
+        'batch_size': best['batch_size'],
+        'p95_ms': best['p95_ms'],
+        'images_per_second': best['images_per_second'],
+        'latency_target_ms': latency_target_ms,
+        'fingerprint': fingerprint(model_path),
+        'tuned_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'results': results,
+    }
+
+
+def save_tuning(config, path=TUNING_PATH):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+
+
+def load_tuning(model_path, path=TUNING_PATH):
+    """Stored tuning result, if it was measured on this host for this model"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return config if config.get('fingerprint') == fingerprint(model_path) else None
+
+
+def tune_at_startup(model_path, latency_target_ms=200.0, path=TUNING_PATH):
+    """
+    Reuse the stored tuning for this host/model or calibrate a new one,
+    then size TensorFlow's thread pools. Call before TensorFlow runs any op.
+
+    Returns:
+        (config, 'stored' or 'calibrated')
+    """
+    import tensorflow as tf
+
+    config, source = load_tuning(model_path, path), 'stored'
+    if config is None:
+        config, source = calibrate(model_path, latency_target_ms), 'calibrated'
+        save_tuning(config, path)
+    tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+    return config, source
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-image predictions into batched model calls
+
+    Args:
+        run_batch: function(batch array) -> list of per-image results
+        max_batch: largest batch to form
+        max_wait_ms: how long the first request waits for company
+    """
+
+    def __init__(self, run_batch, max_batch, max_wait_ms=5.0):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.images = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, name='micro-batcher', daemon=True).start()
+
+    def submit(self, image):
+        """Predict one image (without batch dimension); blocks until done"""
+        future = Future()
+        self._queue.put((image, future))
+        return future.result()
+
+    def _loop(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                results = self.run_batch(np.stack([image for image, _ in items]))
+                for (_, future), result in zip(items, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+            self.batches += 1
+            self.images += len(items)
+
+    def stats(self):
+        return {'max_batch': self.max_batch, 'max_wait_ms': self.max_wait * 1000,
+                'batches': self.batches,
+                'mean_batch_size': round(self.images / self.batches, 2) if self.batches else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune TensorFlow threads and batch size")
+    sub = parser.add_subparsers(dest='command', required=True)
+    tune = sub.add_parser('tune', help="Calibrate and store the result")
+    tune.add_argument('--model', required=True)
+    tune.add_argument('--latency-target-ms', type=float, default=200.0)
+    tune.add_argument('--runs', type=int, default=30)
+    tune.add_argument('--output', default=str(TUNING_PATH))
+    bench = sub.add_parser('bench', help=argparse.SUPPRESS)
+    bench.add_argument('--model', required=True)
+    bench.add_argument('--intra', type=int, required=True)
+    bench.add_argument('--inter', type=int, required=True)
+    bench.add_argument('--runs', type=int, default=30)
+    bench.add_argument('--batch-sizes', type=int, nargs='+', default=list(BATCH_SIZES))
+    sub.add_parser('show', help="Print the stored result")
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        print(json.dumps(benchmark(args.model, args.intra, args.inter, args.batch_sizes, args.runs)))
+        return
+    if args.command == 'show':
+        if not TUNING_PATH.exists():
+            print(f"No runtime tuning at {TUNING_PATH}")
+            return
+        with open(TUNING_PATH, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    else:
+        config = calibrate(args.model, args.latency_target_ms, runs=args.runs)
+        save_tuning(config, args.output)
+
+    print(f"\n{'intra':>5s} {'inter':>5s} {'batch':>5s} {'p50 ms':>8s} {'p95 ms':>8s} {'img/s':>8s}")
+    for r in config['results']:
+        marker = ' <-' if (r['intra_op_threads'], r['inter_op_threads'], r['batch_size']) == (
+            config['intra_op_threads'], config['inter_op_threads'], config['batch_size']) else ''
+        print(f"{r['intra_op_threads']:5d} {r['inter_op_threads']:5d} {r['batch_size']:5d} "
+              f"{r['p50_ms']:8.2f} {r['p95_ms']:8.2f} {r['images_per_second']:8.1f}{marker}")
+    print(f"\nChosen for p95 <= {config['latency_target_ms']:.0f} ms: "
+          f"intra={config['intra_op_threads']} inter={config['inter_op_threads']} "
+          f"batch={config['batch_size']}")
+
+
+if __name__ == "__main__":
+    main()
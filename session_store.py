@@ -0,0 +1,250 @@
+"""
+Server-side session storage for the Flask web application.
+
+The session cookie only carries a signed session id. Session data (access
+token, Graph profile, ...) lives in a pluggable backend:
+- MemorySessionStore: in-process LRU, fastest, lost on restart
+- SQLiteSessionStore: on-disk, shared by all workers on the same host
+"""
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dictionary that remembers its id and whether it changed."""
+
+    def __init__(self, initial=None, sid=None, new=False, expires=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.expires = expires
+        self.previous_sid = None
+
+    def regenerate(self):
+        """
+        Issue a new session id, keeping the data (call when the session is
+        elevated, e.g. at login, so an id planted before login is useless).
+        The old id is deleted from the store when the session is saved.
+        """
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class SessionStore:
+    """Base class for session backends."""
+
+    def load(self, sid):
+        """Return (data, expiry timestamp) for `sid`, or None if missing/expired."""
+        raise NotImplementedError
+
+    def get(self, sid):
+        """Return the session data for `sid`, or None if missing/expired."""
+        entry = self.load(sid)
+        return entry[0] if entry is not None else None
+
+    def set(self, sid, data, ttl):
+        """Store session data for `ttl` seconds."""
+        raise NotImplementedError
+
+    def touch(self, sid, ttl):
+        """Extend a session's lifetime to `ttl` seconds from now."""
+        raise NotImplementedError
+
+    def delete(self, sid):
+        """Remove a session."""
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """In-memory LRU session store (per process)."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.time():
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return dict(data), expires
+
+    def set(self, sid, data, ttl):
+        with self._lock:
+            self._sessions[sid] = (time.time() + ttl, dict(data))
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def touch(self, sid, ttl):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is not None:
+                self._sessions[sid] = (time.time() + ttl, entry[1])
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite-backed session store shared by all workers on one host."""
+
+    # Expired rows are purged at most this often (seconds)
+    PURGE_INTERVAL = 300
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._last_purge = 0.0
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+        conn.commit()
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def load(self, sid):
+        row = self._connect().execute(
+            'SELECT data, expires FROM sessions WHERE sid = ?', (sid,)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, sid, data, ttl):
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            'INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)',
+            (sid, json.dumps(data), now + ttl)
+        )
+        if now - self._last_purge > self.PURGE_INTERVAL:
+            self._last_purge = now
+            conn.execute('DELETE FROM sessions WHERE expires < ?', (now,))
+        conn.commit()
+
+    def touch(self, sid, ttl):
+        conn = self._connect()
+        conn.execute('UPDATE sessions SET expires = ? WHERE sid = ?', (time.time() + ttl, sid))
+        conn.commit()
+
+    def delete(self, sid):
+        conn = self._connect()
+        conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+        conn.commit()
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface that keeps only a signed session id in the cookie."""
+
+    salt = 'server-side-session'
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                entry = self.store.load(sid)
+                if entry is not None:
+                    data, expires = entry
+                    return ServerSideSession(data, sid=sid, expires=expires)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        # Session emptied (e.g. logout): drop it server-side and client-side
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        if not session.modified:
+            # Sliding expiry: active sessions are extended on access, at most
+            # once per half lifetime so most requests do not write
+            if session.expires is not None and session.expires - time.time() < ttl / 2:
+                self.store.touch(session.sid, ttl)
+                self._set_cookie(app, session, response)
+            return
+
+        self.store.set(session.sid, dict(session), ttl)
+        self._set_cookie(app, session, response)
+
+    def _set_cookie(self, app, session, response):
+        response.set_cookie(
+            self.get_cookie_name(app),
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+
+def create_session_interface(backend, db_path=None, max_entries=10000):
+    """
+    Build a session interface for the given backend name.
+
+    Args:
+        backend: 'memory', 'sqlite' or 'cookie' (Flask's default signed cookie)
+        db_path: SQLite database file (sqlite backend only)
+        max_entries: LRU capacity (memory backend only)
+
+    Returns:
+        SessionInterface instance, or None to keep Flask's cookie sessions
+    """
+    if backend == 'cookie':
+        return None
+    if backend == 'memory':
+        return ServerSideSessionInterface(MemorySessionStore(max_entries))
+    if backend == 'sqlite':
+        return ServerSideSessionInterface(SQLiteSessionStore(db_path))
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,357 @@
+"""
+Sprite sheets for the gallery.
+
+A gallery page shows up to GALLERY_PAGE_SIZE photos, each a separate
+image request to blob storage. SpriteSheets packs the thumbnails of
+consecutive USER_LIST entries (chunks of `sheet_users`, aligned with the
+gallery pages) into one JPEG per chunk plus a JSON manifest with each
+photo's tile, so a page of 100 users needs one or two image requests.
+
+Regeneration is incremental:
+
+- A chunk's key is a hash of the photo URLs it contains (in order). When
+  the mapping changes, only chunks whose photos changed get a new key;
+  every other chunk keeps its sheet.
+- Thumbnails are cached on disk by photo URL, so rebuilding a sheet only
+  downloads photos that are new to it.
+- Sheet image names include a hash of their bytes, so they can be served
+  with immutable caching.
+
+Pages are never blocked on a build: chunks without a sheet are queued for
+a background worker and render as individual <img> tags until ready.
+Photos that could not be fetched are retried after `retry_seconds`.
+Downloads go through their own blob client ('blob-sprites': its own pool,
+concurrency limit and circuit breaker), so a build cannot starve or trip
+the client that photo uploads use.
+
+Usage (build step, e.g. at deploy):
+    python sprite_sheets.py build --map profile_upload_map.csv
+    python sprite_sheets.py show
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from http_clients import get_client
+from image_decode import DecodeBusy, decode_budget, decoded_bytes, draft_for, open_checked
+
+BASE_DIR = Path(__file__).parent
+SPRITE_DIR = BASE_DIR / "sprites"
+
+THUMB_SIZE = 160
+SHEET_USERS = 100
+SHEET_COLUMNS = 10
+
+
+def http_fetch(url):
+    """Photo bytes from blob storage (raises on failure)"""
+    response = get_client('blob-sprites', kind='blob').get(url)
+    if response.status_code != 200:
+        raise OSError(f"HTTP {response.status_code} for {url}")
+    return response.content
+
+
+def chunk_key(users, thumb_size):
+    """Key of a chunk: which photos it holds, in which order, at which size"""
+    digest = hashlib.sha1(str(thumb_size).encode())
+    for user in users:
+        digest.update(b'\n' + (user.get('blobUrl') or '').encode('utf-8'))
+    return digest.hexdigest()[:20]
+
+
+class SpriteSheets:
+    """
+    Builds, caches and looks up gallery sprite sheets
+
+    Args:
+        cache_dir: directory for thumbnails and sheets
+        fetch: function(url) -> photo bytes
+        thumb_size: tile edge in pixels
+        sheet_users: users per sheet (should divide the gallery page size)
+        fetch_workers: concurrent photo downloads while building a sheet
+        retry_seconds: age after which sheets with missing photos are rebuilt
+        max_sheets: sheets kept on disk (least recently built are removed)
+    """
+
+    def __init__(self, cache_dir=SPRITE_DIR, fetch=http_fetch, thumb_size=THUMB_SIZE,
+                 sheet_users=SHEET_USERS, fetch_workers=8, retry_seconds=600, max_sheets=2000):
+        self.cache_dir = Path(cache_dir)
+        self.thumb_dir = self.cache_dir / "thumbs"
+        self.sheet_dir = self.cache_dir / "sheets"
+        self.thumb_dir.mkdir(parents=True, exist_ok=True)
+        self.sheet_dir.mkdir(parents=True, exist_ok=True)
+        self.fetch = fetch
+        self.thumb_size = thumb_size
+        self.sheet_users = sheet_users
+        self.fetch_workers = fetch_workers
+        self.retry_seconds = retry_seconds
+        self.max_sheets = max_sheets
+
+        # Incremented whenever a sheet is built; part of gallery page cache keys
+        self.version = 0
+        self._manifests = {}  # key -> manifest
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sprite-build')
+        self.counters = {'sheets_built': 0, 'thumbs_fetched': 0, 'thumbs_cached': 0,
+                         'fetch_failures': 0, 'build_ms': 0.0}
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.counters[name] += amount
+
+    def _thumbnail(self, url):
+        """Square thumbnail for a photo URL (disk cached), or None if unavailable"""
+        path = self.thumb_dir / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}_{self.thumb_size}.jpg"
+        if path.exists():
+            self._count(thumbs_cached=1)
+            thumb = Image.open(path)
+            thumb.load()
+            return thumb
+        try:
+            img = open_checked(io.BytesIO(self.fetch(url)))
+            draft_for(img, (self.thumb_size, self.thumb_size))
+            with decode_budget.reserve(decoded_bytes(img)):
+                img = ImageOps.exif_transpose(img)
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                thumb = ImageOps.fit(img, (self.thumb_size, self.thumb_size), Image.LANCZOS)
+        except (OSError, ValueError, UnidentifiedImageError, DecodeBusy) as e:
+            print(f"Sprite thumbnail failed for {url}: {e}")
+            self._count(fetch_failures=1)
+            return None
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        thumb.save(tmp_path, format='JPEG', quality=85)
+        os.replace(tmp_path, path)
+        self._count(thumbs_fetched=1)
+        return thumb
+
+    def build(self, key, users):
+        """Compose the sheet for one chunk and write its image and manifest"""
+        started = time.perf_counter()
+        size = self.thumb_size
+        columns = min(SHEET_COLUMNS, max(len(users), 1))
+        rows = max(1, -(-len(users) // columns))
+        urls = {slot: user['blobUrl'] for slot, user in enumerate(users) if user.get('blobUrl')}
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as pool:
+            thumbs = dict(zip(urls, pool.map(self._thumbnail, urls.values())))
+
+        sheet = Image.new('RGB', (columns * size, rows * size), (243, 244, 246))
+        tiles, missing = {}, []
+        for slot, thumb in thumbs.items():
+            if thumb is None:
+                missing.append(slot)
+                continue
+            column, row = slot % columns, slot // columns
+            sheet.paste(thumb, (column * size, row * size))
+            tiles[str(slot)] = [column, row]
+        buffer = io.BytesIO()
+        sheet.save(buffer, format='JPEG', quality=80, optimize=True, progressive=True)
+        body = buffer.getvalue()
+
+        image_name = f"{key}-{hashlib.sha1(body).hexdigest()[:10]}.jpg"
+        (self.sheet_dir / image_name).write_bytes(body)
+        manifest = {'key': key, 'image': image_name, 'thumb_size': size, 'columns': columns,
+                    'rows': rows, 'bytes': len(body), 'tiles': tiles, 'missing': missing,
+                    'built_at': time.time()}
+        manifest_path = self.sheet_dir / f"{key}.json"
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+        for image in self.sheet_dir.glob(f"{key}-*.jpg"):
+            if image.name != image_name:
+                image.unlink(missing_ok=True)
+
+        with self._lock:
+            self._manifests[key] = manifest
+            self.version += 1
+        self._count(sheets_built=1, build_ms=(time.perf_counter() - started) * 1000)
+        self._prune()
+        return manifest
+
+    def _prune(self):
+        manifests = sorted(self.sheet_dir.glob('*.json'), key=lambda p: p.stat().st_mtime)
+        for path in manifests[:max(0, len(manifests) - self.max_sheets)]:
+            key = path.stem
+            with self._lock:
+                self._manifests.pop(key, None)
+            for image in self.sheet_dir.glob(f"{key}-*.jpg"):
+                image.unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+
+    def _load_manifest(self, key):
+        with self._lock:
+            manifest = self._manifests.get(key)
+        if manifest is None:
+            path = self.sheet_dir / f"{key}.json"
+            if not path.exists():
+                return None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                return None
+            with self._lock:
+                self._manifests[key] = manifest
+        return manifest
+
+    def _stale(self, manifest):
+        return bool(manifest['missing']) and time.time() - manifest['built_at'] > self.retry_seconds
+
+    def _schedule(self, key, users):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+
+        def run():
+            try:
+                self.build(key, users)
+            except Exception as e:
+                print(f"Sprite sheet {key} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        self._builder.submit(run)
+
+    def lookup(self, users, build=True):
+        """
+        Manifest of the sheet for one chunk of users, or None if not built
+
+        Missing (and stale) sheets are queued for the background builder
+        unless build is False.
+        """
+        users = [dict(user) for user in users]
+        key = chunk_key(users, self.thumb_size)
+        manifest = self._load_manifest(key)
+        if build and (manifest is None or self._stale(manifest)):
+            self._schedule(key, users)
+        return manifest
+
+    def page_tiles(self, user_list, start, count, url_for_sheet):
+        """
+        Sprite tile of every user on a gallery page that has one
+
+        Args:
+            user_list: USER_LIST
+            start / count: the page's slice
+            url_for_sheet: function(image name) -> URL of the sheet image
+
+        Returns:
+            {index in user_list: {'url', 'x', 'y', 'size'}} with CSS
+            background position/size percentages (they scale with the card)
+        """
+        tiles = {}
+        end = min(start + count, len(user_list))
+        for chunk in range(start // self.sheet_users, -(-end // self.sheet_users)):
+            chunk_start = chunk * self.sheet_users
+            manifest = self.lookup(user_list[chunk_start:chunk_start + self.sheet_users])
+            if manifest is None:
+                continue
+            url = url_for_sheet(manifest['image'])
+            columns, rows = manifest['columns'], manifest['rows']
+            for slot, (column, row) in manifest['tiles'].items():
+                index = chunk_start + int(slot)
+                if start <= index < end:
+                    tiles[index] = {
+                        'url': url,
+                        'x': f"{column * 100 / (columns - 1) if columns > 1 else 0:g}%",
+                        'y': f"{row * 100 / (rows - 1) if rows > 1 else 0:g}%",
+                        'size': f"{columns * 100}% {rows * 100}%",
+                    }
+        return tiles
+
+    def build_all(self, user_list):
+        """Build every missing or stale sheet now (the build step); returns counts"""
+        built = reused = 0
+        for chunk_start in range(0, len(user_list), self.sheet_users):
+            users = [dict(user) for user in user_list[chunk_start:chunk_start + self.sheet_users]]
+            key = chunk_key(users, self.thumb_size)
+            manifest = self._load_manifest(key)
+            if manifest is not None and not self._stale(manifest):
+                reused += 1
+                continue
+            self.build(key, users)
+            built += 1
+        return {'built': built, 'reused': reused}
+
+    def start_build_all(self, user_list):
+        """Queue build_all on the background builder; returns its Future"""
+        users = [dict(user) for user in user_list]
+        return self._builder.submit(self.build_all, users)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            pending = len(self._pending)
+        counters['build_ms'] = round(counters['build_ms'], 1)
+        return {
+            **counters,
+            'pending': pending,
+            'version': self.version,
+            'sheets_on_disk': sum(1 for _ in self.sheet_dir.glob('*.json')),
+            'thumb_size': self.thumb_size,
+            'sheet_users': self.sheet_users,
+        }
+
+
+def users_from_map(map_path):
+    """USER_LIST order of an upload map (later rows for a user replace earlier ones)"""
+    users, positions = [], {}
+    with open(map_path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            upn = row['UserPrincipalName'].lower()
+            user = {'userPrincipalName': row['UserPrincipalName'], 'blobUrl': row['BlobUrl']}
+            if upn in positions:
+                users[positions[upn]] = user
+            else:
+                positions[upn] = len(users)
+                users.append(user)
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build gallery sprite sheets")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help="Build every missing sheet for an upload map")
+    build.add_argument('--map', default=str(BASE_DIR / "profile_upload_map.csv"))
+    build.add_argument('--cache-dir', default=os.getenv('SPRITE_CACHE_DIR', str(SPRITE_DIR)))
+    build.add_argument('--thumb-size', type=int, default=int(os.getenv('SPRITE_THUMB_SIZE', str(THUMB_SIZE))))
+    build.add_argument('--sheet-users', type=int, default=int(os.getenv('SPRITE_SHEET_USERS', str(SHEET_USERS))))
+    show = sub.add_parser('show', help="Summarize the sheets on disk")
+    show.add_argument('--cache-dir', default=os.getenv('SPRITE_CACHE_DIR', str(SPRITE_DIR)))
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        sheets = SpriteSheets(args.cache_dir)
+        manifests = [json.loads(p.read_text()) for p in sheets.sheet_dir.glob('*.json')]
+        print(f"{len(manifests)} sheets in {sheets.sheet_dir}")
+        if manifests:
+            print(f"  tiles:   {sum(len(m['tiles']) for m in manifests)}")
+            print(f"  missing: {sum(len(m['missing']) for m in manifests)}")
+            print(f"  bytes:   {sum(m['bytes'] for m in manifests)}")
+        return
+
+    sheets = SpriteSheets(args.cache_dir, thumb_size=args.thumb_size, sheet_users=args.sheet_users)
+    users = users_from_map(args.map)
+    started = time.perf_counter()
+    result = sheets.build_all(users)
+    print(f"✓ {len(users)} users: {result['built']} sheets built, {result['reused']} reused "
+          f"in {time.perf_counter() - started:.1f}s")
+    print(f"  {json.dumps(sheets.stats())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,11 +16,15 @@ Requirements:
 """
 
 import os
+import time
+import argparse
 import numpy as np
 from pathlib import Path
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
+from packed_dataset import PackedDataset, build_packed_dataset, default_dataset_dir
 
 # Configuration
 IMG_SIZE = (128, 128)
@@ -28,15 +32,45 @@ BATCH_SIZE = 16
 EPOCHS = 50
 LEARNING_RATE = 0.001
 VALIDATION_SPLIT = 0.2
+SEED = 42  # Fixed seed so the train/validation split is reproducible
 
 # Paths
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "scripts" / "test_images"
 MODEL_OUTPUT = BASE_DIR / "models" / "profile_classifier.keras"
+HEAD_MODEL_OUTPUT = BASE_DIR / "models" / "resnet50_head_classifier.keras"
+STUDENT_MODEL_OUTPUT = BASE_DIR / "models" / "profile_classifier_student.keras"
+TEACHER_MODEL = BASE_DIR / "models" / "resnet50_profilepic_classifier.keras"
+
+# Knowledge distillation settings
+DISTILL_TEMPERATURE = 4.0
+DISTILL_ALPHA = 0.3  # Weight of the hard-label loss; the rest goes to the teacher's soft labels
 
 # Class mapping (must match classifier_api.py)
 CLASS_NAMES = ['animal', 'avatar', 'human']
 
+# Image formats picked up from the class directories
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+
+def configure(img_size=None, batch_size=None, epochs=None, learning_rate=None):
+    """
+    Override the training hyperparameters
+    
+    The functions below read the module-level constants when they run, so
+    this is how the command line and hyperparameter_sweep.py set them.
+    Arguments left as None keep their current value.
+    """
+    global IMG_SIZE, BATCH_SIZE, EPOCHS, LEARNING_RATE
+    if img_size is not None:
+        IMG_SIZE = (img_size, img_size) if isinstance(img_size, int) else tuple(img_size)
+    if batch_size is not None:
+        BATCH_SIZE = int(batch_size)
+    if epochs is not None:
+        EPOCHS = int(epochs)
+    if learning_rate is not None:
+        LEARNING_RATE = float(learning_rate)
+
 
 def create_model(input_shape=(128, 128, 3), num_classes=3):
     """
@@ -81,6 +115,76 @@ def create_model(input_shape=(128, 128, 3), num_classes=3):
     return model
 
 
+def create_student_model(input_shape=(128, 128, 3), num_classes=3, width=16):
+    """
+    Slimmed version of create_model() for low-latency serving
+    
+    Same four conv blocks with a quarter of the filters, and global average
+    pooling instead of Flatten + Dense(512), which held almost all of the
+    original model's parameters.
+    """
+    model = keras.Sequential([layers.Input(shape=input_shape)], name='student')
+    for block in range(4):
+        model.add(layers.Conv2D(width * 2 ** block, (3, 3), activation='relu', padding='same'))
+        model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.GlobalAveragePooling2D())
+    model.add(layers.Dropout(0.3))
+    model.add(layers.Dense(num_classes, activation='softmax'))
+    return model
+
+
+class Distiller(keras.Model):
+    """
+    Trains a student against hard labels and a teacher's softened probabilities
+    
+    Both networks output softmax probabilities, so their logs are used as
+    logits before dividing by the temperature.
+    """
+    
+    def __init__(self, student, teacher, temperature=DISTILL_TEMPERATURE, alpha=DISTILL_ALPHA):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+        self.temperature = temperature
+        self.alpha = alpha
+        self.teacher_input_size = tuple(teacher.input_shape[1:3])
+    
+    def call(self, x, training=False):
+        return self.student(x, training=training)
+    
+    def compute_loss(self, x=None, y=None, y_pred=None, sample_weight=None, **kwargs):
+        teacher_x = x
+        if tuple(x.shape[1:3]) != self.teacher_input_size:
+            teacher_x = tf.image.resize(x, self.teacher_input_size)
+        teacher_probs = self.teacher(teacher_x, training=False)
+        
+        def soften(probs):
+            return tf.nn.softmax(tf.math.log(probs + 1e-7) / self.temperature)
+        
+        hard_loss = keras.losses.categorical_crossentropy(y, y_pred)
+        teacher_soft, student_soft = soften(teacher_probs), soften(y_pred)
+        soft_loss = tf.reduce_sum(
+            teacher_soft * tf.math.log((teacher_soft + 1e-7) / (student_soft + 1e-7)), axis=-1)
+        loss = self.alpha * hard_loss + (1 - self.alpha) * soft_loss * self.temperature ** 2
+        return tf.reduce_mean(loss)
+
+
+def create_head(feature_dim, num_classes=3):
+    """
+    Classification head trained on cached backbone features
+    
+    Kept small on purpose: it sees pooled ResNet50 features, not pixels.
+    """
+    return keras.Sequential([
+        layers.Input(shape=(feature_dim,)),
+        layers.Dropout(0.3),
+        layers.Dense(256, activation='relu'),
+        layers.Dropout(0.3),
+        layers.Dense(num_classes, activation='softmax')
+    ], name='classification_head')
+
+
 def create_data_generators():
     """
     Create data generators with augmentation
@@ -130,8 +234,378 @@ def create_data_generators():
     return train_generator, val_generator
 
 
+def list_image_files(data_dir=DATA_DIR):
+    """
+    List all training images and their class indices
+    
+    Files are sorted so the listing (and therefore the split) is deterministic.
+    """
+    paths, labels = [], []
+    for class_idx, class_name in enumerate(CLASS_NAMES):
+        class_dir = Path(data_dir) / class_name
+        if not class_dir.exists():
+            continue
+        for path in sorted(class_dir.iterdir()):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                paths.append(str(path))
+                labels.append(class_idx)
+    return paths, labels
+
+
+def split_files(paths, labels, validation_split=VALIDATION_SPLIT, seed=SEED):
+    """
+    Deterministic, stratified train/validation split
+    
+    Each class is shuffled with a fixed seed and its last `validation_split`
+    fraction goes to validation, so every run sees the same split.
+    """
+    rng = np.random.default_rng(seed)
+    train, val = [], []
+    labels = np.asarray(labels)
+    for class_idx in range(len(CLASS_NAMES)):
+        indices = np.flatnonzero(labels == class_idx)
+        rng.shuffle(indices)
+        n_val = int(round(len(indices) * validation_split))
+        val.extend(indices[len(indices) - n_val:])
+        train.extend(indices[:len(indices) - n_val])
+    pick = lambda idx: ([paths[i] for i in idx], [int(labels[i]) for i in idx])
+    return pick(sorted(train)), pick(sorted(val))
+
+
+def decode_and_resize(path, label):
+    """Read, decode and resize one image; kept as uint8 so the cache stays small"""
+    image = tf.io.read_file(path)
+    image = tf.io.decode_image(image, channels=3, expand_animations=False)
+    image = tf.image.resize(image, IMG_SIZE)
+    image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+    return image, tf.one_hot(label, len(CLASS_NAMES))
+
+
+def create_augmentation():
+    """
+    Batch-level augmentation matching the ImageDataGenerator settings
+    
+    Runs vectorized on whole batches inside the tf.data pipeline.
+    """
+    return keras.Sequential([
+        layers.RandomFlip('horizontal', seed=SEED),
+        layers.RandomRotation(20 / 360, seed=SEED),
+        layers.RandomTranslation(0.2, 0.2, seed=SEED),
+        layers.RandomZoom(0.2, seed=SEED),
+    ], name='augmentation')
+
+
+def normalize_batch(images, labels):
+    """Scale uint8 pixels to [0, 1] floats (matches classifier_api.py)"""
+    return tf.cast(images, tf.float32) / 255.0, labels
+
+
+def create_tf_datasets(data_dir=DATA_DIR, cache_file=None):
+    """
+    Create tf.data training and validation pipelines
+    
+    Stages: parallel decode/resize -> cache (memory, or `cache_file` on disk)
+    -> shuffle -> batch -> vectorized augmentation -> prefetch.
+    Decoding only happens during the first epoch; later epochs read the cache.
+    
+    Returns:
+        (train_ds, val_ds, train_count, val_count)
+    """
+    paths, labels = list_image_files(data_dir)
+    (train_paths, train_labels), (val_paths, val_labels) = split_files(paths, labels)
+    augmentation = create_augmentation()
+    
+    def augment(images, labels):
+        return augmentation(images, training=True), labels
+    
+    def build(split_paths, split_labels, cache_suffix, training):
+        ds = tf.data.Dataset.from_tensor_slices((split_paths, split_labels))
+        ds = ds.map(decode_and_resize, num_parallel_calls=tf.data.AUTOTUNE)
+        ds = ds.cache(f"{cache_file}.{cache_suffix}" if cache_file else '')
+        if training:
+            ds = ds.shuffle(len(split_paths), seed=SEED, reshuffle_each_iteration=True)
+        ds = ds.batch(BATCH_SIZE)
+        ds = ds.map(normalize_batch, num_parallel_calls=tf.data.AUTOTUNE)
+        if training:
+            ds = ds.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+        return ds.prefetch(tf.data.AUTOTUNE)
+    
+    train_ds = build(train_paths, train_labels, 'train', training=True)
+    val_ds = build(val_paths, val_labels, 'val', training=False)
+    return train_ds, val_ds, len(train_paths), len(val_paths)
+
+
+def create_packed_datasets(dataset_dir=None):
+    """
+    Create training and validation pipelines from a packed dataset
+    
+    Batches are sliced straight out of the memory-mapped array built by
+    `python packed_dataset.py build`, so there is no per-epoch decoding.
+    
+    Returns:
+        (train_ds, val_ds, train_count, val_count)
+    """
+    dataset = PackedDataset(dataset_dir or default_dataset_dir(IMG_SIZE[0]))
+    if (dataset.size, dataset.size) != tuple(IMG_SIZE):
+        raise ValueError(f"Packed dataset is {dataset.size}px but IMG_SIZE is {IMG_SIZE}")
+    train_rows, val_rows = dataset.split(VALIDATION_SPLIT, SEED)
+    augmentation = create_augmentation()
+    num_classes = len(CLASS_NAMES)
+    
+    def augment(images, labels):
+        return augmentation(images, training=True), labels
+    
+    def build(rows, training):
+        def batches():
+            # A new shuffle order every epoch for training
+            yield from dataset.iter_batches(rows, BATCH_SIZE, shuffle=training)
+        
+        ds = tf.data.Dataset.from_generator(batches, output_signature=(
+            tf.TensorSpec(shape=(None, *IMG_SIZE, 3), dtype=tf.uint8),
+            tf.TensorSpec(shape=(None,), dtype=tf.int64),
+        ))
+        ds = ds.apply(tf.data.experimental.assert_cardinality(-(-len(rows) // BATCH_SIZE)))
+        ds = ds.map(lambda images, labels: (images, tf.one_hot(labels, num_classes)))
+        ds = ds.map(normalize_batch, num_parallel_calls=tf.data.AUTOTUNE)
+        if training:
+            ds = ds.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+        return ds.prefetch(tf.data.AUTOTUNE)
+    
+    return build(train_rows, True), build(val_rows, False), len(train_rows), len(val_rows)
+
+
+def benchmark_input_pipeline(batches, steps, label):
+    """
+    Time how fast an input pipeline yields batches (no model involved)
+    
+    Args:
+        batches: iterable of (images, labels) batches
+        steps: number of batches to pull
+        label: name printed in the report
+    """
+    iterator = iter(batches)
+    step_times = []
+    images = 0
+    for _ in range(steps):
+        started = time.perf_counter()
+        try:
+            batch_images, _ = next(iterator)
+        except StopIteration:
+            break
+        step_times.append(time.perf_counter() - started)
+        images += len(batch_images)
+    
+    total = sum(step_times)
+    print(f"  {label:28s}: {1000 * total / max(len(step_times), 1):7.1f} ms/step, "
+          f"{images / total if total else 0:8.1f} images/sec ({len(step_times)} steps)")
+
+
+def compare_input_pipelines(cache_file=None, packed_dataset=None):
+    """Benchmark ImageDataGenerator against the tf.data pipeline"""
+    print("\nInput pipeline benchmark (one full training epoch each):")
+    print("-" * 60)
+    
+    train_gen, _ = create_data_generators()
+    steps = len(train_gen)
+    benchmark_input_pipeline(train_gen, steps, "ImageDataGenerator epoch 1")
+    benchmark_input_pipeline(train_gen, steps, "ImageDataGenerator epoch 2")
+    
+    train_ds, _, _, _ = create_tf_datasets(cache_file=cache_file)
+    benchmark_input_pipeline(train_ds, steps, "tf.data epoch 1 (decode)")
+    benchmark_input_pipeline(train_ds, steps, "tf.data epoch 2 (cached)")
+    
+    if packed_dataset is not None:
+        train_ds, _, _, _ = create_packed_datasets(packed_dataset or None)
+        benchmark_input_pipeline(train_ds, steps, "packed epoch 1")
+        benchmark_input_pipeline(train_ds, steps, "packed epoch 2")
+
+
+def train_head_on_cached_features(dataset_dir=None, output_path=HEAD_MODEL_OUTPUT):
+    """
+    Retrain only the classification head on cached ResNet50 features
+    
+    1. Append any new images to the packed dataset
+    2. Push only images without cached features through the frozen backbone
+    3. Train the head on the cached feature vectors (seconds, not minutes)
+    4. Save backbone + head as one model that `load_model` can serve
+    """
+    from feature_cache import update_feature_cache
+    
+    dataset_dir = dataset_dir or default_dataset_dir(IMG_SIZE[0])
+    appended = build_packed_dataset(DATA_DIR, dataset_dir, IMG_SIZE[0])
+    print(f"Packed dataset: {appended} new image(s) appended")
+    dataset = PackedDataset(dataset_dir)
+    
+    started = time.perf_counter()
+    cache, backbone, computed = update_feature_cache(dataset, batch_size=BATCH_SIZE)
+    print(f"Feature cache: {computed} image(s) featurized in {time.perf_counter() - started:.1f}s "
+          f"({len(cache.rows)} cached, {cache.version})")
+    
+    train_rows, val_rows = dataset.split(VALIDATION_SPLIT, SEED)
+    
+    def features_and_labels(rows):
+        hashes = [dataset.records[row]['sha1'] for row in rows]
+        labels = keras.utils.to_categorical(dataset.labels[rows], len(CLASS_NAMES))
+        return cache.lookup(hashes), labels
+    
+    x_train, y_train = features_and_labels(train_rows)
+    x_val, y_val = features_and_labels(val_rows)
+    print(f"Training samples: {len(x_train)}")
+    print(f"Validation samples: {len(x_val)}")
+    
+    head = create_head(cache.dim, len(CLASS_NAMES))
+    head.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE),
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+    
+    started = time.perf_counter()
+    history = head.fit(
+        x_train, y_train,
+        validation_data=(x_val, y_val),
+        epochs=EPOCHS,
+        batch_size=BATCH_SIZE,
+        callbacks=[keras.callbacks.EarlyStopping(
+            monitor='val_loss', patience=10, restore_best_weights=True, verbose=1)],
+        verbose=2
+    )
+    print(f"Head trained in {time.perf_counter() - started:.1f}s")
+    
+    # Assemble the servable model: [0, 1] RGB image -> backbone -> head
+    inputs = layers.Input(shape=(*IMG_SIZE, 3))
+    outputs = head(backbone(inputs))
+    model = keras.Model(inputs, outputs, name='resnet50_profilepic_classifier')
+    model.save(output_path)
+    print(f"Model saved to: {output_path}")
+    return history
+
+
+def train_student_by_distillation(train_ds, val_ds, teacher_path=TEACHER_MODEL,
+                                  output_path=STUDENT_MODEL_OUTPUT, extra_callbacks=None):
+    """
+    Distill the ResNet50 teacher into the small student network
+    
+    The student is saved on its own, so classifier_api.load_model serves it
+    like any other model (MODEL_PATH=models/profile_classifier_student.keras).
+    """
+    print(f"Loading teacher from: {teacher_path}")
+    teacher = keras.models.load_model(teacher_path)
+    student = create_student_model((*IMG_SIZE, 3), len(CLASS_NAMES))
+    student.summary()
+    
+    distiller = Distiller(student, teacher)
+    distiller.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE),
+        metrics=['accuracy']
+    )
+    
+    history = distiller.fit(
+        train_ds,
+        validation_data=val_ds,
+        epochs=EPOCHS,
+        callbacks=[
+            keras.callbacks.EarlyStopping(
+                monitor='val_accuracy', mode='max', patience=10,
+                restore_best_weights=True, verbose=1),
+            keras.callbacks.ReduceLROnPlateau(
+                monitor='val_loss', factor=0.5, patience=5, min_lr=1e-7, verbose=1),
+            *(extra_callbacks or []),
+        ],
+        verbose=1
+    )
+    student.save(output_path)
+    print(f"Student saved to: {output_path}")
+    return history
+
+
+def create_input_pipelines(args):
+    """
+    Build the training/validation inputs selected on the command line
+    
+    Returns:
+        (train, val, train_count, val_count)
+    """
+    if args.packed_dataset is not None:
+        print("\nLoading packed dataset...")
+        return create_packed_datasets(args.packed_dataset or None)
+    if args.pipeline == 'tfdata':
+        print("\nCreating tf.data pipelines...")
+        return create_tf_datasets(cache_file=args.cache_file)
+    print("\nCreating data generators...")
+    train_gen, val_gen = create_data_generators()
+    return train_gen, val_gen, train_gen.samples, val_gen.samples
+
+
+def create_instrumentation(args, train_ds):
+    """
+    Attach throughput instrumentation to a training run
+    
+    tf.data pipelines get an InputTimer stage so input wait can be split out
+    of step time; the ImageDataGenerator pipeline is measured without it.
+    
+    Returns:
+        (train_ds, TrainingInstrumentation callback)
+    """
+    from training_instrumentation import InputTimer, TrainingInstrumentation, default_log_path
+    
+    input_timer = None
+    if isinstance(train_ds, tf.data.Dataset):
+        input_timer = InputTimer()
+        train_ds = input_timer.wrap(train_ds)
+    pipeline = 'packed' if args.packed_dataset is not None else args.pipeline
+    callback = TrainingInstrumentation(
+        args.instrument or default_log_path(),
+        BATCH_SIZE,
+        input_timer=input_timer,
+        profile_steps=args.profile_steps,
+        run_info={'mode': args.mode, 'pipeline': pipeline, 'img_size': list(IMG_SIZE),
+                  'batch_size': BATCH_SIZE, 'epochs': EPOCHS, 'learning_rate': LEARNING_RATE},
+    )
+    return train_ds, callback
+
+
+def parse_args():
+    """Parse command-line options"""
+    parser = argparse.ArgumentParser(description="Train the profile picture classifier")
+    parser.add_argument('--mode', choices=['full', 'head', 'distill', 'incremental'],
+                        default='full',
+                        help="full: train the CNN end to end; head: retrain only a "
+                             "classification head on cached ResNet50 features; "
+                             "distill: train a small student against the ResNet50 teacher; "
+                             "incremental: fine-tune the current registered model on new images")
+    parser.add_argument('--teacher', default=str(TEACHER_MODEL),
+                        help="Teacher model for --mode distill")
+    parser.add_argument('--pipeline', choices=['tfdata', 'generator'], default='tfdata',
+                        help="Input pipeline: tf.data (default) or Keras ImageDataGenerator")
+    parser.add_argument('--cache-file', default=None,
+                        help="Cache decoded images to this file prefix instead of memory")
+    parser.add_argument('--packed-dataset', nargs='?', const='', default=None,
+                        help="Train from a packed dataset (default location if no path given)")
+    parser.add_argument('--benchmark-input', action='store_true',
+                        help="Only benchmark the input pipelines, do not train")
+    parser.add_argument('--instrument', nargs='?', const='', default=None, metavar='LOG',
+                        help="Record per-step time, images/sec, input wait and memory to a "
+                             "JSON-lines log (default logs/training/<time>.jsonl)")
+    parser.add_argument('--profile-steps', type=int, nargs=2, default=None,
+                        metavar=('FIRST', 'LAST'),
+                        help="Capture a TensorFlow profiler trace for these training steps")
+    parser.add_argument('--img-size', type=int, default=None,
+                        help=f"Square input resolution (default {IMG_SIZE[0]})")
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help=f"Batch size (default {BATCH_SIZE})")
+    parser.add_argument('--epochs', type=int, default=None,
+                        help=f"Maximum epochs (default {EPOCHS})")
+    parser.add_argument('--learning-rate', type=float, default=None,
+                        help=f"Adam learning rate (default {LEARNING_RATE})")
+    return parser.parse_args()
+
+
 def main():
     """Main training function"""
+    args = parse_args()
+    configure(args.img_size, args.batch_size, args.epochs, args.learning_rate)
+    
     print("=" * 60)
     print("Profile Picture Classifier - Model Training")
     print("=" * 60)
@@ -156,16 +630,52 @@ def main():
         else:
             print(f"  {class_name:10s}: MISSING DIRECTORY!")
     
-    # Create data generators
-    print("\nCreating data generators...")
-    train_gen, val_gen = create_data_generators()
+    if args.mode == 'head':
+        print("\nRetraining classification head on cached backbone features...")
+        history = train_head_on_cached_features(args.packed_dataset or None)
+        print(f"\nBest validation accuracy: {max(history.history['val_accuracy']):.4f}")
+        return
     
-    print(f"Training samples: {train_gen.samples}")
-    print(f"Validation samples: {val_gen.samples}")
+    if args.mode == 'incremental':
+        from incremental_training import retrain_incrementally
+        print("\nFine-tuning the current model on new images...")
+        run = retrain_incrementally(epochs=args.epochs or 10,
+                                    learning_rate=args.learning_rate or 1e-4,
+                                    batch_size=args.batch_size or BATCH_SIZE)
+        if run is not None:
+            print(f"\nRegistered version {run['version']}: validation accuracy "
+                  f"{run['accuracy_before']['val']} -> {run['accuracy_after']['val']}")
+        return
+    
+    if args.benchmark_input:
+        compare_input_pipelines(args.cache_file, args.packed_dataset)
+        return
+    
+    # Create input pipelines
+    train_gen, val_gen, train_count, val_count = create_input_pipelines(args)
+    
+    print(f"Training samples: {train_count}")
+    print(f"Validation samples: {val_count}")
+    
+    instrumentation = []
+    if args.instrument is not None or args.profile_steps:
+        train_gen, callback = create_instrumentation(args, train_gen)
+        instrumentation.append(callback)
+    
+    if args.mode == 'distill':
+        print("\nDistilling teacher into student model...")
+        train_student_by_distillation(train_gen, val_gen, args.teacher,
+                                      extra_callbacks=instrumentation)
+        
+        # Compare teacher and student (accuracy, latency, size, RSS)
+        from evaluate_model import compare_models
+        build_packed_dataset(DATA_DIR, default_dataset_dir(IMG_SIZE[0]), IMG_SIZE[0])
+        compare_models([args.teacher, STUDENT_MODEL_OUTPUT])
+        return
     
     # Create model
     print("\nCreating model...")
-    model = create_model()
+    model = create_model((*IMG_SIZE, 3), len(CLASS_NAMES))
     
     # Print model summary
     print("\nModel Architecture:")
@@ -204,7 +714,8 @@ def main():
             patience=5,
             min_lr=1e-7,
             verbose=1
-        )
+        ),
+        *instrumentation
     ]
     
     # Train model
@@ -0,0 +1,278 @@
+"""
+Training throughput instrumentation
+
+A Keras callback that splits every training step into input-pipeline wait,
+compute, and Python/callback overhead between steps. It records images/sec
+and peak memory, can capture a TensorFlow profiler trace for a chosen step
+window, and writes everything to a JSON-lines log:
+
+    {"type": "run", ...}      hyperparameters and pipeline, once
+    {"type": "step", ...}     one per training step
+    {"type": "epoch", ...}    per-epoch aggregates + Keras metrics
+    {"type": "summary", ...}  whole-run aggregates and the dominant bottleneck
+
+Input wait is measured by InputTimer, which stamps each batch as the
+training step pulls it off the tf.data pipeline. The difference between
+the step's start and the batch's arrival is time spent waiting on input.
+
+Usage:
+    python train_model_example.py --instrument                      # logs/training/<time>.jsonl
+    python train_model_example.py --instrument --profile-steps 20 25
+    python training_instrumentation.py logs/training/a.jsonl logs/training/b.jsonl
+"""
+import argparse
+import json
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from evaluate_model import peak_rss_mb
+
+BASE_DIR = Path(__file__).parent
+LOG_DIR = BASE_DIR / "logs" / "training"
+
+# A bottleneck is reported once it takes at least this share of step time
+BOTTLENECK_SHARE = 0.25
+
+
+def current_rss_mb():
+    """Current resident memory of this process in MB (None if unavailable)"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+class InputTimer:
+    """
+    Records when each training batch reaches the model
+
+    wrap() appends a stage to the end of a tf.data pipeline that records
+    (arrival time, batch size) from a py_function as the batch is consumed.
+    """
+
+    def __init__(self):
+        self.arrivals = deque()
+
+    def _record(self, batch_size):
+        self.arrivals.append((time.perf_counter(), int(batch_size)))
+        return np.int64(0)
+
+    def wrap(self, dataset):
+        def stamp(images, labels):
+            token = tf.py_function(self._record, [tf.shape(images)[0]], tf.int64)
+            with tf.control_dependencies([token]):
+                return tf.identity(images), tf.identity(labels)
+
+        return dataset.map(stamp)
+
+    def pop(self):
+        """Oldest unclaimed (arrival time, batch size), or (None, None)"""
+        return self.arrivals.popleft() if self.arrivals else (None, None)
+
+    def clear(self):
+        self.arrivals.clear()
+
+
+class TrainingInstrumentation(keras.callbacks.Callback):
+    """
+    Per-step timing, throughput, memory and optional profiler trace
+
+    Args:
+        log_path: JSON-lines file to write (appended per epoch)
+        batch_size: images per step, used when no InputTimer reports sizes
+        input_timer: InputTimer wrapped around the training dataset (optional;
+            without it input wait is folded into compute time)
+        profile_steps: (first, last) global step numbers to trace, inclusive
+        profile_dir: where the profiler trace goes (TensorBoard format)
+        run_info: dict of hyperparameters written as the first record
+    """
+
+    def __init__(self, log_path, batch_size, input_timer=None, profile_steps=None,
+                 profile_dir=None, run_info=None):
+        super().__init__()
+        self.log_path = Path(log_path)
+        self.batch_size = batch_size
+        self.input_timer = input_timer
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir or str(self.log_path.with_suffix('')) + '_profile'
+        self.run_info = run_info or {}
+        self._profiling = False
+
+    def _write(self, records):
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def on_train_begin(self, logs=None):
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        self.global_step = 0
+        self.all_steps = []
+        self.train_started = time.perf_counter()
+        self._write([{'type': 'run', 'started_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                      **self.run_info}])
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.current_epoch = epoch
+        self.epoch_steps = []
+        self.last_step_end = None
+        self.epoch_started = time.perf_counter()
+        if self.input_timer is not None:
+            self.input_timer.clear()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.profile_dir)
+            self._profiling = True
+        self.step_started = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        arrival, images = (self.input_timer.pop() if self.input_timer is not None
+                           else (None, None))
+        step_seconds = step_end - self.step_started
+        input_wait = max(0.0, arrival - self.step_started) if arrival is not None else None
+        overhead = self.step_started - self.last_step_end if self.last_step_end else 0.0
+        images = images or self.batch_size
+
+        record = {
+            'type': 'step',
+            'epoch': self.current_epoch,
+            'step': self.global_step,
+            'images': images,
+            'step_ms': round(step_seconds * 1000, 3),
+            'input_wait_ms': round(input_wait * 1000, 3) if input_wait is not None else None,
+            'compute_ms': round((step_seconds - (input_wait or 0.0)) * 1000, 3),
+            'overhead_ms': round(overhead * 1000, 3),
+            'images_per_second': round(images / step_seconds, 1) if step_seconds else None,
+            'loss': float(logs['loss']) if logs and 'loss' in logs else None,
+        }
+        self.epoch_steps.append(record)
+        self.last_step_end = step_end
+
+        if self._profiling and self.global_step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+            print(f"\nProfiler trace for steps {self.profile_steps[0]}-{self.profile_steps[1]} "
+                  f"written to {self.profile_dir}")
+        self.global_step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_seconds = time.perf_counter() - self.epoch_started
+        record = {'type': 'epoch', 'epoch': epoch, 'seconds': round(epoch_seconds, 3)}
+        record.update(aggregate_steps(self.epoch_steps))
+        record['current_rss_mb'] = current_rss_mb()
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['metrics'] = {k: float(v) for k, v in (logs or {}).items()
+                             if isinstance(v, (int, float, np.floating))}
+        self._write(self.epoch_steps + [record])
+        self.all_steps.extend(self.epoch_steps)
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+        summary = {'type': 'summary',
+                   'seconds': round(time.perf_counter() - self.train_started, 3)}
+        summary.update(aggregate_steps(self.all_steps))
+        summary['peak_rss_mb'] = peak_rss_mb()
+        summary['bottleneck'] = classify_bottleneck(summary)
+        self._write([summary])
+        print_summary(self.log_path, summary)
+
+
+def aggregate_steps(steps):
+    """Step-time percentiles, throughput and how step time splits up"""
+    # The first step of a run includes tracing/compilation; leave it out
+    steps = [s for s in steps if s['step'] > 0] or steps
+    if not steps:
+        return {'steps': 0}
+    step_ms = np.array([s['step_ms'] for s in steps])
+    overhead_ms = np.array([s['overhead_ms'] for s in steps])
+    waits = [s['input_wait_ms'] for s in steps if s['input_wait_ms'] is not None]
+    wall_ms = step_ms.sum() + overhead_ms.sum()
+    images = sum(s['images'] for s in steps)
+    return {
+        'steps': len(steps),
+        'images': images,
+        'step_ms_p50': round(float(np.percentile(step_ms, 50)), 3),
+        'step_ms_p95': round(float(np.percentile(step_ms, 95)), 3),
+        'step_ms_mean': round(float(step_ms.mean()), 3),
+        'images_per_second': round(images / (wall_ms / 1000), 1) if wall_ms else None,
+        'input_wait_share': round(sum(waits) / wall_ms, 4) if waits and wall_ms else None,
+        'overhead_share': round(float(overhead_ms.sum() / wall_ms), 4) if wall_ms else None,
+        'compute_share': round(float((step_ms.sum() - sum(waits)) / wall_ms), 4) if wall_ms else None,
+    }
+
+
+def classify_bottleneck(stats):
+    """'input', 'python-overhead' or 'compute', from the time shares"""
+    if (stats.get('input_wait_share') or 0.0) >= BOTTLENECK_SHARE:
+        return 'input'
+    if (stats.get('overhead_share') or 0.0) >= BOTTLENECK_SHARE:
+        return 'python-overhead'
+    return 'compute'
+
+
+def print_summary(log_path, summary):
+    print("\nTraining throughput:")
+    print("-" * 60)
+    print(f"  Steps:               {summary.get('steps', 0)}")
+    print(f"  Step time p50/p95:   {summary.get('step_ms_p50')} / {summary.get('step_ms_p95')} ms")
+    print(f"  Images/sec:          {summary.get('images_per_second')}")
+    print(f"  Input wait share:    {summary.get('input_wait_share')}")
+    print(f"  Overhead share:      {summary.get('overhead_share')}")
+    print(f"  Peak RSS:            {summary.get('peak_rss_mb')} MB")
+    print(f"  Bottleneck:          {summary.get('bottleneck')}")
+    print(f"  Log:                 {log_path}")
+
+
+def default_log_path():
+    return LOG_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+
+
+def read_log(log_path):
+    """Return (run record, summary record) from an instrumentation log"""
+    run, summary = {}, {}
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['type'] == 'run':
+                run = record
+            elif record['type'] == 'summary':
+                summary = record
+    return run, summary
+
+
+def compare_logs(log_paths):
+    """Print one summary row per instrumentation log"""
+    print(f"\n{'log':28s} {'pipeline':10s} {'batch':>5s} {'p50 ms':>8s} {'img/s':>8s} "
+          f"{'wait':>6s} {'ovh':>6s} {'RSS MB':>8s}  bottleneck")
+    print("-" * 100)
+    for log_path in log_paths:
+        run, s = read_log(log_path)
+        fmt = lambda v, spec: format(v, spec) if v is not None else '-'
+        print(f"{Path(log_path).name:28s} {str(run.get('pipeline', '-')):10s} "
+              f"{fmt(run.get('batch_size'), '5d'):>5s} {fmt(s.get('step_ms_p50'), '8.2f'):>8s} "
+              f"{fmt(s.get('images_per_second'), '8.1f'):>8s} "
+              f"{fmt(s.get('input_wait_share'), '6.3f'):>6s} {fmt(s.get('overhead_share'), '6.3f'):>6s} "
+              f"{fmt(s.get('peak_rss_mb'), '8.1f'):>8s}  {s.get('bottleneck', '-')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare training instrumentation logs")
+    parser.add_argument('logs', nargs='+', help="JSON-lines logs written by --instrument")
+    args = parser.parse_args()
+    compare_logs(args.logs)
+
+
+if __name__ == "__main__":
+    main()